@@ -0,0 +1,143 @@
+"""Time series of mileage and expenses for the trends charts.
+
+`timeseries` buckets one metric by day, week (from Monday), month or year in
+UTC, optionally split into series per vehicle, expense category or
+business/personal, with one date_trunc/GROUP BY query over the
+(user_id, time) indexes of trips or expenses. Buckets with no rows are zero.
+
+Buckets before the current one rarely change, so they are cached per process
+along with the user's change counter (`sync_state.seq`, bumped by every write
+to their vehicles, trips and expenses, from any worker). While the counter is
+unchanged only the current bucket is queried again. After a write, or once
+the current bucket has closed, the whole range is recomputed and re-cached.
+"""
+import calendar
+from datetime import datetime, timedelta, timezone
+
+from fastapi import HTTPException
+
+import metrics
+
+# Metric -> series it can be split into
+METRICS = {
+    "miles": ("vehicle", "business"),
+    "business_miles": ("vehicle",),
+    "trips": ("vehicle", "business"),
+    "expenses": ("vehicle", "category"),
+}
+BUCKETS = ("day", "week", "month", "year")
+
+# Ten years of days
+MAX_BUCKETS = 3700
+CACHE_SIZE = 10_000
+
+cache_hits = metrics.counter("analytics_cache_hits_total", "Time series served from cached closed buckets")
+cache_misses = metrics.counter("analytics_cache_misses_total", "Time series computed over the whole range")
+
+
+def as_utc(value: datetime) -> datetime:
+    # Naive values, such as a date-only start_date, are taken as UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def truncate(value: datetime, bucket: str) -> datetime:
+    """Start of the UTC bucket holding `value`, as date_trunc(bucket, value, 'UTC')."""
+    value = as_utc(value).replace(hour=0, minute=0, second=0, microsecond=0)
+    if bucket == "week":
+        return value - timedelta(days=value.weekday())
+    if bucket == "month":
+        return value.replace(day=1)
+    if bucket == "year":
+        return value.replace(month=1, day=1)
+    return value
+
+
+def next_bucket(value: datetime, bucket: str) -> datetime:
+    if bucket == "day":
+        return value + timedelta(days=1)
+    if bucket == "week":
+        return value + timedelta(weeks=1)
+    if bucket == "month":
+        return value + timedelta(days=calendar.monthrange(value.year, value.month)[1])
+    return value.replace(year=value.year + 1)
+
+
+def bucket_range(start: datetime, end: datetime, bucket: str) -> list:
+    """Starts of the buckets covering start <= time < end."""
+    starts = []
+    current = truncate(start, bucket)
+    end = as_utc(end)
+    while current < end:
+        if len(starts) == MAX_BUCKETS:
+            raise HTTPException(status_code=400, detail=f"More than {MAX_BUCKETS} buckets; use a larger bucket or a shorter range")
+        starts.append(current)
+        current = next_bucket(current, bucket)
+    return starts
+
+
+class CacheEntry:
+    __slots__ = ("seq", "start", "closed_until", "values")
+
+    def __init__(self, seq: int, start: datetime, closed_until: datetime, values: dict):
+        self.seq = seq
+        self.start = start
+        # Buckets before this were closed when computed
+        self.closed_until = closed_until
+        # (bucket start, series) -> value
+        self.values = values
+
+
+# (user_id, metric, bucket, group_by) -> CacheEntry
+cache = {}
+
+
+async def timeseries(storage, user_id: str, metric: str, bucket: str, group_by, start: datetime, end: datetime,
+                     now: datetime = None) -> dict:
+    """Buckets covering start..end and one list of values per series, aligned with them."""
+    starts = bucket_range(start, end, bucket)
+    if not starts:
+        return {"metric": metric, "bucket": bucket, "group_by": group_by, "buckets": [], "series": []}
+    start, end = starts[0], next_bucket(starts[-1], bucket)
+    current = truncate(now or datetime.now(timezone.utc), bucket)
+    closed_until = min(end, current)
+
+    async def compute(since):
+        rows = await storage.timeseries(user_id, metric, bucket, group_by, since, end)
+        return {(row['bucket'], row['series']): row['value'] for row in rows}
+
+    # Read before the rows, so a write racing the query invalidates what is cached
+    seq = await storage.change_seq(user_id)
+    key = (user_id, metric, bucket, group_by)
+    entry = cache.get(key)
+    # A bucket closed since the entry was cached is missing from it, so it no longer covers the range
+    if entry is not None and entry.seq == seq and entry.start <= start and entry.closed_until >= closed_until:
+        cache_hits.inc()
+        values = {k: v for k, v in entry.values.items() if start <= k[0] < closed_until}
+        if end > closed_until:
+            values.update(await compute(closed_until))
+    else:
+        cache_misses.inc()
+        values = await compute(start)
+        if len(cache) >= CACHE_SIZE:
+            cache.clear()
+        cache[key] = CacheEntry(seq, start, closed_until, {k: v for k, v in values.items() if k[0] < closed_until})
+
+    index = {bucket_start: i for i, bucket_start in enumerate(starts)}
+    series = {}
+    for (bucket_start, name), value in values.items():
+        if name not in series:
+            series[name] = [0] * len(starts)
+        series[name][index[bucket_start]] = int(value) if metric == "trips" else round(value, 2)
+
+    return {
+        "metric": metric,
+        "bucket": bucket,
+        "group_by": group_by,
+        "buckets": starts,
+        "series": [
+            {"name": name, "values": series[name]}
+            for name in sorted(series, key=lambda name: (name is not None, name or ""))
+        ],
+    }
@@ -0,0 +1,259 @@
+"""Full-account export as a streamed zip archive, and bulk restore via COPY.
+
+The archive holds one CSV per table plus `receipts/<expense_id>.<ext>` files
+decoded from `receipt_image_base64`. Rows are read from server-side cursors and
+every compressed chunk is yielded as soon as it is written, so neither export
+nor import ever holds a whole table in memory. Import decompresses in a worker
+thread, off the event loop, and refuses archives whose entries add up to more
+than MAX_IMPORT_BYTES uncompressed.
+"""
+import asyncio
+import base64
+import csv
+import io
+import json
+import mimetypes
+import os
+import zipfile
+from datetime import datetime, timezone
+
+from repository import DOLLARS, METERS_PER_MILE, MILES
+
+ARCHIVE_FORMAT = 1
+
+# Archive columns per table; user_id is implied by the account
+ARCHIVE_COLUMNS = {
+    "vehicles": ["vehicle_id", "name", "make", "model", "year", "business_percentage", "created_at"],
+    "trips": [
+        "trip_id", "vehicle_id", "start_time", "end_time", "distance", "start_location",
+        "end_location", "purpose", "is_business", "is_automatic", "created_at",
+    ],
+    "expenses": ["expense_id", "vehicle_id", "amount", "category", "date", "notes", "created_at", "receipt"],
+    "subscriptions": ["subscription_id", "plan_type", "status", "start_date", "end_date", "created_at"],
+}
+
+# Subscriptions are exported for the user's records but never restored: plan
+# state comes from billing, not from an uploaded file
+IMPORT_TABLES = ("vehicles", "trips", "expenses")
+
+# Imported table -> external id; rows whose id exists are skipped
+IMPORT_IDS = {"vehicles": "vehicle_id", "trips": "trip_id", "expenses": "expense_id"}
+
+EXPORT_BATCH_SIZE = 1000
+RECEIPT_BATCH_SIZE = 50
+
+# Flush the import COPY stream once this much CSV is buffered
+COPY_CHUNK_SIZE = 1 << 20
+
+# Uncompressed size of all entries together; zipfile stops each entry at its declared size
+MAX_IMPORT_BYTES = int(os.getenv("MAX_IMPORT_BYTES", str(1 << 30)))
+
+RECEIPT_PATH = (
+    "CASE WHEN coalesce(receipt_image_base64, '') <> '' THEN "
+    "coalesce(substring(receipt_image_base64 from '^data:([^;,]+)'), '') END AS receipt"
+)
+
+# Archives keep amounts in dollars and distances in miles, like the API
+EXPORT_EXPRESSIONS = {
+    "distance": f"{MILES} AS distance",
+    "amount": f"{DOLLARS} AS amount",
+    "receipt": RECEIPT_PATH,
+}
+
+# Archive column -> (stored column, conversion from the archived value)
+STORED_COLUMNS = {
+    "distance": ("distance_m", f"round(distance * {METERS_PER_MILE})"),
+    "amount": ("amount_cents", "round(amount * 100)"),
+}
+
+
+class ZipSink(io.RawIOBase):
+    """Unseekable write target collecting zip output until it is drained."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def receipt_path(expense_id: str, mime_type: str) -> str:
+    extension = mimetypes.guess_extension(mime_type) if mime_type else None
+    return f"receipts/{expense_id}{extension or '.bin'}"
+
+
+def decode_receipt(data_url: str) -> bytes:
+    _, _, payload = data_url.rpartition(",")
+    return base64.b64decode(payload)
+
+
+def encode_receipt(path: str, data: bytes) -> str:
+    payload = base64.b64encode(data).decode()
+    mime_type, _ = mimetypes.guess_type(path)
+    if path.endswith(".bin") or not mime_type:
+        return payload
+    return f"data:{mime_type};base64,{payload}"
+
+
+def zip_entry(name: str, compress_type=zipfile.ZIP_DEFLATED) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, datetime.now(timezone.utc).timetuple()[:6])
+    info.compress_type = compress_type
+    return info
+
+
+def export_columns(columns) -> str:
+    return ", ".join(EXPORT_EXPRESSIONS.get(c, c) for c in columns)
+
+
+def export_query(table: str) -> str:
+    return f"SELECT {export_columns(ARCHIVE_COLUMNS[table])} FROM {table} WHERE user_id = $1"
+
+
+async def stream_archive(pool, user_id: str):
+    sink = ZipSink()
+    counts = {}
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        async with pool.acquire() as conn:
+            async with conn.transaction(isolation='repeatable_read', readonly=True):
+                for table, columns in ARCHIVE_COLUMNS.items():
+                    counts[table] = 0
+                    with io.TextIOWrapper(
+                        archive.open(zip_entry(f"{table}.csv"), "w", force_zip64=True),
+                        encoding="utf-8", newline=""
+                    ) as member:
+                        writer = csv.writer(member)
+                        writer.writerow(columns)
+                        cursor = await conn.cursor(export_query(table), user_id)
+                        while rows := await cursor.fetch(EXPORT_BATCH_SIZE):
+                            for row in rows:
+                                row = list(row)
+                                if table == "expenses" and row[-1] is not None:
+                                    row[-1] = receipt_path(row[0], row[-1])
+                                writer.writerow(row)
+                            counts[table] += len(rows)
+                            member.flush()
+                            yield sink.drain()
+
+                # Receipts go in their own entries, already compressed images are stored as-is
+                cursor = await conn.cursor(
+                    f"""SELECT expense_id, receipt_image_base64, {RECEIPT_PATH} FROM expenses
+                        WHERE user_id = $1 AND coalesce(receipt_image_base64, '') <> ''""",
+                    user_id
+                )
+                counts["receipts"] = 0
+                while rows := await cursor.fetch(RECEIPT_BATCH_SIZE):
+                    for expense_id, data_url, mime_type in rows:
+                        archive.writestr(
+                            zip_entry(receipt_path(expense_id, mime_type), zipfile.ZIP_STORED),
+                            decode_receipt(data_url)
+                        )
+                    counts["receipts"] += len(rows)
+                    yield sink.drain()
+
+        archive.writestr(zip_entry("manifest.json"), json.dumps({
+            "format": ARCHIVE_FORMAT,
+            "exported_at": datetime.now(timezone.utc).isoformat(),
+            "counts": counts,
+        }, indent=2))
+    yield sink.drain()
+
+
+def read_member(archive: zipfile.ZipFile, name: str):
+    """Raw bytes of one archive entry, in chunks."""
+    with archive.open(name) as member:
+        while chunk := member.read(COPY_CHUNK_SIZE):
+            yield chunk
+
+
+def expenses_with_receipts(archive: zipfile.ZipFile):
+    """expenses.csv with each receipt path replaced by the encoded image."""
+    with io.TextIOWrapper(archive.open("expenses.csv"), encoding="utf-8", newline="") as member:
+        reader = csv.reader(member)
+        header = next(reader)
+        receipt = header.index("receipt")
+        header[receipt] = "receipt_image_base64"
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        for row in reader:
+            if row[receipt]:
+                row[receipt] = encode_receipt(row[receipt], archive.read(row[receipt]))
+            writer.writerow(row)
+            if buffer.tell() >= COPY_CHUNK_SIZE:
+                yield buffer.getvalue().encode()
+                buffer.seek(0)
+                buffer.truncate()
+        yield buffer.getvalue().encode()
+
+
+async def aiter_chunks(chunks):
+    # Each chunk is decompressed (and receipts encoded) in a worker thread
+    chunks = iter(chunks)
+    while (chunk := await asyncio.to_thread(next, chunks, None)) is not None:
+        yield chunk
+
+
+def check_size(archive: zipfile.ZipFile):
+    total = sum(info.file_size for info in archive.infolist())
+    if total > MAX_IMPORT_BYTES:
+        raise ValueError(f"Archive expands to {total} bytes, at most {MAX_IMPORT_BYTES} are accepted")
+
+
+async def import_archive(pool, user_id: str, archive: zipfile.ZipFile) -> dict:
+    """Restore an exported archive into the account, skipping rows that already exist."""
+    check_size(archive)
+    manifest = json.loads(await asyncio.to_thread(archive.read, "manifest.json"))
+    if manifest.get("format") != ARCHIVE_FORMAT:
+        raise ValueError(f"Unsupported archive format: {manifest.get('format')}")
+
+    imported = {}
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            for table in IMPORT_TABLES:
+                columns = ARCHIVE_COLUMNS[table]
+                if table == "expenses":
+                    columns = [c if c != "receipt" else "receipt_image_base64" for c in columns]
+                    source = expenses_with_receipts(archive)
+                else:
+                    source = read_member(archive, f"{table}.csv")
+
+                staging = f"import_{table}"
+                await conn.execute(
+                    f"CREATE TEMP TABLE {staging} ON COMMIT DROP AS "
+                    f"SELECT {export_columns(columns)} FROM {table} WITH NO DATA"
+                )
+                await conn.copy_to_table(
+                    staging, source=aiter_chunks(source), columns=columns, format="csv", header=True
+                )
+
+                if table != "vehicles":
+                    # References to vehicles outside this account are dropped
+                    await conn.execute(
+                        f"""UPDATE {staging} SET vehicle_id = NULL
+                            WHERE vehicle_id IS NOT NULL
+                              AND vehicle_id NOT IN (SELECT vehicle_id FROM vehicles WHERE user_id = $1)""",
+                        user_id
+                    )
+                stored = [STORED_COLUMNS.get(c, (c, c)) for c in columns]
+                # Partitioned tables are only unique on (id, time), so a conflict alone
+                # would let in a second row for an id whose time differs
+                id_column = IMPORT_IDS[table]
+                result = await conn.execute(
+                    f"""INSERT INTO {table} (user_id, {", ".join(column for column, _ in stored)})
+                        SELECT $1, {", ".join(value for _, value in stored)} FROM {staging} s
+                        WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE t.{id_column} = s.{id_column})
+                        ON CONFLICT DO NOTHING""",
+                    user_id
+                )
+                imported[table] = int(result.split()[-1])
+    return imported
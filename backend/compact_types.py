@@ -0,0 +1,289 @@
+"""Integer storage for money and distance.
+
+Expense amounts are stored as BIGINT cents (`amount_cents`) and trip distances
+as integer meters (`distance_m`) instead of FLOAT dollars and miles, so sums
+are exact and distances 4 bytes narrower. The API still speaks dollars and
+miles; repository.py converts at the SQL edge.
+
+Columns are converted online by `migrate` here or in partitioning.py, never at
+startup: the integer column is added next to the legacy one, a trigger keeps
+the two in step for old and new app versions alike, existing rows are filled
+in in batches, and a short transaction finally drops the legacy column. No
+step rewrites the table or holds an exclusive lock for longer than a catalog
+change. The server starts once the backfill is done and refuses to until then.
+
+Keys stay VARCHAR. The external ids are what clients keep in their offline
+caches, change_log and archives, and every foreign key and unique index is
+built on them; swapping in UUID/bigint keys means rewriting all of those
+tables together with a mapping at the API edge. `bench` prints what the
+narrower keys would save, to weigh that migration on its own.
+
+`migrate` converts the primary and every shard in SHARD_DATABASE_URLS.
+
+Usage:
+    python compact_types.py migrate              # convert FLOAT columns online
+    python compact_types.py migrate --keep-legacy # stop before dropping them, for a rolling deploy
+    python compact_types.py bench --rows 1000000 # compare FLOAT, integer and UUID-key layouts
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+
+from repository import METERS_PER_MILE
+from sharding import cli_router
+from sync import skip_change_log
+
+logger = logging.getLogger(__name__)
+
+# table -> [(legacy FLOAT column, integer column, its type, conversion to it, conversion back)]
+COMPACT_COLUMNS = {
+    "trips": [("distance", "distance_m", "integer", f"round({{}} * {METERS_PER_MILE})", f"{{}} / {METERS_PER_MILE}")],
+    "expenses": [("amount", "amount_cents", "bigint", "round({} * 100)", "{} / 100.0")],
+}
+
+# Rows updated per backfill transaction
+BACKFILL_BATCH = int(os.getenv("COMPACT_BACKFILL_BATCH", "5000"))
+
+# Catalog changes give up instead of queueing behind long-running queries
+LOCK_TIMEOUT = os.getenv("COMPACT_LOCK_TIMEOUT", "5s")
+
+
+async def has_column(conn, table: str, column: str) -> bool:
+    return await conn.fetchval(
+        """SELECT EXISTS (SELECT 1 FROM pg_attribute
+                          WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped)""",
+        table, column
+    )
+
+
+async def column_type(conn, table: str, column: str):
+    return await conn.fetchval(
+        """SELECT format_type(atttypid, atttypmod) FROM pg_attribute
+           WHERE attrelid = $1::regclass AND attname = $2 AND NOT attisdropped""",
+        table, column
+    )
+
+
+async def backfilled(conn, table: str, column: str) -> bool:
+    # The validated NOT NULL check is what marks a backfill finished
+    return await conn.fetchval(
+        "SELECT convalidated FROM pg_constraint WHERE conrelid = $1::regclass AND conname = $2",
+        table, f"{table}_{column}_filled"
+    ) or False
+
+
+async def pending_compact_types(conn) -> list:
+    """Legacy FLOAT columns whose integer column is not filled in yet, as table.column."""
+    pending = []
+    for table, columns in COMPACT_COLUMNS.items():
+        for legacy, column, _, _, _ in columns:
+            if await has_column(conn, table, legacy) and not await backfilled(conn, table, column):
+                pending.append(f"{table}.{legacy}")
+    return pending
+
+
+async def pending_conversions(conn, table: str) -> list:
+    """(old column, new column, its type, conversion to it, conversion back, final name) still to do."""
+    conversions = []
+    for legacy, column, type_, to_column, to_legacy in COMPACT_COLUMNS[table]:
+        if await has_column(conn, table, legacy):
+            conversions.append((legacy, column, type_, to_column, to_legacy, column))
+        elif await column_type(conn, table, column) not in (None, type_):
+            # Converted before amount_cents became BIGINT: widened through a staging column
+            conversions.append((column, f"{column}_{type_}", type_, "{}", "{}", column))
+    return conversions
+
+
+async def add_column(conn, table: str, old: str, new: str, type_: str, to_new: str, to_old: str):
+    """Add `new` and a trigger filling whichever of the two columns a writer left out."""
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        # No default, so only the catalog changes
+        await conn.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {new} {type_}")
+        await conn.execute(f"""
+            CREATE OR REPLACE FUNCTION {table}_{new}_sync() RETURNS trigger AS $$
+            BEGIN
+                IF TG_OP = 'INSERT' THEN
+                    IF NEW.{new} IS NULL THEN
+                        NEW.{new} := {to_new.format(f"NEW.{old}")};
+                    ELSIF NEW.{old} IS NULL THEN
+                        NEW.{old} := {to_old.format(f"NEW.{new}")};
+                    END IF;
+                ELSIF NEW.{old} IS DISTINCT FROM OLD.{old} THEN
+                    NEW.{new} := {to_new.format(f"NEW.{old}")};
+                -- The backfill fills NULLs and must leave the old value exactly as it was
+                ELSIF OLD.{new} IS NOT NULL AND NEW.{new} IS DISTINCT FROM OLD.{new} THEN
+                    NEW.{old} := {to_old.format(f"NEW.{new}")};
+                END IF;
+                RETURN NEW;
+            END
+            $$ LANGUAGE plpgsql
+        """)
+        await conn.execute(
+            f"""CREATE OR REPLACE TRIGGER {table}_{new}_sync
+                BEFORE INSERT OR UPDATE ON {table}
+                FOR EACH ROW EXECUTE FUNCTION {table}_{new}_sync()"""
+        )
+
+
+async def backfill(conn, table: str, old: str, new: str, to_new: str, batch: int):
+    """Fill `new` for existing rows, one short transaction per id range."""
+    bounds = await conn.fetchrow(f"SELECT MIN(id) AS low, MAX(id) AS high FROM {table} WHERE {new} IS NULL")
+    if bounds['low'] is None:
+        return
+    # Rows written since the trigger went in are filled already
+    for low in range(bounds['low'], bounds['high'] + 1, batch):
+        async with conn.transaction():
+            # Not a change clients need to sync
+            await skip_change_log(conn)
+            result = await conn.execute(
+                f"""UPDATE {table} SET {new} = {to_new.format(old)}
+                    WHERE id >= $1 AND id < $2 AND {new} IS NULL""",
+                low, low + batch
+            )
+        logger.info(f"Backfilled {table}.{new} ids {low}..{low + batch - 1}: {result.split()[-1]} rows")
+
+
+async def mark_filled(conn, table: str, new: str):
+    # Validating only takes a lock that lets reads and writes through
+    name = f"{table}_{new}_filled"
+    exists = await conn.fetchval(
+        "SELECT EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = $1::regclass AND conname = $2)",
+        table, name
+    )
+    if not exists:
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+            await conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} CHECK ({new} IS NOT NULL) NOT VALID")
+    await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {name}")
+
+
+async def swap_columns(conn, table: str, old: str, new: str, final: str):
+    """Drop the old column in one short transaction; the validated check spares SET NOT NULL a scan."""
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT}'")
+        await conn.execute(f"DROP TRIGGER IF EXISTS {table}_{new}_sync ON {table}")
+        await conn.execute(f"DROP FUNCTION IF EXISTS {table}_{new}_sync()")
+        await conn.execute(f"ALTER TABLE {table} ALTER COLUMN {new} SET NOT NULL")
+        await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_{new}_filled")
+        await conn.execute(f"ALTER TABLE {table} DROP COLUMN {old}")
+        if new != final:
+            await conn.execute(f"ALTER TABLE {table} RENAME COLUMN {new} TO {final}")
+
+
+async def migrate_compact_types(conn, batch: int = BACKFILL_BATCH, keep_legacy: bool = False):
+    """Convert legacy FLOAT columns online; a no-op once every table is converted.
+
+    Also widens columns converted before amount_cents became BIGINT. Every
+    step can be rerun, so an interrupted migration picks up where it stopped.
+    With `keep_legacy` the old columns stay, kept in step by the trigger, for
+    app instances that still read them; a later run drops them.
+    """
+    for table in COMPACT_COLUMNS:
+        for old, new, type_, to_new, to_old, final in await pending_conversions(conn, table):
+            logger.warning(f"Converting {table}.{old} to {final} ({type_})")
+            await add_column(conn, table, old, new, type_, to_new, to_old)
+            await backfill(conn, table, old, new, to_new, batch)
+            await mark_filled(conn, table, new)
+            if keep_legacy:
+                logger.info(f"Filled {table}.{new}; {table}.{old} is kept in step until the next run")
+                continue
+            await swap_columns(conn, table, old, new, final)
+            logger.info(f"Converted {table}.{old} to {final}")
+
+
+async def bench(conn, rows: int, runs: int = 5):
+    """Compare table and index size, aggregate speed and SUM accuracy of the layouts."""
+    users = 100
+    string_keys = (
+        "'expense_' || substr(md5(i::text), 1, 12)",
+        f"'user_' || substr(md5((i % {users})::text), 1, 12)",
+    )
+    uuid_keys = ("md5(i::text)::uuid", f"md5((i % {users})::text)::uuid")
+    float_values = "(i % 9973) / 100.0, (i % 5000) / 10.0"
+    integer_values = f"i % 9973, round((i % 5000) / 10.0 * {METERS_PER_MILE})"
+    float_sums = "SUM(amount), SUM(distance)"
+    integer_sums = f"SUM(amount_cents) / 100.0, SUM(distance_m) / {METERS_PER_MILE}"
+    # name -> (key columns, value columns, key values, values, sums)
+    layouts = {
+        "float": ("id VARCHAR(255) NOT NULL, user_id VARCHAR(255) NOT NULL",
+                  "amount FLOAT NOT NULL, distance FLOAT NOT NULL",
+                  string_keys, float_values, float_sums),
+        "integer": ("id VARCHAR(255) NOT NULL, user_id VARCHAR(255) NOT NULL",
+                    "amount_cents BIGINT NOT NULL, distance_m INTEGER NOT NULL",
+                    string_keys, integer_values, integer_sums),
+        "uuid": ("id UUID NOT NULL, user_id UUID NOT NULL",
+                 "amount_cents BIGINT NOT NULL, distance_m INTEGER NOT NULL",
+                 uuid_keys, integer_values, integer_sums),
+    }
+
+    async def timed(query, *args):
+        await conn.fetch(query, *args)
+        started = time.perf_counter()
+        for _ in range(runs):
+            result = await conn.fetchrow(query, *args)
+        return (time.perf_counter() - started) / runs * 1000, result
+
+    for name, (keys, columns, key_values, values, sums) in layouts.items():
+        # Same shape as the expenses/trips rows around the measured columns
+        await conn.execute(f"""
+            CREATE TEMP TABLE bench_{name} (
+                {keys},
+                {columns},
+                created_at TIMESTAMP WITH TIME ZONE NOT NULL
+            )
+        """)
+        await conn.execute(f"""
+            INSERT INTO bench_{name}
+            SELECT {key_values[0]}, {key_values[1]}, {values}, NOW() - (i % 17520) * INTERVAL '1 hour'
+            FROM generate_series(1, {rows}) AS i
+        """)
+        # The external id and (user_id, time) indexes every table has
+        await conn.execute(f"CREATE UNIQUE INDEX ON bench_{name} (id)")
+        await conn.execute(f"CREATE INDEX ON bench_{name} (user_id, created_at)")
+        await conn.execute(f"VACUUM ANALYZE bench_{name}")
+
+        size = await conn.fetchrow(
+            f"""SELECT pg_size_pretty(pg_table_size('bench_{name}')) AS heap,
+                       pg_size_pretty(pg_indexes_size('bench_{name}')) AS indexes"""
+        )
+        user_id = await conn.fetchval(f"SELECT user_id FROM bench_{name} LIMIT 1")
+        user_ms, _ = await timed(f"SELECT {sums} FROM bench_{name} WHERE user_id = $1", user_id)
+        monthly_ms, _ = await timed(f"SELECT date_trunc('month', created_at), {sums} FROM bench_{name} GROUP BY 1")
+        total_ms, total = await timed(f"SELECT {sums} FROM bench_{name}")
+        print(f"{name:>8}: table {size['heap']:>8}, indexes {size['indexes']:>8}, "
+              f"SUM per user {user_ms:6.1f} ms, by month {monthly_ms:6.1f} ms, all {total_ms:6.1f} ms, "
+              f"amount total {total[0]}")
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Integer cents/meters storage")
+    sub = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = sub.add_parser("migrate", help="convert FLOAT amount/distance columns online")
+    migrate_parser.add_argument("--batch", type=int, default=BACKFILL_BATCH, help="rows per backfill transaction")
+    migrate_parser.add_argument("--keep-legacy", action="store_true",
+                                help="fill the integer columns but keep the FLOAT ones in step")
+    bench_parser = sub.add_parser("bench", help="compare FLOAT, integer and UUID-key layouts on temp tables")
+    bench_parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / '.env')
+
+    async with cli_router() as router:
+        if args.command == "migrate":
+            for name, pool in router.pools.items():
+                logger.info(f"Shard {name}")
+                async with pool.acquire() as conn:
+                    await migrate_compact_types(conn, args.batch, args.keep_legacy)
+        elif args.command == "bench":
+            # Temp tables only, so any database will do
+            async with router.primary.acquire() as conn:
+                await bench(conn, args.rows)
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,250 @@
+"""Negotiated response compression.
+
+Responses of at least MINIMUM_SIZE bytes with a compressible content type are
+encoded with the best coding the client accepts: zstd, br, then gzip on equal
+q-values. zstd and br need the optional `zstandard` and `brotli` packages and
+are simply not offered without them. Streamed bodies (CSV exports) are
+compressed chunk by chunk and flushed after each chunk, so the client receives
+data before the body is complete.
+
+Usage:
+    python compression.py bench --rows 100   # bytes and CPU per coding and JSON shape
+"""
+import argparse
+import json
+import os
+import random
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+from starlette.datastructures import Headers, MutableHeaders
+
+import metrics
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MINIMUM_SIZE = int(os.getenv("COMPRESSION_MINIMUM_SIZE", "1024"))
+
+# Mid-range levels: most of the size win for a fraction of the CPU of the maximum
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+ZSTD_LEVEL = 3
+
+COMPRESSIBLE_TYPES = ("application/json", "text/")
+
+compressed_responses = metrics.counter("compressed_responses_total", "Responses sent with a Content-Encoding")
+bytes_in = metrics.counter("compression_bytes_in_total", "Response bytes before compression")
+bytes_out = metrics.counter("compression_bytes_out_total", "Response bytes after compression")
+
+
+class GzipEncoder:
+    def __init__(self):
+        self.compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def encode(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+
+class BrotliEncoder:
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def encode(self, data: bytes, final: bool) -> bytes:
+        return self.compressor.process(data) + (self.compressor.finish() if final else self.compressor.flush())
+
+
+class ZstdEncoder:
+    def __init__(self):
+        self.compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def encode(self, data: bytes, final: bool) -> bytes:
+        mode = zstandard.COMPRESSOBJ_FLUSH_FINISH if final else zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        return self.compressor.compress(data) + self.compressor.flush(mode)
+
+
+# Server preference order among the codings this install can produce
+ENCODERS = {}
+if zstandard is not None:
+    ENCODERS["zstd"] = ZstdEncoder
+if brotli is not None:
+    ENCODERS["br"] = BrotliEncoder
+ENCODERS["gzip"] = GzipEncoder
+
+
+def negotiate(accept_encoding: str):
+    """Pick the coding with the highest q-value, ties going to server preference."""
+    weights = {}
+    for item in accept_encoding.split(","):
+        coding, _, params = item.partition(";")
+        q = 1.0
+        for param in params.split(";"):
+            name, _, value = param.strip().partition("=")
+            if name.lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        weights[coding.strip().lower()] = q
+
+    best, best_q = None, 0.0
+    for coding in ENCODERS:
+        q = weights.get(coding, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = coding, q
+    return best
+
+
+def is_compressible(headers) -> bool:
+    if "content-encoding" in headers:
+        return False
+    return headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES)
+
+
+class CompressionMiddleware:
+    def __init__(self, app, minimum_size: int = MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        coding = negotiate(Headers(scope=scope).get("accept-encoding", ""))
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+        pending = []
+        encoder = None
+
+        async def send_wrapper(message):
+            nonlocal start, encoder
+            if message["type"] == "http.response.start":
+                # Held back until enough of the body is seen to decide on compression
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+
+            body = message.get("body", b"")
+            more_body = message.get("more_body", False)
+            if start is None:
+                if encoder is not None:
+                    message = {**message, "body": self._encode(encoder, body, not more_body)}
+                    if not more_body:
+                        encoder = None
+                await send(message)
+                return
+
+            headers = MutableHeaders(raw=start["headers"])
+            if not is_compressible(headers):
+                await send(start)
+                start = None
+                await send(message)
+                return
+
+            pending.append(body)
+            size = sum(map(len, pending))
+            if more_body and size < self.minimum_size:
+                return
+            body = b"".join(pending)
+            pending.clear()
+            headers.add_vary_header("Accept-Encoding")
+            if size >= self.minimum_size:
+                # Wrapping middleware may re-chunk a body whose length is already declared
+                final = not more_body or headers.get("content-length") == str(size)
+                encoder = ENCODERS[coding]()
+                body = self._encode(encoder, body, final)
+                headers["Content-Encoding"] = coding
+                if final:
+                    headers["Content-Length"] = str(len(body))
+                    encoder = None
+                else:
+                    # Streamed: sent chunked as each piece is compressed
+                    del headers["Content-Length"]
+                compressed_responses.inc()
+            await send(start)
+            start = None
+            await send({**message, "body": body})
+
+        await self.app(scope, receive, send_wrapper)
+
+    @staticmethod
+    def _encode(encoder, body: bytes, final: bool) -> bytes:
+        encoded = encoder.encode(body, final)
+        bytes_in.inc(len(body))
+        bytes_out.inc(len(encoded))
+        return encoded
+
+
+def sample_trips(rows: int) -> list:
+    """A page of trips as GET /trips serializes them."""
+    rng = random.Random(42)
+    started = datetime(2026, 1, 5, 7, 30, tzinfo=timezone.utc)
+    trips = []
+    for i in range(rows):
+        start = started + timedelta(hours=i * 9, minutes=rng.randrange(60), seconds=rng.randrange(60))
+        trips.append({
+            "trip_id": f"trip_{rng.getrandbits(48):012x}",
+            "user_id": "user_3f9a2c71b0d4",
+            "vehicle_id": "vehicle_8d21e4c0a9f3",
+            "start_time": start.isoformat().replace("+00:00", "Z"),
+            "end_time": (start + timedelta(minutes=rng.randrange(5, 90))).isoformat().replace("+00:00", "Z"),
+            "distance": round(rng.uniform(0.5, 60), 3),
+            "start_location": rng.choice(["Home", "Office", "123 Main St", None]),
+            "end_location": rng.choice(["Client site", "Warehouse", "Office", None]),
+            "purpose": rng.choice(["Client meeting", "Site visit", "Supplies", None]),
+            "is_business": rng.random() < 0.8,
+            "is_automatic": rng.random() < 0.5,
+            "created_at": start.isoformat().replace("+00:00", "Z"),
+        })
+    return trips
+
+
+def bench(rows: int, runs: int = 200):
+    trips = sample_trips(rows)
+    columns = list(trips[0])
+    shapes = {
+        "objects": trips,
+        "columns": {"columns": columns, "rows": [[trip[c] for c in columns] for trip in trips]},
+    }
+    for shape, content in shapes.items():
+        # Same encoding as starlette's JSONResponse
+        body = json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":")).encode()
+        print(f"{shape:>8} identity: {len(body):>7} bytes")
+        for coding, encoder_class in ENCODERS.items():
+            started = time.process_time()
+            for _ in range(runs):
+                encoded = encoder_class().encode(body, True)
+            cpu = (time.process_time() - started) / runs * 1_000_000
+            print(f"{shape:>8} {coding:>8}: {len(encoded):>7} bytes, {cpu:8.1f} us CPU")
+    missing = [name for name, module in (("zstd", zstandard), ("br", brotli)) if module is None]
+    if missing:
+        print(f"not installed: {', '.join(missing)}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Response compression")
+    sub = parser.add_subparsers(dest="command", required=True)
+    bench_parser = sub.add_parser("bench", help="compare codings and JSON shapes on a page of trips")
+    bench_parser.add_argument("--rows", type=int, default=100)
+    args = parser.parse_args(argv)
+
+    if args.command == "bench":
+        bench(args.rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Liveness and readiness probes.
+
+/api/health/live only answers whether the worker's event loop serves requests;
+restarting an instance whose database is down would not help, so it never
+looks at the database. /api/health/ready answers whether the instance should
+get traffic: warm-up finished, every shard pool answers a ping and its schema
+is at least `SCHEMA_VERSION`.
+
+Probes never query the database themselves. A background loop pings each
+pool every `PING_INTERVAL` seconds and probes read the cached result; a result
+older than `PING_STALE_SECONDS` counts as failed. On shutdown readiness turns
+to draining before the pools are closed.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Bump with every change to create_schema
+SCHEMA_VERSION = 1
+
+PING_INTERVAL = float(os.getenv("HEALTH_PING_INTERVAL_SECONDS", "5"))
+PING_TIMEOUT = float(os.getenv("HEALTH_PING_TIMEOUT_SECONDS", "2"))
+PING_STALE_SECONDS = 3 * PING_INTERVAL
+# Shutdown waits this long for in-use connections before terminating them
+POOL_CLOSE_TIMEOUT = float(os.getenv("POOL_CLOSE_TIMEOUT_SECONDS", "10"))
+
+ping_failures = metrics.counter("health_ping_failures_total", "Database pings that failed or timed out")
+ready_gauge = metrics.gauge("health_ready", "1 while readiness reports ready")
+
+
+async def install_schema_version(conn):
+    """Record that the schema is at SCHEMA_VERSION; run last in create_schema."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    await conn.execute(
+        "INSERT INTO schema_version (version) VALUES ($1) ON CONFLICT DO NOTHING", SCHEMA_VERSION
+    )
+
+
+async def read_schema_version(pool) -> int:
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def close_pool(pool, timeout: float = POOL_CLOSE_TIMEOUT):
+    """Close once connections in use are released, terminating them after `timeout`."""
+    try:
+        await asyncio.wait_for(pool.close(), timeout)
+    except asyncio.TimeoutError:
+        logger.warning(f"Connections still in use after {timeout:g}s, terminating them")
+        pool.terminate()
+
+
+def pool_state(pool) -> dict:
+    return {"size": pool.get_size(), "idle": pool.get_idle_size(), "max": pool.get_max_size()}
+
+
+class HealthMonitor:
+    def __init__(self):
+        # Shard name -> result of its last ping
+        self.pings = {}
+        self.draining = False
+
+    async def ping(self, name: str, pool):
+        started = time.monotonic()
+        try:
+            version = await asyncio.wait_for(read_schema_version(pool), PING_TIMEOUT)
+            self.pings[name] = {"ok": True, "checked": started, "schema_version": version,
+                                "latency_ms": round((time.monotonic() - started) * 1000, 1)}
+        except Exception as e:
+            ping_failures.inc()
+            if self.pings.get(name, {}).get("ok", True):
+                logger.warning(f"Database ping to shard {name} failed: {type(e).__name__}: {e}")
+            self.pings[name] = {"ok": False, "checked": started, "error": f"{type(e).__name__}: {e}"}
+
+    async def check(self, pools: dict):
+        await asyncio.gather(*(self.ping(name, pool) for name, pool in pools.items()))
+        for name in set(self.pings) - set(pools):
+            del self.pings[name]
+
+    async def run(self, get_pools, interval: float = PING_INTERVAL):
+        """Background loop refreshing the cached pings."""
+        while True:
+            await self.check(get_pools())
+            await asyncio.sleep(interval)
+
+    def shard_status(self, name: str, pool, now: float) -> tuple:
+        ping = self.pings.get(name)
+        if ping is None:
+            return False, {"ok": False, "error": "Not checked yet", "pool": pool_state(pool)}
+        age = now - ping["checked"]
+        status = {key: value for key, value in ping.items() if key != "checked"}
+        status["age_seconds"] = round(age, 1)
+        status["pool"] = pool_state(pool)
+        if ping["ok"] and age > PING_STALE_SECONDS:
+            status.update(ok=False, error="Last ping is stale")
+        elif ping["ok"] and ping["schema_version"] < SCHEMA_VERSION:
+            status.update(ok=False, error=f"Schema is behind version {SCHEMA_VERSION}")
+        return status["ok"], status
+
+    def readiness(self, started: bool, pools: dict) -> tuple:
+        """Whether to route traffic here, with the details behind the answer."""
+        if self.draining:
+            body = {"status": "draining"}
+        elif not started:
+            body = {"status": "starting"}
+        else:
+            now = time.monotonic()
+            shards = {name: self.shard_status(name, pool, now) for name, pool in pools.items()}
+            ok = all(shard_ok for shard_ok, _ in shards.values())
+            body = {
+                "status": "ready" if ok else "unavailable",
+                "schema_version": SCHEMA_VERSION,
+                "shards": {name: status for name, (_, status) in shards.items()},
+            }
+        ready = body["status"] == "ready"
+        ready_gauge.set(int(ready))
+        return ready, body
+
+
+health_monitor = HealthMonitor()
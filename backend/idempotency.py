@@ -0,0 +1,222 @@
+"""Idempotency-Key support for POST/PUT requests.
+
+The first request with a key claims it and records its response; retries with
+the same key and payload get the recorded response without re-running the
+write. A key is claimed with one INSERT, so two racing retries can never both
+run the handler; the loser reads the winner's row afterwards.
+
+Keys live on the primary while the handler writes to the user's shard, so the
+response cannot be recorded in the handler's transaction. A claim instead
+holds a short lease: a request that fails or is cancelled releases its key,
+and one whose worker died leaves a claim that expires after
+IDEMPOTENCY_LEASE_SECONDS rather than blocking retries for the whole TTL.
+
+Keys are scoped to the user, so a retry after signing in again still replays.
+Requests without a valid session, and all requests on the memory storage
+backend, are passed through without a key.
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import zlib
+from datetime import datetime, timezone, timedelta
+
+import anyio
+from fastapi import HTTPException
+from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.responses import JSONResponse, Response
+
+logger = logging.getLogger(__name__)
+
+IDEMPOTENCY_TTL = timedelta(hours=int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24")))
+# A claim without a recorded response can be taken over after this long
+IDEMPOTENCY_LEASE = timedelta(seconds=int(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "120")))
+IDEMPOTENT_METHODS = {"POST", "PUT"}
+MAX_KEY_LENGTH = 255
+CLEANUP_BATCH_SIZE = 1000
+
+
+async def install_idempotency_keys(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope BYTEA NOT NULL,
+            idem_key VARCHAR(255) NOT NULL,
+            request_hash BYTEA NOT NULL,
+            status_code SMALLINT,
+            content_type VARCHAR(100),
+            response_body BYTEA,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            locked_until TIMESTAMP WITH TIME ZONE,
+            PRIMARY KEY (scope, idem_key)
+        )
+    ''')
+    await conn.execute("ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS locked_until TIMESTAMP WITH TIME ZONE")
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires_at ON idempotency_keys (expires_at)"
+    )
+
+
+def _digest(*parts: bytes) -> bytes:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part)
+        h.update(b"\0")
+    return h.digest()[:16]
+
+
+def _session_token(request) -> str:
+    token = request.cookies.get("session_token")
+    if not token:
+        auth_header = request.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            token = auth_header.replace("Bearer ", "")
+    return token or ""
+
+
+async def _claim(conn, scope: bytes, key: str, request_hash: bytes):
+    """None once the key is claimed for this request, else the row holding it."""
+    for _ in range(3):
+        now = datetime.now(timezone.utc)
+        # Expired keys, and claims whose request never finished, are taken over
+        claimed = await conn.fetchval(
+            """INSERT INTO idempotency_keys (scope, idem_key, request_hash, expires_at, locked_until)
+               VALUES ($1, $2, $3, $4, $5)
+               ON CONFLICT (scope, idem_key) DO UPDATE
+               SET request_hash = EXCLUDED.request_hash, status_code = NULL, content_type = NULL,
+                   response_body = NULL, expires_at = EXCLUDED.expires_at, locked_until = EXCLUDED.locked_until
+               WHERE idempotency_keys.expires_at < NOW()
+                  OR (idempotency_keys.status_code IS NULL AND idempotency_keys.locked_until < NOW())
+               RETURNING 1""",
+            scope, key, request_hash, now + IDEMPOTENCY_TTL, now + IDEMPOTENCY_LEASE
+        )
+        if claimed:
+            return None
+        # A separate statement, so it sees the winner that the INSERT waited for
+        row = await conn.fetchrow(
+            """SELECT request_hash, status_code, content_type, response_body
+               FROM idempotency_keys WHERE scope = $1 AND idem_key = $2""",
+            scope, key
+        )
+        if row is not None:
+            return row
+        # The winner failed and released the key in between; claim again
+    return {"request_hash": request_hash, "status_code": None}
+
+
+class IdempotencyMiddleware(BaseHTTPMiddleware):
+    def __init__(self, app, get_pool, get_user_id):
+        super().__init__(app)
+        self.get_pool = get_pool
+        # async (session token) -> user_id, or None for an invalid session
+        self.get_user_id = get_user_id
+
+    async def dispatch(self, request, call_next):
+        key = request.headers.get("Idempotency-Key")
+        if not key or request.method not in IDEMPOTENT_METHODS:
+            return await call_next(request)
+        if len(key) > MAX_KEY_LENGTH:
+            return JSONResponse({"detail": "Idempotency-Key too long"}, status_code=400)
+
+        # Keys are scoped to the user so they cannot collide across users;
+        # anonymous callers have nothing to scope them to
+        token = _session_token(request)
+        if not token:
+            return await call_next(request)
+
+        try:
+            pool = await self.get_pool()
+        except HTTPException as e:
+            if e.status_code == 501:
+                # No database to record keys in (memory storage backend)
+                return await call_next(request)
+            # Raised outside the routes, so no exception handler would turn it into a response
+            return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+
+        user_id = await self.get_user_id(token)
+        if user_id is None:
+            # The route rejects the request
+            return await call_next(request)
+
+        scope = _digest(user_id.encode())
+        body = await request.body()
+        request_hash = _digest(
+            request.method.encode(), request.url.path.encode(), request.url.query.encode(), body
+        )
+
+        async with pool.acquire() as conn:
+            row = await _claim(conn, scope, key, request_hash)
+
+        if row is not None:
+            if row['request_hash'] != request_hash:
+                return JSONResponse(
+                    {"detail": "Idempotency-Key was already used with a different request"},
+                    status_code=422
+                )
+            if row['status_code'] is None:
+                return JSONResponse(
+                    {"detail": "A request with this Idempotency-Key is still in progress"},
+                    status_code=409
+                )
+            return Response(
+                content=zlib.decompress(row['response_body']),
+                status_code=row['status_code'],
+                media_type=row['content_type'],
+                headers={"Idempotent-Replayed": "true"}
+            )
+
+        try:
+            response = await call_next(request)
+            content = b"".join([chunk async for chunk in response.body_iterator])
+        except BaseException:
+            # Also on cancellation (a client disconnect), which would otherwise cancel the release too
+            with anyio.CancelScope(shield=True):
+                await self._release(scope, key)
+            raise
+
+        if response.status_code >= 500:
+            # Server errors are not final; let the client retry with the same key
+            await self._release(scope, key)
+        else:
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    """UPDATE idempotency_keys SET status_code = $3, content_type = $4, response_body = $5
+                       WHERE scope = $1 AND idem_key = $2""",
+                    scope, key, response.status_code, response.headers.get("content-type"),
+                    zlib.compress(content)
+                )
+
+        buffered = Response(content=content, status_code=response.status_code)
+        buffered.raw_headers = response.raw_headers
+        return buffered
+
+    async def _release(self, scope: bytes, key: str):
+        try:
+            pool = await self.get_pool()
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "DELETE FROM idempotency_keys WHERE scope = $1 AND idem_key = $2 AND status_code IS NULL",
+                    scope, key
+                )
+        except Exception as e:
+            # The claim's lease expires on its own
+            logger.error(f"Releasing Idempotency-Key failed: {e}")
+
+
+async def expire_idempotency_keys(pool, interval: float = 60 * 60):
+    """Background loop deleting expired keys in small batches."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with pool.acquire() as conn:
+                while True:
+                    result = await conn.execute(
+                        """DELETE FROM idempotency_keys WHERE ctid IN (
+                               SELECT ctid FROM idempotency_keys WHERE expires_at < NOW() LIMIT $1
+                           )""",
+                        CLEANUP_BATCH_SIZE
+                    )
+                    if int(result.split()[-1]) < CLEANUP_BATCH_SIZE:
+                        break
+        except Exception as e:
+            logger.error(f"Idempotency key cleanup failed: {e}")
@@ -0,0 +1,260 @@
+"""In-process background job runner backed by the `jobs` table.
+
+Workers claim queued jobs with SELECT ... FOR UPDATE SKIP LOCKED, so several
+app instances can share one queue without double-running a job. A claimed job
+holds a lease, which its worker extends while the handler runs; if the worker
+dies the lease expires and another worker picks it up. Failed jobs are retried
+with exponential backoff up to `max_attempts`, and a job whose last attempt
+lost its lease fails. A worker that lost its lease never writes the outcome
+over the attempt that reclaimed the job. CPU-heavy steps run in a process pool
+through `run_cpu` so they never block the event loop. Params are validated per
+kind when a job is submitted, so bad input is rejected up front instead of
+failing every attempt.
+"""
+import asyncio
+import json
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))
+JOB_PROCESSES = int(os.getenv("JOB_PROCESSES", "2"))
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL_SECONDS", "2"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "300"))
+# Running jobs extend their lease this often, so only a dead worker's lease expires
+JOB_HEARTBEAT_SECONDS = JOB_LEASE_SECONDS / 3
+JOB_MAX_ATTEMPTS = 3
+JOB_RETRY_BASE_SECONDS = 5
+
+# kind -> async handler(pool, user_id, params) returning (body bytes, content type)
+JOB_HANDLERS = {}
+# kind -> validate(params) returning the params to store, raising ValueError when invalid
+JOB_VALIDATORS = {}
+
+_process_pool = None
+
+
+def no_params(params: dict) -> dict:
+    if params:
+        raise ValueError(f"takes no params, got {', '.join(sorted(params))}")
+    return {}
+
+
+def job_handler(kind: str, validate=no_params):
+    def register(func):
+        JOB_HANDLERS[kind] = func
+        JOB_VALIDATORS[kind] = validate
+        return func
+    return register
+
+
+def validate_params(kind: str, params: dict) -> dict:
+    """Params as the handler of `kind` will get them; ValueError if it would reject them."""
+    if kind not in JOB_HANDLERS:
+        raise ValueError(f"Unknown job kind: {kind}")
+    try:
+        return JOB_VALIDATORS[kind](params)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid params for {kind}: {e!s}")
+
+
+async def run_cpu(func, *args):
+    """Run a picklable function in the shared worker process pool."""
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=JOB_PROCESSES)
+    return await asyncio.get_running_loop().run_in_executor(_process_pool, func, *args)
+
+
+def json_result(data):
+    return json.dumps(data, default=str).encode(), "application/json"
+
+
+async def install_jobs(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id SERIAL PRIMARY KEY,
+            job_id VARCHAR(255) UNIQUE NOT NULL,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            kind VARCHAR(50) NOT NULL,
+            params JSONB NOT NULL DEFAULT '{}',
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            max_attempts INTEGER NOT NULL DEFAULT 3,
+            run_after TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            locked_until TIMESTAMP WITH TIME ZONE,
+            result BYTEA,
+            content_type VARCHAR(100),
+            error TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    await conn.execute(
+        "CREATE INDEX IF NOT EXISTS idx_jobs_runnable ON jobs (run_after) WHERE status IN ('queued', 'running')"
+    )
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_user ON jobs (user_id, created_at)")
+
+
+async def enqueue_job(conn, user_id: str, kind: str, params: dict):
+    return await conn.fetchrow(
+        """INSERT INTO jobs (job_id, user_id, kind, params, max_attempts)
+           VALUES ($1, $2, $3, $4::jsonb, $5)
+           RETURNING job_id, kind, status, attempts, error, created_at, updated_at""",
+        f"job_{uuid.uuid4().hex[:12]}", user_id, kind, json.dumps(params), JOB_MAX_ATTEMPTS
+    )
+
+
+async def get_job(conn, job_id: str, user_id: str):
+    return await conn.fetchrow(
+        """SELECT job_id, kind, status, attempts, error, created_at, updated_at
+           FROM jobs WHERE job_id = $1 AND user_id = $2""",
+        job_id, user_id
+    )
+
+
+async def get_job_result(conn, job_id: str, user_id: str):
+    return await conn.fetchrow(
+        "SELECT status, result, content_type FROM jobs WHERE job_id = $1 AND user_id = $2",
+        job_id, user_id
+    )
+
+
+class JobRunner:
+    def __init__(self, concurrency: int = JOB_CONCURRENCY):
+        self.concurrency = concurrency
+        self.running = set()
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.pool_for = None
+
+    def start(self, pool, pool_for):
+        """Claim jobs from `pool` (the primary); handlers get `pool_for(user_id)`, the user's shard."""
+        self.pool_for = pool_for
+        self.task = asyncio.create_task(self.run(pool))
+
+    def notify(self):
+        self.wakeup.set()
+
+    def finished(self, task):
+        # A slot is free again; claim the next job without waiting for the poll
+        self.running.discard(task)
+        self.notify()
+
+    async def stop(self):
+        global _process_pool
+        if self.task:
+            self.task.cancel()
+        for task in list(self.running):
+            task.cancel()
+        if _process_pool is not None:
+            _process_pool.shutdown(wait=False, cancel_futures=True)
+            _process_pool = None
+
+    async def run(self, pool):
+        while True:
+            free = self.concurrency - len(self.running)
+            if free > 0:
+                try:
+                    async with pool.acquire() as conn:
+                        claimed = await self.claim(conn, free)
+                    for job in claimed:
+                        task = asyncio.create_task(self.execute(pool, job))
+                        self.running.add(task)
+                        task.add_done_callback(self.finished)
+                except Exception as e:
+                    logger.error(f"Job claim failed: {e}")
+
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), JOB_POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+
+    async def claim(self, conn, limit: int):
+        # A job that lost the lease of its last attempt (its worker died or hung) is not run again
+        await conn.execute(
+            """UPDATE jobs SET status = 'failed', error = 'Lease expired on the last attempt',
+                      locked_until = NULL, updated_at = NOW()
+               WHERE status = 'running' AND locked_until < NOW() AND attempts >= max_attempts"""
+        )
+        # Expired leases of running jobs are reclaimed as well
+        return await conn.fetch(
+            """UPDATE jobs SET status = 'running', attempts = attempts + 1,
+                      locked_until = NOW() + make_interval(secs => $2), updated_at = NOW()
+               WHERE id IN (
+                   SELECT id FROM jobs
+                   WHERE run_after <= NOW()
+                     AND (status = 'queued' OR (status = 'running' AND locked_until < NOW() AND attempts < max_attempts))
+                   ORDER BY run_after
+                   LIMIT $1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING id, job_id, user_id, kind, params, attempts, max_attempts""",
+            limit, float(JOB_LEASE_SECONDS)
+        )
+
+    async def heartbeat(self, pool, job):
+        """Extend the job's lease until cancelled; stops once another worker has reclaimed it."""
+        while True:
+            await asyncio.sleep(JOB_HEARTBEAT_SECONDS)
+            try:
+                async with pool.acquire() as conn:
+                    renewed = await conn.fetchval(
+                        """UPDATE jobs SET locked_until = NOW() + make_interval(secs => $3), updated_at = NOW()
+                           WHERE id = $1 AND attempts = $2 AND status = 'running'
+                           RETURNING 1""",
+                        job['id'], job['attempts'], float(JOB_LEASE_SECONDS)
+                    )
+            except Exception as e:
+                logger.warning(f"Lease renewal of job {job['job_id']} failed: {e}")
+                continue
+            if not renewed:
+                logger.warning(f"Job {job['job_id']} lost its lease")
+                return
+
+    async def execute(self, pool, job):
+        heartbeat = asyncio.create_task(self.heartbeat(pool, job))
+        try:
+            handler = JOB_HANDLERS[job['kind']]
+            data_pool = await self.pool_for(job['user_id'])
+            body, content_type = await handler(data_pool, job['user_id'], json.loads(job['params']))
+        except asyncio.CancelledError:
+            heartbeat.cancel()
+            raise
+        except Exception as e:
+            heartbeat.cancel()
+            logger.error(f"Job {job['job_id']} ({job['kind']}) attempt {job['attempts']} failed: {e}")
+            retry = job['attempts'] < job['max_attempts'] and job['kind'] in JOB_HANDLERS
+            async with pool.acquire() as conn:
+                result = await conn.execute(
+                    """UPDATE jobs SET status = $3, error = $4, locked_until = NULL, updated_at = NOW(),
+                              run_after = NOW() + make_interval(secs => $5)
+                       WHERE id = $1 AND attempts = $2 AND status = 'running'""",
+                    job['id'], job['attempts'], 'queued' if retry else 'failed', str(e),
+                    float(JOB_RETRY_BASE_SECONDS * 2 ** (job['attempts'] - 1))
+                )
+            self.check_owned(job, result)
+            return
+        heartbeat.cancel()
+
+        async with pool.acquire() as conn:
+            result = await conn.execute(
+                """UPDATE jobs SET status = 'succeeded', result = $3, content_type = $4, error = NULL,
+                          locked_until = NULL, updated_at = NOW()
+                   WHERE id = $1 AND attempts = $2 AND status = 'running'""",
+                job['id'], job['attempts'], body, content_type
+            )
+        self.check_owned(job, result)
+
+    @staticmethod
+    def check_owned(job, result: str):
+        # The outcome belongs to the attempt that reclaimed the job, not to this one
+        if result.split()[-1] == "0":
+            logger.warning(f"Job {job['job_id']} attempt {job['attempts']} lost its lease; outcome discarded")
+
+
+job_runner = JobRunner()
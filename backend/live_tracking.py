@@ -0,0 +1,131 @@
+"""In-memory accumulation of live GPS streams with batched trip writes.
+
+Each open trip keeps its running distance and last fix in memory. Fixes never
+touch the database; a background loop writes every changed trip's distance in
+one UPDATE per interval, and a trip is written immediately when it ends or its
+last stream disconnects.
+"""
+import asyncio
+import logging
+import math
+import os
+
+import repository
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_MILES = 3958.8
+
+# Seconds between batched distance writes
+FLUSH_INTERVAL = float(os.getenv("LIVE_TRIP_FLUSH_SECONDS", "15"))
+
+# Largest batch of fixes accepted in one message
+MAX_FIXES_PER_MESSAGE = 200
+
+# Jumps implying a faster speed are treated as GPS noise
+MAX_SPEED_MPH = 150
+
+
+def haversine_miles(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    phi1, phi2 = math.radians(lat1), math.radians(lat2)
+    dphi = phi2 - phi1
+    dlmb = math.radians(lng2 - lng1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlmb / 2) ** 2
+    return 2 * EARTH_RADIUS_MILES * math.asin(math.sqrt(a))
+
+
+class LiveTrip:
+    __slots__ = ("trip_id", "user_id", "distance", "last_fix", "dirty", "streams")
+
+    def __init__(self, trip_id: str, user_id: str, distance: float):
+        self.trip_id = trip_id
+        self.user_id = user_id
+        self.distance = distance
+        self.last_fix = None
+        self.dirty = False
+        self.streams = 0
+
+    def add_fix(self, lat: float, lng: float, ts: float):
+        if self.last_fix is not None:
+            last_lat, last_lng, last_ts = self.last_fix
+            if ts <= last_ts:
+                return
+            miles = haversine_miles(last_lat, last_lng, lat, lng)
+            if miles / ((ts - last_ts) / 3600) > MAX_SPEED_MPH:
+                return
+            self.distance += miles
+            self.dirty = True
+        self.last_fix = (lat, lng, ts)
+
+
+class LiveTripTracker:
+    def __init__(self):
+        self.trips = {}
+
+    def attach(self, trip_id: str, user_id: str, distance: float) -> LiveTrip:
+        trip = self.trips.get(trip_id)
+        if trip is None:
+            trip = self.trips[trip_id] = LiveTrip(trip_id, user_id, distance)
+        trip.streams += 1
+        return trip
+
+    async def detach(self, pool, trip: LiveTrip):
+        trip.streams -= 1
+        if trip.streams <= 0 and self.trips.get(trip.trip_id) is trip:
+            del self.trips[trip.trip_id]
+            await self.write(pool, [trip])
+
+    async def finish(self, pool, trip: LiveTrip, end_time, end_location=None):
+        """Write the final distance and end of the trip, returning the row."""
+        self.trips.pop(trip.trip_id, None)
+        trip.dirty = False
+        async with pool.acquire() as conn:
+            return await repository.finish_trip(
+                conn, trip.trip_id, trip.user_id, trip.distance, end_time, end_location
+            )
+
+    async def write(self, pool, trips):
+        dirty = [t for t in trips if t.dirty]
+        if not dirty:
+            return
+        # Cleared before the await so fixes arriving meanwhile re-mark the trip
+        for t in dirty:
+            t.dirty = False
+        try:
+            async with pool.acquire() as conn:
+                await repository.update_trip_distances(
+                    conn,
+                    [t.trip_id for t in dirty],
+                    [t.user_id for t in dirty],
+                    [t.distance for t in dirty]
+                )
+        except Exception:
+            for t in dirty:
+                t.dirty = True
+            raise
+
+    async def write_all(self, pool_for):
+        """Write every open trip, one batch per database; `pool_for` maps user_id to its pool."""
+        by_pool = {}
+        for trip in list(self.trips.values()):
+            try:
+                pool = await pool_for(trip.user_id)
+            except Exception as e:
+                # Stays dirty and is written by a later flush
+                logger.warning(f"No database for live trip {trip.trip_id}: {e}")
+                continue
+            by_pool.setdefault(pool, []).append(trip)
+        for pool, trips in by_pool.items():
+            await self.write(pool, trips)
+
+    async def run(self, pool_for, interval: float = FLUSH_INTERVAL):
+        """Background loop writing running distances in one batch per interval."""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.write_all(pool_for)
+            except Exception as e:
+                logger.error(f"Live trip flush failed: {e}")
+
+
+live_trips = LiveTripTracker()
@@ -0,0 +1,212 @@
+"""Backpressure for bursts that exceed what the connection pool can serve.
+
+Each worker admits a bounded number of concurrent HTTP requests. Excess
+requests wait in a bounded priority queue: auth and writes are admitted before
+plain reads, and reads before heavy reports and exports. When the queue is full
+or a request waits too long, it is answered 503 with Retry-After instead of
+piling up behind `pool.acquire()`. Pool acquires are bounded by a timeout, and
+every route class runs its SQL under its own Postgres statement_timeout. A
+request that hits its statement_timeout gets 504 without Retry-After, since
+retrying the same query would time out again.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import os
+
+import asyncpg
+from starlette.responses import JSONResponse
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "20"))
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "50"))
+QUEUE_TIMEOUT = float(os.getenv("REQUEST_QUEUE_TIMEOUT_SECONDS", "5"))
+POOL_ACQUIRE_TIMEOUT = float(os.getenv("POOL_ACQUIRE_TIMEOUT_SECONDS", "5"))
+RETRY_AFTER_SECONDS = 2
+
+# Route class -> admission priority (lower is served first)
+PRIORITIES = {"critical": 0, "read": 1, "heavy": 2}
+
+# Route class -> statement_timeout in ms; None is background work, never limited
+STATEMENT_TIMEOUTS = {
+    "critical": int(os.getenv("STATEMENT_TIMEOUT_CRITICAL_MS", "5000")),
+    "read": int(os.getenv("STATEMENT_TIMEOUT_READ_MS", "10000")),
+    "heavy": int(os.getenv("STATEMENT_TIMEOUT_HEAVY_MS", "120000")),
+    None: 0,
+}
+
+# Set as the connection default, so the common case needs no extra SET
+DEFAULT_STATEMENT_TIMEOUT = STATEMENT_TIMEOUTS["read"]
+
+HEAVY_PATHS = ("/api/reports", "/api/account", "/api/search")
+
+# Probes read cached state; queueing them behind a burst would fail liveness
+PROBE_PATHS = ("/api/health/live", "/api/health/ready")
+
+current_route_class = contextvars.ContextVar("current_route_class", default=None)
+
+shed_requests = metrics.counter("requests_shed_total", "Requests answered 503 because the worker was saturated")
+queued_requests = metrics.gauge("requests_queued", "Requests waiting for admission")
+active_requests = metrics.gauge("requests_active", "Requests currently admitted")
+
+
+def classify(method: str, path: str) -> str:
+    if path.startswith("/api/auth"):
+        return "critical"
+    if path.startswith(HEAVY_PATHS):
+        return "heavy"
+    if method in ("POST", "PUT", "PATCH", "DELETE"):
+        return "critical"
+    return "read"
+
+
+class PriorityLimiter:
+    def __init__(self, limit: int = MAX_CONCURRENT_REQUESTS, max_waiting: int = MAX_QUEUED_REQUESTS):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.active = 0
+        self.waiting = []
+        self.counter = itertools.count()
+
+    def _update_metrics(self):
+        active_requests.set(self.active)
+        queued_requests.set(len(self.waiting))
+
+    async def acquire(self, priority: int, timeout: float = QUEUE_TIMEOUT) -> bool:
+        """Wait for a slot; False means the request should be shed."""
+        if self.active < self.limit and not self.waiting:
+            self.active += 1
+            self._update_metrics()
+            return True
+
+        if len(self.waiting) >= self.max_waiting:
+            # A full queue sheds its lowest-priority, newest waiter if it ranks below this request
+            worst = max(self.waiting)
+            if worst[0] <= priority:
+                return False
+            self.waiting.remove(worst)
+            heapq.heapify(self.waiting)
+            worst[2].set_result(False)
+
+        entry = (priority, next(self.counter), asyncio.get_running_loop().create_future())
+        heapq.heappush(self.waiting, entry)
+        self._update_metrics()
+        try:
+            # A slot handed over just as the timeout fires is still returned as True
+            return await asyncio.wait_for(entry[2], timeout)
+        except asyncio.TimeoutError:
+            return False
+        except asyncio.CancelledError:
+            # Cancelled after release() handed this waiter the slot: pass it on, or it leaks
+            if entry[2].done() and not entry[2].cancelled() and entry[2].result():
+                self.release()
+            raise
+        finally:
+            if entry in self.waiting:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+            self._update_metrics()
+
+    def release(self):
+        # The slot passes straight to the best waiter still waiting
+        while self.waiting:
+            _, _, future = heapq.heappop(self.waiting)
+            if not future.done():
+                future.set_result(True)
+                self._update_metrics()
+                return
+        self.active -= 1
+        self._update_metrics()
+
+
+def statement_timeout_response() -> JSONResponse:
+    return JSONResponse({"detail": "The request took too long to complete"}, status_code=504)
+
+
+def overloaded_response() -> JSONResponse:
+    return JSONResponse(
+        {"detail": "Server is busy, please retry shortly"},
+        status_code=503,
+        headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+    )
+
+
+class LoadSheddingMiddleware:
+    def __init__(self, app, limiter: PriorityLimiter = None):
+        self.app = app
+        self.limiter = limiter or PriorityLimiter()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in PROBE_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        route_class = classify(scope["method"], scope["path"])
+        if not await self.limiter.acquire(PRIORITIES[route_class]):
+            shed_requests.inc()
+            await overloaded_response()(scope, receive, send)
+            return
+
+        started = False
+
+        async def send_wrapper(message):
+            nonlocal started
+            if message["type"] == "http.response.start":
+                started = True
+            await send(message)
+
+        token = current_route_class.set(route_class)
+        try:
+            await self.app(scope, receive, send_wrapper)
+        except asyncio.TimeoutError as e:
+            # Pool acquire timeout: the database is saturated
+            if started:
+                raise
+            logger.warning(f"Shedding {scope['method']} {scope['path']}: {type(e).__name__}")
+            shed_requests.inc()
+            await overloaded_response()(scope, receive, send)
+        except asyncpg.QueryCanceledError:
+            # Statement timeout: the query itself is too slow, so a retry would fail the same way
+            if started:
+                raise
+            logger.warning(f"Statement timeout on {scope['method']} {scope['path']}")
+            await statement_timeout_response()(scope, receive, send)
+        finally:
+            current_route_class.reset(token)
+            self.limiter.release()
+
+
+async def apply_statement_timeout(conn):
+    """Pool setup hook: run the connection under the current route class's timeout."""
+    timeout = STATEMENT_TIMEOUTS[current_route_class.get()]
+    if timeout != DEFAULT_STATEMENT_TIMEOUT:
+        await conn.execute(f"SET statement_timeout = {timeout}")
+
+
+class Pool(asyncpg.Pool):
+    """asyncpg pool whose acquire() gives up after POOL_ACQUIRE_TIMEOUT by default."""
+
+    def acquire(self, *, timeout=None):
+        return super().acquire(timeout=POOL_ACQUIRE_TIMEOUT if timeout is None else timeout)
+
+
+def create_pool(dsn: str, *, min_size: int, max_size: int):
+    # Same defaults as asyncpg.create_pool; released connections are RESET ALL
+    # back to the connection-level statement_timeout
+    return Pool(
+        dsn,
+        min_size=min_size,
+        max_size=max_size,
+        max_queries=50000,
+        max_inactive_connection_lifetime=300.0,
+        setup=apply_statement_timeout,
+        loop=None,
+        connection_class=asyncpg.Connection,
+        record_class=asyncpg.Record,
+        server_settings={"statement_timeout": str(DEFAULT_STATEMENT_TIMEOUT)},
+    )
@@ -0,0 +1,221 @@
+"""Non-blocking, structured logging.
+
+Handlers on the event loop thread only enqueue records; a QueueListener thread
+formats them as one JSON object per line and writes them to stderr, so a burst
+of errors cannot stall request handling on log I/O. When the queue is full,
+records are dropped and counted instead of blocking.
+
+Every record carries the request id, route and user id of the request that
+logged it, and `RequestLogMiddleware` logs one access record per request with
+its status and latency. Warnings and errors from the same call site are
+limited to `ERROR_BURST` per `ERROR_WINDOW_SECONDS`; the first record after a
+window reports how many were suppressed.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import time
+import uuid
+from datetime import datetime, timezone
+
+import metrics
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" for log collectors, "text" for reading in a terminal
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+ERROR_BURST = int(os.getenv("LOG_ERROR_BURST", "10"))
+ERROR_WINDOW_SECONDS = float(os.getenv("LOG_ERROR_WINDOW_SECONDS", "60"))
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+dropped_records = metrics.counter("log_records_dropped_total", "Log records dropped because the queue was full")
+suppressed_records = metrics.counter("log_records_suppressed_total", "Repeated warnings and errors not logged")
+
+access_logger = logging.getLogger("access")
+
+
+class RequestContext:
+    """Mutable per-request state; dependencies fill in the user once known."""
+    __slots__ = ("request_id", "scope", "user_id")
+
+    def __init__(self, request_id: str, scope: dict):
+        self.request_id = request_id
+        self.scope = scope
+        self.user_id = None
+
+    @property
+    def route(self) -> str:
+        # The path template once routing has matched, e.g. /api/trips/{trip_id}
+        route = self.scope.get("route")
+        return getattr(route, "path", None) or self.scope["path"]
+
+
+current_request = contextvars.ContextVar("current_request", default=None)
+
+
+def set_user(user_id: str):
+    context = current_request.get()
+    if context is not None:
+        context.user_id = user_id
+
+
+class ContextFilter(logging.Filter):
+    """Stamps records with the current request before they leave its context."""
+
+    def filter(self, record):
+        context = current_request.get()
+        if context is not None:
+            record.request_id = context.request_id
+            record.route = context.route
+            record.user_id = context.user_id
+        return True
+
+
+class RepeatFilter(logging.Filter):
+    """At most `burst` warnings and errors per call site per window."""
+
+    def __init__(self, burst: int = ERROR_BURST, window: float = ERROR_WINDOW_SECONDS):
+        super().__init__()
+        self.burst = burst
+        self.window = window
+        # (pathname, lineno) -> [window start, records seen, records suppressed]
+        self.sites = {}
+
+    def filter(self, record):
+        if record.levelno < logging.WARNING:
+            return True
+        now = time.monotonic()
+        site = self.sites.get((record.pathname, record.lineno))
+        if site is None or now - site[0] >= self.window:
+            if site is not None and site[2]:
+                record.suppressed = site[2]
+            if len(self.sites) > 10_000:
+                self.sites.clear()
+            self.sites[(record.pathname, record.lineno)] = [now, 1, 0]
+            return True
+        site[1] += 1
+        if site[1] <= self.burst:
+            return True
+        site[2] += 1
+        suppressed_records.inc()
+        return False
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # Only merge the message here; tracebacks are formatted by the listener thread
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records.inc()
+
+
+# Record attributes that are part of every LogRecord rather than added context
+STANDARD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        # Request context, access fields and anything passed as `extra=`
+        for key, value in record.__dict__.items():
+            if key not in STANDARD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+listener = None
+
+
+def configure_logging(level: str = LOG_LEVEL, fmt: str = LOG_FORMAT, stream=None):
+    """Route the root logger, and uvicorn's loggers, through a queue to a writer thread."""
+    global listener
+    if listener is not None:
+        listener.stop()
+
+    output = logging.StreamHandler(stream or sys.stderr)
+    output.setFormatter(JSONFormatter() if fmt == "json" else logging.Formatter(TEXT_FORMAT))
+
+    handler = NonBlockingQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    handler.addFilter(RepeatFilter())
+    handler.addFilter(ContextFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level)
+    # uvicorn installs its own stream handlers before importing the app
+    for name in ("uvicorn", "uvicorn.error"):
+        logging.getLogger(name).handlers = []
+        logging.getLogger(name).propagate = True
+    # Superseded by the access records of RequestLogMiddleware
+    logging.getLogger("uvicorn.access").disabled = True
+
+    listener = logging.handlers.QueueListener(handler.queue, output)
+    listener.start()
+    return listener
+
+
+@atexit.register
+def flush_logs():
+    # Writes out whatever is still queued
+    if listener is not None:
+        listener.stop()
+
+
+class RequestLogMiddleware:
+    """Outermost middleware: request id, context for log records and the access log."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+        context = RequestContext(request_id or uuid.uuid4().hex, scope)
+        status = 500
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [*message.get("headers", []), (b"x-request-id", context.request_id.encode("latin-1"))]
+            await send(message)
+
+        token = current_request.set(context)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            latency_ms = round((time.perf_counter() - started) * 1000, 1)
+            access_logger.info(
+                f"{scope['method']} {scope['path']} {status} {latency_ms}ms",
+                extra={"method": scope["method"], "status": status, "latency_ms": latency_ms}
+            )
+            current_request.reset(token)
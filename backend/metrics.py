@@ -0,0 +1,43 @@
+"""Process-local counters and gauges, exposed in Prometheus text format."""
+
+_registry = {}
+
+
+class Metric:
+    __slots__ = ("name", "help", "kind", "value")
+
+    def __init__(self, name: str, help: str, kind: str):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def set(self, value: float):
+        self.value = value
+
+
+def _register(name: str, help: str, kind: str) -> Metric:
+    metric = _registry.get(name)
+    if metric is None:
+        metric = _registry[name] = Metric(name, help, kind)
+    return metric
+
+
+def counter(name: str, help: str) -> Metric:
+    return _register(name, help, "counter")
+
+
+def gauge(name: str, help: str) -> Metric:
+    return _register(name, help, "gauge")
+
+
+def render() -> str:
+    lines = []
+    for metric in _registry.values():
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.append(f"{metric.name} {metric.value}")
+    return "\n".join(lines) + "\n"
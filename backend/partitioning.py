@@ -0,0 +1,370 @@
+"""Monthly range partitioning for the trips and expenses tables.
+
+Commands run on the primary and then on every shard in SHARD_DATABASE_URLS.
+
+Usage:
+    python partitioning.py migrate               # convert existing heap tables
+    python partitioning.py ensure                # create upcoming partitions
+    python partitioning.py archive --before 2024-01-01 --out ./archive
+"""
+import argparse
+import asyncio
+import gzip
+import logging
+import os
+from datetime import datetime, timezone
+from pathlib import Path
+
+import asyncpg
+
+from compact_types import migrate_compact_types
+from sharding import PRIMARY_SHARD, cli_router
+from sync import skip_change_log
+
+logger = logging.getLogger(__name__)
+
+# Partitioned table -> (range key column, external id column)
+PARTITIONED_TABLES = {
+    "trips": ("start_time", "trip_id"),
+    "expenses": ("date", "expense_id"),
+}
+
+# Number of monthly partitions kept created ahead of the current month
+PARTITIONS_AHEAD = int(os.getenv("PARTITIONS_AHEAD_MONTHS", "3"))
+
+# Never queue behind long-running queries while changing partition layout
+DDL_LOCK_TIMEOUT = os.getenv("PARTITION_LOCK_TIMEOUT", "5s")
+
+# A unique constraint on a partitioned table must include the partition key, so
+# trip_id and expense_id are only unique together with their time. The ids are
+# still unique on their own by construction: they are generated server side, and
+# every path that writes by id (API updates and deletes, live tracking, dedup,
+# import) matches on the id and user_id alone, never on (id, time), so an edit
+# that moves a row's time can neither orphan it nor let in a second copy.
+PARENT_DDL = {
+    "trips": '''
+        CREATE TABLE IF NOT EXISTS trips (
+            id INTEGER NOT NULL DEFAULT nextval('trips_id_seq'),
+            trip_id VARCHAR(255) NOT NULL,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
+            start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+            end_time TIMESTAMP WITH TIME ZONE,
+            distance_m INTEGER NOT NULL,
+            start_location TEXT,
+            end_location TEXT,
+            purpose TEXT,
+            is_business BOOLEAN DEFAULT TRUE,
+            is_automatic BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (id, start_time),
+            UNIQUE (trip_id, start_time)
+        ) PARTITION BY RANGE (start_time)
+    ''',
+    "expenses": '''
+        CREATE TABLE IF NOT EXISTS expenses (
+            id INTEGER NOT NULL DEFAULT nextval('expenses_id_seq'),
+            expense_id VARCHAR(255) NOT NULL,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
+            amount_cents BIGINT NOT NULL,
+            category VARCHAR(255) NOT NULL,
+            date TIMESTAMP WITH TIME ZONE NOT NULL,
+            notes TEXT,
+            receipt_image_base64 TEXT,
+            receipt_thumbnail_base64 TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (id, date),
+            UNIQUE (expense_id, date)
+        ) PARTITION BY RANGE (date)
+    ''',
+}
+
+
+def month_start(dt: datetime) -> datetime:
+    return dt.astimezone(timezone.utc).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def add_months(dt: datetime, months: int) -> datetime:
+    month = dt.month - 1 + months
+    return dt.replace(year=dt.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(table: str, start: datetime) -> str:
+    return f"{table}_p{start:%Y_%m}"
+
+
+async def is_partitioned(conn, table: str) -> bool:
+    return bool(await conn.fetchval(
+        "SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass($1)",
+        table
+    ))
+
+
+async def create_partitioned_table(conn, table: str):
+    """Create the partitioned parent, its indexes and a default partition."""
+    key, _ = PARTITIONED_TABLES[table]
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", table) and not await is_partitioned(conn, table):
+        # Heap table from before partitioning; left alone until `migrate` runs
+        return
+    await conn.execute(f"CREATE SEQUENCE IF NOT EXISTS {table}_id_seq")
+    await conn.execute(PARENT_DDL[table])
+    await conn.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_{key} ON {table} (user_id, {key})")
+    await conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+
+
+async def create_partition(conn, table: str, start: datetime) -> bool:
+    """Create the monthly partition starting at `start`.
+
+    Rows the default partition already caught for that month are moved into
+    the new partition before it is attached. Returns False when the month is
+    already covered by an existing partition.
+    """
+    key, _ = PARTITIONED_TABLES[table]
+    end = add_months(start, 1)
+    name = partition_name(table, start)
+
+    if await conn.fetchval("SELECT to_regclass($1) IS NOT NULL", name):
+        return False
+
+    try:
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{DDL_LOCK_TIMEOUT}'")
+            # Moved rows are unchanged; logged, the DELETE would sync them as deleted
+            await skip_change_log(conn)
+            await conn.execute(
+                f"CREATE TABLE {name} (LIKE {table} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"
+            )
+            # Matching CHECK lets ATTACH skip the validation scan
+            await conn.execute(
+                f"ALTER TABLE {name} ADD CONSTRAINT {name}_bound "
+                f"CHECK ({key} >= '{start.isoformat()}' AND {key} < '{end.isoformat()}')"
+            )
+            await conn.execute(
+                f"""WITH moved AS (
+                        DELETE FROM {table}_default WHERE {key} >= $1 AND {key} < $2 RETURNING *
+                    )
+                    INSERT INTO {name} SELECT * FROM moved""",
+                start, end
+            )
+            await conn.execute(
+                f"ALTER TABLE {table} ATTACH PARTITION {name} "
+                f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+            )
+            await conn.execute(f"ALTER TABLE {name} DROP CONSTRAINT {name}_bound")
+    except asyncpg.exceptions.InvalidObjectDefinitionError:
+        # Range overlaps an existing partition (e.g. the migrated legacy table)
+        return False
+
+    logger.info(f"Created partition {name}")
+    return True
+
+
+async def ensure_partitions(conn, months_ahead: int = PARTITIONS_AHEAD):
+    """Make sure the current month and the next `months_ahead` have partitions."""
+    current = month_start(datetime.now(timezone.utc))
+    for table in PARTITIONED_TABLES:
+        if not await is_partitioned(conn, table):
+            logger.warning(f"Table {table} is not partitioned; run `python partitioning.py migrate`")
+            continue
+        for offset in range(months_ahead + 1):
+            await create_partition(conn, table, add_months(current, offset))
+
+
+async def maintain_partitions(pool, interval: float = 24 * 60 * 60):
+    """Background loop that keeps future partitions created."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            async with pool.acquire() as conn:
+                await ensure_partitions(conn)
+        except Exception as e:
+            logger.error(f"Partition maintenance failed: {e}")
+
+
+async def table_columns(conn, table: str) -> dict:
+    """Column name -> (type, NOT NULL)."""
+    rows = await conn.fetch(
+        """SELECT attname, format_type(atttypid, atttypmod) AS type, attnotnull FROM pg_attribute
+           WHERE attrelid = $1::regclass AND attnum > 0 AND NOT attisdropped""",
+        table
+    )
+    return {r['attname']: (r['type'], r['attnotnull']) for r in rows}
+
+
+async def align_legacy_columns(conn, table: str):
+    """Add the parent's columns the heap table lacks, so it can be attached.
+
+    Columns added by later features (e.g. receipt_thumbnail_base64) are
+    nullable, so adding them only touches the catalog. Anything else that
+    differs needs a migration of its own first.
+    """
+    # The parent's columns, read from a copy created in a rolled back transaction
+    shape = conn.transaction()
+    await shape.start()
+    try:
+        await conn.execute(PARENT_DDL[table].replace(f"EXISTS {table} (", f"EXISTS {table}_shape (", 1))
+        parent = await table_columns(conn, f"{table}_shape")
+    finally:
+        await shape.rollback()
+
+    legacy = await table_columns(conn, table)
+    extra = set(legacy) - set(parent)
+    if extra:
+        raise RuntimeError(f"{table} has columns the partitioned table lacks: {', '.join(sorted(extra))}")
+    for column, (column_type, not_null) in parent.items():
+        if column not in legacy:
+            if not_null:
+                raise RuntimeError(f"{table}.{column} is missing and NOT NULL; migrate it first")
+            async with conn.transaction():
+                await conn.execute(f"SET LOCAL lock_timeout = '{DDL_LOCK_TIMEOUT}'")
+                await conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+            logger.info(f"Added {table}.{column} to match the partitioned table")
+        elif legacy[column][0] != column_type:
+            raise RuntimeError(f"{table}.{column} is {legacy[column][0]}, the partitioned table needs {column_type}")
+
+
+async def migrate_table(conn, table: str):
+    """Convert an existing heap table into a partitioned one without long locks.
+
+    The old table is kept as a single `<table>_legacy` partition covering every
+    row up to a cutoff. Its bound constraint is validated and the parent's
+    indexes are built concurrently up front, so the final swap is a short
+    catalog-only transaction.
+    """
+    if await is_partitioned(conn, table):
+        logger.info(f"Table {table} is already partitioned")
+        return
+
+    # ATTACH needs exactly the parent's columns
+    await align_legacy_columns(conn, table)
+
+    key, id_column = PARTITIONED_TABLES[table]
+    legacy = f"{table}_legacy"
+    latest = await conn.fetchval(f"SELECT MAX({key}) FROM {table}")
+    now = datetime.now(timezone.utc)
+    cutoff = add_months(month_start(max(latest or now, now)), 1)
+
+    # Enforced for new rows immediately, validated without blocking writes
+    await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {legacy}_bound")
+    await conn.execute(
+        f"ALTER TABLE {table} ADD CONSTRAINT {legacy}_bound "
+        f"CHECK ({key} < '{cutoff.isoformat()}') NOT VALID"
+    )
+    await conn.execute(f"ALTER TABLE {table} VALIDATE CONSTRAINT {legacy}_bound")
+
+    # Pre-build indexes matching the parent's so ATTACH can adopt them
+    await conn.execute(
+        f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {legacy}_pkey_idx ON {table} (id, {key})"
+    )
+    await conn.execute(
+        f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {legacy}_{id_column}_idx ON {table} ({id_column}, {key})"
+    )
+    await conn.execute(
+        f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {legacy}_user_{key}_idx ON {table} (user_id, {key})"
+    )
+
+    async with conn.transaction():
+        await conn.execute(f"SET LOCAL lock_timeout = '{DDL_LOCK_TIMEOUT}'")
+        # Swap the old single-column keys for the pre-built ones
+        await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_pkey")
+        await conn.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {legacy}_pkey PRIMARY KEY USING INDEX {legacy}_pkey_idx"
+        )
+        await conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_{id_column}_key")
+        await conn.execute(
+            f"ALTER TABLE {table} ADD CONSTRAINT {legacy}_{id_column}_key UNIQUE USING INDEX {legacy}_{id_column}_idx"
+        )
+        await conn.execute(f"ALTER TABLE {table} RENAME TO {legacy}")
+        await conn.execute(PARENT_DDL[table])
+        await conn.execute(f"ALTER SEQUENCE {table}_id_seq OWNED BY {table}.id")
+        await conn.execute(
+            f"ALTER TABLE {table} ATTACH PARTITION {legacy} "
+            f"FOR VALUES FROM (MINVALUE) TO ('{cutoff.isoformat()}')"
+        )
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_user_{key} ON {table} (user_id, {key})")
+        await conn.execute(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT")
+
+    logger.info(f"Migrated {table} to range partitioning (legacy rows before {cutoff:%Y-%m-%d})")
+
+
+async def cold_partitions(conn, table: str, before: datetime):
+    """Partitions of `table` whose upper bound is on or before `before`."""
+    rows = await conn.fetch(
+        r"""SELECT c.relname AS name,
+                   (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \(''([^'']+)''\)'))[1]::timestamptz AS upper_bound
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = to_regclass($1)""",
+        table
+    )
+    return sorted(
+        (r['name'] for r in rows if r['upper_bound'] and r['upper_bound'] <= before)
+    )
+
+
+async def archive_partitions(conn, table: str, before: datetime, out_dir: Path, keep: bool = False):
+    """Detach cold partitions, dump them to gzipped CSV and drop them."""
+    out_dir.mkdir(parents=True, exist_ok=True)
+    archived = []
+    for name in await cold_partitions(conn, table, before):
+        async with conn.transaction():
+            await conn.execute(f"SET LOCAL lock_timeout = '{DDL_LOCK_TIMEOUT}'")
+            await conn.execute(f"ALTER TABLE {table} DETACH PARTITION {name}")
+
+        path = out_dir / f"{name}.csv.gz"
+        with gzip.open(path, "wb") as f:
+            await conn.copy_from_table(name, output=f, format="csv", header=True)
+
+        if not keep:
+            await conn.execute(f"DROP TABLE {name}")
+        logger.info(f"Archived partition {name} to {path}")
+        archived.append(name)
+    return archived
+
+
+async def run_command(conn, shard: str, args):
+    if args.command == "migrate":
+        # Partitions are created with integer columns, the legacy table must match
+        await migrate_compact_types(conn)
+        for table in PARTITIONED_TABLES:
+            await migrate_table(conn, table)
+        await ensure_partitions(conn)
+    elif args.command == "ensure":
+        await ensure_partitions(conn)
+    elif args.command == "archive":
+        before = datetime.fromisoformat(args.before)
+        if before.tzinfo is None:
+            before = before.replace(tzinfo=timezone.utc)
+        # Partition names repeat across shards
+        out_dir = Path(args.out) if shard == PRIMARY_SHARD else Path(args.out) / shard
+        for table in args.table or PARTITIONED_TABLES:
+            await archive_partitions(conn, table, before, out_dir, keep=args.keep)
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage trips/expenses partitions")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="convert existing heap tables to partitioned tables")
+    sub.add_parser("ensure", help="create upcoming monthly partitions")
+    archive = sub.add_parser("archive", help="detach and archive cold partitions")
+    archive.add_argument("--before", required=True, help="archive partitions ending on or before this date")
+    archive.add_argument("--out", default="archive", help="output directory for gzipped CSV dumps")
+    archive.add_argument("--table", choices=list(PARTITIONED_TABLES), action="append")
+    archive.add_argument("--keep", action="store_true", help="keep detached tables instead of dropping them")
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / '.env')
+
+    async with cli_router() as router:
+        for name, pool in router.pools.items():
+            logger.info(f"Shard {name}")
+            async with pool.acquire() as conn:
+                await run_command(conn, name, args)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+"""Minimal streaming PDF writer for plain-text reports.
+
+Pages are emitted as soon as they are rendered and only byte offsets are kept
+for the cross-reference table, so a document of any length is written in
+constant memory. Text is set in the built-in Courier font, which needs no
+embedding and keeps columns aligned.
+"""
+import zlib
+
+PAGE_WIDTH, PAGE_HEIGHT = 612, 792  # US Letter, in points
+MARGIN = 48
+FONT_SIZE = 8
+LEADING = 11
+LINES_PER_PAGE = (PAGE_HEIGHT - 2 * MARGIN) // LEADING
+
+# Objects 1-3 are fixed; the page tree (2) is written last, once all pages are known
+CATALOG, PAGES, FONT = 1, 2, 3
+
+
+def escape(text: str) -> bytes:
+    data = text.encode("latin-1", errors="replace")
+    return data.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+def render_page(lines) -> bytes:
+    """Compressed content stream for one page of text lines."""
+    ops = [b"BT /F1 %d Tf %d TL %d %d Td" % (FONT_SIZE, LEADING, MARGIN, PAGE_HEIGHT - MARGIN)]
+    for line in lines:
+        ops.append(b"(" + escape(line) + b") '")
+    ops.append(b"ET")
+    return zlib.compress(b"\n".join(ops))
+
+
+def render_pages(pages):
+    """Render several pages in one call; picklable for a worker process."""
+    return [render_page(lines) for lines in pages]
+
+
+class PdfStream:
+    def __init__(self):
+        self.position = 0
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = FONT + 1
+
+    def _emit(self, data: bytes) -> bytes:
+        self.position += len(data)
+        return data
+
+    def _object(self, obj_id: int, body: bytes) -> bytes:
+        self.offsets[obj_id] = self.position
+        return self._emit(b"%d 0 obj\n" % obj_id + body + b"\nendobj\n")
+
+    def header(self) -> bytes:
+        return b"".join([
+            self._emit(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n"),
+            self._object(CATALOG, b"<< /Type /Catalog /Pages %d 0 R >>" % PAGES),
+            self._object(FONT, b"<< /Type /Font /Subtype /Type1 /BaseFont /Courier /Encoding /WinAnsiEncoding >>"),
+        ])
+
+    def page(self, content: bytes) -> bytes:
+        content_id, page_id = self.next_id, self.next_id + 1
+        self.next_id += 2
+        self.page_ids.append(page_id)
+        return b"".join([
+            self._object(
+                content_id,
+                b"<< /Length %d /Filter /FlateDecode >>\nstream\n" % len(content) + content + b"\nendstream"
+            ),
+            self._object(
+                page_id,
+                b"<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] /Contents %d 0 R "
+                b"/Resources << /Font << /F1 %d 0 R >> >> >>"
+                % (PAGES, PAGE_WIDTH, PAGE_HEIGHT, content_id, FONT)
+            ),
+        ])
+
+    def trailer(self) -> bytes:
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        pages = self._object(PAGES, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+
+        xref_offset = self.position
+        size = self.next_id
+        xref = [b"xref\n0 %d\n" % size, b"0000000000 65535 f \n"]
+        for obj_id in range(1, size):
+            xref.append(b"%010d 00000 n \n" % self.offsets[obj_id])
+        xref.append(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, CATALOG, xref_offset))
+        return pages + self._emit(b"".join(xref))
@@ -0,0 +1,172 @@
+"""Per-user (or per-IP) token bucket rate limiting.
+
+Each rule allows a burst of `capacity` requests refilled at `capacity / period`
+tokens per second. Buckets live in a dict of two-element lists in the worker
+and are evicted once idle long enough to have refilled completely, which is
+indistinguishable from having no bucket. With RATE_LIMIT_BACKEND=postgres the
+buckets are shared by all workers through one atomic upsert per request.
+
+Rules are configured in RATE_LIMITS and can be overridden with the env var of
+the same name, e.g. RATE_LIMITS="reports=30/60,exports=5/300".
+"""
+import logging
+import math
+import os
+import time
+
+from fastapi import HTTPException
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# rule -> (capacity, period in seconds)
+RATE_LIMITS = {
+    "auth": (10, 60),
+    "reads": (300, 60),
+    "writes": (120, 60),
+    "search": (60, 60),
+    "reports": (20, 60),
+    "exports": (5, 300),
+    # Clients page through changes in a loop after being offline
+    "sync": (120, 60),
+    # Once per app launch, but fans out into several queries
+    "bootstrap": (30, 60),
+}
+
+# Seconds between sweeps for idle in-memory buckets
+EVICT_INTERVAL = 60
+
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+limited_requests = metrics.counter("rate_limited_total", "Requests rejected with 429")
+tracked_buckets = metrics.gauge("rate_limit_buckets", "In-memory rate limit buckets")
+
+
+def parse_limits(spec: str) -> dict:
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        rule, _, value = item.partition("=")
+        capacity, _, period = value.partition("/")
+        limits[rule.strip()] = (int(capacity), float(period or 60))
+    return limits
+
+
+RATE_LIMITS.update(parse_limits(os.getenv("RATE_LIMITS", "")))
+
+
+class MemoryBuckets:
+    def __init__(self):
+        # (rule, key) -> [tokens, last refill (monotonic)]
+        self.buckets = {}
+        self.next_eviction = time.monotonic() + EVICT_INTERVAL
+
+    def evict(self, now: float):
+        self.next_eviction = now + EVICT_INTERVAL
+        idle = [
+            bucket_key for bucket_key, (tokens, last) in self.buckets.items()
+            if tokens + (now - last) * self.rate(bucket_key[0]) >= RATE_LIMITS[bucket_key[0]][0]
+        ]
+        for bucket_key in idle:
+            del self.buckets[bucket_key]
+        tracked_buckets.set(len(self.buckets))
+
+    @staticmethod
+    def rate(rule: str) -> float:
+        capacity, period = RATE_LIMITS[rule]
+        return capacity / period
+
+    async def take(self, rule: str, key: str) -> float:
+        """Take one token; returns the tokens left, negative when none was available."""
+        now = time.monotonic()
+        if now >= self.next_eviction:
+            self.evict(now)
+
+        capacity = RATE_LIMITS[rule][0]
+        bucket = self.buckets.get((rule, key))
+        if bucket is None:
+            bucket = self.buckets[(rule, key)] = [capacity, now]
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * self.rate(rule))
+        bucket[0] = tokens - 1 if tokens >= 1 else tokens
+        bucket[1] = now
+        return tokens - 1
+
+
+class PostgresBuckets:
+    """Buckets shared across workers, refilled and taken in one statement."""
+
+    def __init__(self, get_pool):
+        self.get_pool = get_pool
+        self.next_eviction = time.monotonic() + EVICT_INTERVAL
+
+    async def evict(self, conn, now: float):
+        self.next_eviction = now + EVICT_INTERVAL
+        longest_period = max(period for _, period in RATE_LIMITS.values())
+        await conn.execute(
+            "DELETE FROM rate_limit_buckets WHERE updated_at < NOW() - make_interval(secs => $1)",
+            float(longest_period)
+        )
+
+    async def take(self, rule: str, key: str) -> float:
+        capacity, period = RATE_LIMITS[rule]
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            now = time.monotonic()
+            if now >= self.next_eviction:
+                await self.evict(conn, now)
+            return await conn.fetchval(
+                """WITH refill AS (
+                       SELECT COALESCE((
+                           SELECT LEAST($2, tokens + EXTRACT(EPOCH FROM clock_timestamp() - updated_at) * $3)
+                           FROM rate_limit_buckets WHERE bucket = $1 FOR UPDATE
+                       ), $2) AS tokens
+                   ), taken AS (
+                       INSERT INTO rate_limit_buckets (bucket, tokens, updated_at)
+                       SELECT $1, CASE WHEN tokens >= 1 THEN tokens - 1 ELSE tokens END, clock_timestamp()
+                       FROM refill
+                       ON CONFLICT (bucket) DO UPDATE SET tokens = EXCLUDED.tokens, updated_at = EXCLUDED.updated_at
+                   )
+                   SELECT tokens - 1 FROM refill""",
+                f"{rule}:{key}", float(capacity), capacity / period
+            )
+
+
+async def install_rate_limits(conn):
+    # Unlogged: losing buckets on a crash only resets limits
+    await conn.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limit_buckets (
+            bucket VARCHAR(300) PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE NOT NULL
+        )
+    ''')
+
+
+class RateLimiter:
+    def __init__(self):
+        self.backend = MemoryBuckets()
+
+    def use_postgres(self, get_pool):
+        self.backend = PostgresBuckets(get_pool)
+
+    async def check(self, rule: str, key: str) -> dict:
+        """Take a token for `key` under `rule`; raises 429 when the bucket is empty.
+
+        Returns the RateLimit-* headers to send with the response.
+        """
+        capacity, period = RATE_LIMITS[rule]
+        rate = capacity / period
+        tokens = await self.backend.take(rule, key)
+        headers = {
+            "RateLimit-Limit": str(capacity),
+            "RateLimit-Remaining": str(max(0, math.floor(tokens))),
+            "RateLimit-Reset": str(math.ceil((capacity - max(tokens, 0)) / rate)),
+        }
+        if tokens < 0:
+            limited_requests.inc()
+            headers["Retry-After"] = str(math.ceil(-tokens / rate))
+            raise HTTPException(status_code=429, detail="Rate limit exceeded", headers=headers)
+        return headers
+
+
+rate_limiter = RateLimiter()
@@ -0,0 +1,117 @@
+"""Receipt ingestion: normalized originals and list-view thumbnails.
+
+Uploaded receipt photos are decoded, turned upright from their EXIF
+orientation, stripped of metadata (phone EXIF includes GPS position), scaled
+down to MAX_DIMENSION and re-encoded as WebP, together with a small thumbnail.
+Decoding and encoding run in the shared worker process pool so the event loop
+never blocks. Expense lists carry only the thumbnail; the original is served on
+demand by GET /api/expenses/{expense_id}/receipt.
+
+Receipts stored before thumbnails existed (or restored from an archive) are
+processed by the `receipt_thumbnails` job.
+"""
+import base64
+import io
+import logging
+import os
+
+from archive import decode_receipt
+from jobs import job_handler, json_result, run_cpu
+from startup import lazy_import
+
+# Loaded by the first receipt upload rather than at server start
+Image = lazy_import("PIL.Image")
+ImageOps = lazy_import("PIL.ImageOps")
+
+logger = logging.getLogger(__name__)
+
+MAX_DIMENSION = int(os.getenv("RECEIPT_MAX_DIMENSION", "2000"))
+THUMBNAIL_DIMENSION = int(os.getenv("RECEIPT_THUMBNAIL_DIMENSION", "320"))
+RECEIPT_QUALITY = 80
+THUMBNAIL_QUALITY = 60
+MAX_RECEIPT_BYTES = 20 * 1024 * 1024
+
+RECEIPT_FORMAT = "WEBP"
+RECEIPT_MIME_TYPE = "image/webp"
+
+BACKFILL_BATCH_SIZE = 50
+
+
+async def install_receipt_thumbnails(conn):
+    await conn.execute("ALTER TABLE expenses ADD COLUMN IF NOT EXISTS receipt_thumbnail_base64 TEXT")
+
+
+def _encode(image, quality: int) -> str:
+    buffer = io.BytesIO()
+    # No exif/icc_profile arguments, so no metadata is written
+    image.save(buffer, RECEIPT_FORMAT, quality=quality)
+    return f"data:{RECEIPT_MIME_TYPE};base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def normalize_receipt(data_url: str) -> tuple:
+    """(receipt, thumbnail) data URLs for an uploaded image; runs in a worker process."""
+    data = decode_receipt(data_url)
+    if len(data) > MAX_RECEIPT_BYTES:
+        raise ValueError("Receipt image is too large")
+
+    try:
+        with Image.open(io.BytesIO(data)) as upload:
+            # JPEG can decode straight at 1/2, 1/4 or 1/8 scale, far cheaper than full size
+            upload.draft("RGB", (MAX_DIMENSION, MAX_DIMENSION))
+            image = ImageOps.exif_transpose(upload)
+            image = image.convert("RGBA" if image.has_transparency_data else "RGB")
+    except (Image.UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        raise ValueError("Unreadable receipt image") from e
+
+    image.thumbnail((MAX_DIMENSION, MAX_DIMENSION), Image.LANCZOS)
+    receipt = _encode(image, RECEIPT_QUALITY)
+    image.thumbnail((THUMBNAIL_DIMENSION, THUMBNAIL_DIMENSION), Image.LANCZOS)
+    return receipt, _encode(image, THUMBNAIL_QUALITY)
+
+
+async def ingest_receipt(data_url):
+    """Normalized receipt and thumbnail, or (None, None) when there is no image."""
+    if not data_url:
+        return None, None
+    return await run_cpu(normalize_receipt, data_url)
+
+
+async def get_receipt(conn, expense_id: str, user_id: str):
+    return await conn.fetchval(
+        "SELECT receipt_image_base64 FROM expenses WHERE expense_id = $1 AND user_id = $2",
+        expense_id, user_id
+    )
+
+
+@job_handler("receipt_thumbnails")
+async def receipt_thumbnails_job(pool, user_id: str, params: dict):
+    """Normalize receipts that have no thumbnail yet, a batch at a time."""
+    processed, unreadable = 0, []
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """SELECT expense_id, receipt_image_base64 FROM expenses
+                   WHERE user_id = $1 AND receipt_thumbnail_base64 IS NULL
+                     AND receipt_image_base64 <> '' AND expense_id <> ALL($2)
+                   LIMIT $3""",
+                user_id, unreadable, BACKFILL_BATCH_SIZE
+            )
+        if not rows:
+            break
+
+        for expense_id, data_url in rows:
+            try:
+                receipt, thumbnail = await run_cpu(normalize_receipt, data_url)
+            except ValueError as e:
+                logger.warning(f"Skipping receipt of {expense_id}: {e}")
+                unreadable.append(expense_id)
+                continue
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    """UPDATE expenses SET receipt_image_base64 = $3, receipt_thumbnail_base64 = $4
+                       WHERE expense_id = $1 AND user_id = $2""",
+                    expense_id, user_id, receipt, thumbnail
+                )
+            processed += 1
+
+    return json_result({"processed": processed, "unreadable": unreadable})
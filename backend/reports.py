@@ -0,0 +1,212 @@
+"""Tax report computations, streaming exports and the background report jobs."""
+import csv
+import io
+from datetime import datetime
+
+import repository
+from jobs import job_handler, json_result, run_cpu
+from pdf import LINES_PER_PAGE, PdfStream, render_pages
+
+# IRS 2025 rate: $0.67 per mile
+IRS_RATE = 0.67
+
+# Estimated tax savings (assuming 25% tax bracket)
+TAX_BRACKET = 0.25
+
+# Rows fetched from a server-side cursor per round trip
+EXPORT_BATCH_SIZE = 1000
+
+# PDF pages handed to a worker process per call
+PDF_PAGES_PER_BATCH = 20
+
+EXPORT_COLUMNS = ["type", "id", "date", "category", "description", "miles", "amount", "deduction"]
+
+
+def parse_period(start_date: str, end_date: str):
+    start = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    return start, end
+
+
+def build_tax_summary(months, categories, period_start: str, period_end: str) -> dict:
+    """Monthly and per-category breakdown of a tax period.
+
+    Runs in a worker process, so it takes and returns plain picklable data.
+    `months` rows are (month, total_miles, business_miles, trip_count) and
+    `categories` rows are (month, category, amount).
+    """
+    by_month = {}
+    for month, total_miles, business_miles, trip_count in months:
+        by_month[month] = {
+            "month": month,
+            "total_miles": total_miles,
+            "business_miles": business_miles,
+            "trips": trip_count,
+            "expenses": {},
+        }
+    totals_by_category = {}
+    for month, category, amount in categories:
+        entry = by_month.setdefault(month, {
+            "month": month, "total_miles": 0.0, "business_miles": 0.0, "trips": 0, "expenses": {},
+        })
+        entry["expenses"][category] = round(amount, 2)
+        totals_by_category[category] = totals_by_category.get(category, 0.0) + amount
+
+    monthly = []
+    for month in sorted(by_month):
+        entry = by_month[month]
+        expenses = sum(entry["expenses"].values())
+        deduction = entry["business_miles"] * IRS_RATE + expenses
+        monthly.append({
+            **entry,
+            "total_miles": round(entry["total_miles"], 2),
+            "business_miles": round(entry["business_miles"], 2),
+            "total_expenses": round(expenses, 2),
+            "total_deduction": round(deduction, 2),
+        })
+
+    total_miles = sum(m["total_miles"] for m in monthly)
+    business_miles = sum(m["business_miles"] for m in monthly)
+    total_expenses = sum(totals_by_category.values())
+    total_deduction = business_miles * IRS_RATE + total_expenses
+
+    return {
+        "period_start": period_start,
+        "period_end": period_end,
+        "total_miles": round(total_miles, 2),
+        "business_miles": round(business_miles, 2),
+        "total_expenses": round(total_expenses, 2),
+        "total_deduction": round(total_deduction, 2),
+        "total_tax_savings": round(total_deduction * TAX_BRACKET, 2),
+        "expenses_by_category": {k: round(v, 2) for k, v in sorted(totals_by_category.items())},
+        "monthly": monthly,
+    }
+
+
+def validate_tax_report_params(params: dict) -> dict:
+    start, end = parse_period(params["start_date"], params["end_date"])
+    if start > end:
+        raise ValueError("start_date is after end_date")
+    return {"start_date": params["start_date"], "end_date": params["end_date"]}
+
+
+@job_handler("tax_report", validate=validate_tax_report_params)
+async def tax_report_job(pool, user_id: str, params: dict):
+    start, end = parse_period(params["start_date"], params["end_date"])
+
+    async with pool.acquire() as conn:
+        months = await repository.monthly_trip_totals(conn, user_id, start, end)
+        categories = await repository.monthly_expense_totals(conn, user_id, start, end)
+
+    summary = await run_cpu(
+        build_tax_summary,
+        [tuple(r) for r in months],
+        [tuple(r) for r in categories],
+        start.isoformat(),
+        end.isoformat()
+    )
+    return json_result(summary)
+
+
+# Line item exports
+def trip_line(row) -> tuple:
+    description = row['purpose'] or " -> ".join(filter(None, [row['start_location'], row['end_location']]))
+    deduction = row['distance'] * IRS_RATE if row['is_business'] else 0.0
+    return (
+        "trip", row['trip_id'], row['start_time'].date().isoformat(),
+        "business" if row['is_business'] else "personal", description or "",
+        round(row['distance'], 2), "", round(deduction, 2)
+    )
+
+
+def expense_line(row) -> tuple:
+    return (
+        "expense", row['expense_id'], row['date'].date().isoformat(),
+        row['category'], row['notes'] or "", "", round(row['amount'], 2), round(row['amount'], 2)
+    )
+
+
+async def export_line_items(pool, user_id: str, start, end):
+    """Trip then expense line items, in batches read from server-side cursors."""
+    async with pool.acquire() as conn:
+        async with conn.transaction(isolation='repeatable_read', readonly=True):
+            for open_cursor, to_line in (
+                (repository.trip_export_cursor, trip_line),
+                (repository.expense_export_cursor, expense_line),
+            ):
+                cursor = await open_cursor(conn, user_id, start, end)
+                while True:
+                    rows = await cursor.fetch(EXPORT_BATCH_SIZE)
+                    if not rows:
+                        break
+                    yield [to_line(row) for row in rows]
+
+
+async def stream_csv(pool, user_id: str, start, end):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for lines in export_line_items(pool, user_id, start, end):
+        writer.writerows(lines)
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def pdf_line(line) -> str:
+    kind, _, date, category, description, miles, amount, deduction = line
+    return (
+        f"{date:<10} {kind:<7} {category[:12]:<12} {description[:40]:<40} "
+        f"{miles:>9} {amount:>10} {deduction:>10}"
+    )
+
+
+PDF_COLUMN_HEADER = pdf_line(("type", "", "date", "category", "description", "miles", "amount", "deduction"))
+
+
+async def stream_pdf(pool, user_id: str, start, end):
+    doc = PdfStream()
+    yield doc.header()
+
+    pages = []
+    page = [f"Tax report {start.date().isoformat()} to {end.date().isoformat()}", "", PDF_COLUMN_HEADER]
+
+    def add(text: str):
+        nonlocal page
+        if len(page) == LINES_PER_PAGE:
+            pages.append(page)
+            page = [PDF_COLUMN_HEADER]
+        page.append(text)
+
+    total_miles = business_miles = total_expenses = 0.0
+    async for lines in export_line_items(pool, user_id, start, end):
+        for line in lines:
+            if line[0] == "trip":
+                total_miles += line[5]
+                if line[3] == "business":
+                    business_miles += line[5]
+            else:
+                total_expenses += line[6]
+            add(pdf_line(line))
+        if len(pages) >= PDF_PAGES_PER_BATCH:
+            for content in await run_cpu(render_pages, pages):
+                yield doc.page(content)
+            pages = []
+
+    total_deduction = business_miles * IRS_RATE + total_expenses
+    for text in [
+        "",
+        f"Total miles:        {total_miles:,.2f}",
+        f"Business miles:     {business_miles:,.2f}",
+        f"Total expenses:     ${total_expenses:,.2f}",
+        f"Total deduction:    ${total_deduction:,.2f}",
+        f"Est. tax savings:   ${total_deduction * TAX_BRACKET:,.2f}",
+    ]:
+        add(text)
+    pages.append(page)
+
+    for content in await run_cpu(render_pages, pages):
+        yield doc.page(content)
+    yield doc.trailer()
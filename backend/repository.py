@@ -0,0 +1,376 @@
+"""SQL statements used by the API handlers.
+
+Every statement is a constant string with an explicit column list, so asyncpg's
+per-connection statement cache prepares each one once and reuses its plan.
+Writes return the stored row with RETURNING instead of re-reading it.
+
+This module holds the CRUD and report statements that the handlers and storage
+backends share. Modules owning one feature's tables or queries (search,
+trip_dedup, segmentation, archive, sync, jobs and the like) keep their SQL next
+to the code that uses it, and still write trips and expenses by id and user_id
+alone.
+"""
+
+# Money is stored as integer cents and distance as integer meters; the API keeps
+# dollars and miles, so values are converted here at the SQL edge. Meters are
+# fine enough that rounding back to 3 decimals returns the miles sent in.
+METERS_PER_MILE = 1609.344
+MILES = f"round(distance_m / {METERS_PER_MILE}, 3)::float8"
+DOLLARS = "amount_cents / 100.0::float8"
+
+
+def meters(miles: float) -> int:
+    return round(miles * METERS_PER_MILE)
+
+
+def cents(dollars: float) -> int:
+    return round(dollars * 100)
+
+
+def sum_miles(condition: str = "") -> str:
+    total = f"SUM(distance_m) {condition}".strip()
+    return f"COALESCE({total}, 0) / {METERS_PER_MILE}::float8"
+
+
+VEHICLE_COLUMNS = "vehicle_id, user_id, name, make, model, year, business_percentage, created_at"
+
+TRIP_COLUMNS = (
+    f"trip_id, user_id, vehicle_id, start_time, end_time, {MILES} AS distance, start_location, "
+    "end_location, purpose, is_business, is_automatic, created_at"
+)
+
+# Lists carry the receipt thumbnail; the original is fetched on demand
+RECEIPT_URL = (
+    "CASE WHEN receipt_thumbnail_base64 IS NOT NULL "
+    "THEN '/api/expenses/' || expense_id || '/receipt' END"
+)
+
+EXPENSE_COLUMNS = (
+    f"expense_id, user_id, vehicle_id, {DOLLARS} AS amount, category, date, notes, "
+    f"receipt_thumbnail_base64, {RECEIPT_URL} AS receipt_url, created_at"
+)
+
+TABLE_COLUMNS = {
+    "vehicles": VEHICLE_COLUMNS,
+    "trips": TRIP_COLUMNS,
+    "expenses": EXPENSE_COLUMNS,
+}
+
+LIST_LIMIT = 100
+
+# Fields a trip update may change, and their columns; unset fields are passed
+# as NULL and kept
+TRIP_UPDATE_FIELDS = {
+    "vehicle_id": "vehicle_id",
+    "start_time": "start_time",
+    "end_time": "end_time",
+    "distance": "distance_m",
+    "start_location": "start_location",
+    "end_location": "end_location",
+    "purpose": "purpose",
+    "is_business": "is_business",
+}
+
+UPDATE_TRIP = f"""
+    UPDATE trips SET
+        {", ".join(f"{column} = COALESCE(${i}, {column})" for i, column in enumerate(TRIP_UPDATE_FIELDS.values(), start=3))}
+    WHERE trip_id = $1 AND user_id = $2
+    RETURNING {TRIP_COLUMNS}
+"""
+
+
+# Users & sessions
+async def get_session_user(conn, token: str):
+    return await conn.fetchrow(
+        """SELECT u.user_id, u.email, u.name, u.picture, u.created_at, s.expires_at
+           FROM user_sessions s JOIN users u ON u.user_id = s.user_id
+           WHERE s.session_token = $1""",
+        token
+    )
+
+
+async def upsert_user(conn, user_id: str, email: str, name: str, picture):
+    """Create the user unless the email is known; returns the stored user_id."""
+    return await conn.fetchval(
+        """INSERT INTO users (user_id, email, name, picture) VALUES ($1, $2, $3, $4)
+           ON CONFLICT (email) DO UPDATE SET email = EXCLUDED.email
+           RETURNING user_id""",
+        user_id, email, name, picture
+    )
+
+
+async def create_session(conn, user_id: str, session_token: str, expires_at):
+    await conn.execute(
+        "INSERT INTO user_sessions (user_id, session_token, expires_at) VALUES ($1, $2, $3)",
+        user_id, session_token, expires_at
+    )
+
+
+async def delete_session(conn, session_token: str):
+    await conn.execute(
+        "DELETE FROM user_sessions WHERE session_token = $1",
+        session_token
+    )
+
+
+# Vehicles
+async def insert_vehicle(conn, vehicle_id: str, user_id: str, vehicle):
+    return await conn.fetchrow(
+        f"""INSERT INTO vehicles (vehicle_id, user_id, name, make, model, year, business_percentage)
+            VALUES ($1, $2, $3, $4, $5, $6, $7)
+            RETURNING {VEHICLE_COLUMNS}""",
+        vehicle_id, user_id, vehicle.name, vehicle.make,
+        vehicle.model, vehicle.year, vehicle.business_percentage
+    )
+
+
+async def list_vehicles(conn, user_id: str):
+    return await conn.fetch(
+        f"SELECT {VEHICLE_COLUMNS} FROM vehicles WHERE user_id = $1 ORDER BY created_at DESC",
+        user_id
+    )
+
+
+async def delete_vehicle(conn, vehicle_id: str, user_id: str) -> bool:
+    result = await conn.execute(
+        "DELETE FROM vehicles WHERE vehicle_id = $1 AND user_id = $2",
+        vehicle_id, user_id
+    )
+    return result != "DELETE 0"
+
+
+# Trips
+async def insert_trip(conn, trip_id: str, user_id: str, trip):
+    return await conn.fetchrow(
+        f"""INSERT INTO trips (trip_id, user_id, vehicle_id, start_time, end_time,
+            distance_m, start_location, end_location, purpose, is_business, is_automatic)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)
+            RETURNING {TRIP_COLUMNS}""",
+        trip_id, user_id, trip.vehicle_id, trip.start_time,
+        trip.end_time, meters(trip.distance), trip.start_location, trip.end_location,
+        trip.purpose, trip.is_business, trip.is_automatic
+    )
+
+
+async def list_trips(conn, user_id: str):
+    return await conn.fetch(
+        f"SELECT {TRIP_COLUMNS} FROM trips WHERE user_id = $1 ORDER BY start_time DESC LIMIT {LIST_LIMIT}",
+        user_id
+    )
+
+
+async def get_open_trip(conn, trip_id: str, user_id: str):
+    return await conn.fetchrow(
+        f"SELECT {TRIP_COLUMNS} FROM trips WHERE trip_id = $1 AND user_id = $2 AND end_time IS NULL",
+        trip_id, user_id
+    )
+
+
+async def update_trip(conn, trip_id: str, user_id: str, fields: dict):
+    if fields.get("distance") is not None:
+        fields = {**fields, "distance": meters(fields["distance"])}
+    return await conn.fetchrow(
+        UPDATE_TRIP,
+        trip_id, user_id, *(fields.get(field) for field in TRIP_UPDATE_FIELDS)
+    )
+
+
+async def finish_trip(conn, trip_id: str, user_id: str, distance: float, end_time, end_location):
+    return await conn.fetchrow(
+        f"""UPDATE trips SET distance_m = $1, end_time = $2, end_location = COALESCE($3, end_location)
+            WHERE trip_id = $4 AND user_id = $5
+            RETURNING {TRIP_COLUMNS}""",
+        meters(distance), end_time, end_location, trip_id, user_id
+    )
+
+
+async def insert_detected_trips(conn, user_id: str, trips):
+    """Insert segmented trips given as (trip_id, start, end, miles, start_location, end_location)."""
+    trip_ids, starts, ends, distances, start_locations, end_locations = zip(*trips)
+    return await conn.fetch(
+        f"""INSERT INTO trips (trip_id, user_id, start_time, end_time, distance_m,
+            start_location, end_location, is_automatic)
+            SELECT t.trip_id, $1, t.start_time, t.end_time, t.distance_m,
+                   t.start_location, t.end_location, TRUE
+            FROM unnest($2::varchar[], $3::timestamptz[], $4::timestamptz[], $5::int[],
+                        $6::text[], $7::text[])
+                 AS t(trip_id, start_time, end_time, distance_m, start_location, end_location)
+            RETURNING {TRIP_COLUMNS}""",
+        user_id, list(trip_ids), list(starts), list(ends), [meters(d) for d in distances],
+        list(start_locations), list(end_locations)
+    )
+
+
+async def update_trip_distances(conn, trip_ids, user_ids, distances):
+    # Not keyed on start_time: an edit can move the trip while it is being tracked
+    await conn.execute(
+        """UPDATE trips SET distance_m = v.distance_m
+           FROM unnest($1::varchar[], $2::varchar[], $3::int[])
+                AS v(trip_id, user_id, distance_m)
+           WHERE trips.trip_id = v.trip_id AND trips.user_id = v.user_id""",
+        trip_ids, user_ids, [meters(d) for d in distances]
+    )
+
+
+async def delete_trip(conn, trip_id: str, user_id: str) -> bool:
+    result = await conn.execute(
+        "DELETE FROM trips WHERE trip_id = $1 AND user_id = $2",
+        trip_id, user_id
+    )
+    return result != "DELETE 0"
+
+
+async def count_auto_trips_since(conn, user_id: str, since):
+    return await conn.fetchval(
+        "SELECT COUNT(*) FROM trips WHERE user_id = $1 AND is_automatic = TRUE AND created_at >= $2",
+        user_id, since
+    )
+
+
+# Expenses
+async def insert_expense(conn, expense_id: str, user_id: str, expense, receipt=None, thumbnail=None):
+    return await conn.fetchrow(
+        f"""INSERT INTO expenses (expense_id, user_id, vehicle_id, amount_cents, category,
+            date, notes, receipt_image_base64, receipt_thumbnail_base64)
+            VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9)
+            RETURNING {EXPENSE_COLUMNS}""",
+        expense_id, user_id, expense.vehicle_id, cents(expense.amount),
+        expense.category, expense.date, expense.notes, receipt, thumbnail
+    )
+
+
+async def list_expenses(conn, user_id: str):
+    return await conn.fetch(
+        f"SELECT {EXPENSE_COLUMNS} FROM expenses WHERE user_id = $1 ORDER BY date DESC LIMIT {LIST_LIMIT}",
+        user_id
+    )
+
+
+async def delete_expense(conn, expense_id: str, user_id: str) -> bool:
+    result = await conn.execute(
+        "DELETE FROM expenses WHERE expense_id = $1 AND user_id = $2",
+        expense_id, user_id
+    )
+    return result != "DELETE 0"
+
+
+# Dashboard & reports
+async def dashboard_totals(conn, user_id: str, month_start, year_start):
+    return await conn.fetchrow(
+        f"""SELECT t.month_miles, t.year_miles, e.total_expenses
+           FROM (SELECT {sum_miles("FILTER (WHERE start_time >= $2)")} AS month_miles,
+                        {sum_miles()} AS year_miles
+                 FROM trips WHERE user_id = $1 AND is_business = TRUE AND start_time >= $3) t,
+                (SELECT COALESCE(SUM(amount_cents), 0) / 100.0::float8 AS total_expenses
+                 FROM expenses WHERE user_id = $1 AND date >= $3) e""",
+        user_id, month_start, year_start
+    )
+
+
+async def tax_report_totals(conn, user_id: str, start, end):
+    return await conn.fetchrow(
+        f"""SELECT t.total_miles, t.business_miles, e.total_expenses
+           FROM (SELECT {sum_miles()} AS total_miles,
+                        {sum_miles("FILTER (WHERE is_business = TRUE)")} AS business_miles
+                 FROM trips WHERE user_id = $1 AND start_time BETWEEN $2 AND $3) t,
+                (SELECT COALESCE(SUM(amount_cents), 0) / 100.0::float8 AS total_expenses
+                 FROM expenses WHERE user_id = $1 AND date BETWEEN $2 AND $3) e""",
+        user_id, start, end
+    )
+
+
+async def monthly_trip_totals(conn, user_id: str, start, end):
+    return await conn.fetch(
+        f"""SELECT to_char(date_trunc('month', start_time), 'YYYY-MM') AS month,
+                  {sum_miles()} AS total_miles,
+                  {sum_miles("FILTER (WHERE is_business = TRUE)")} AS business_miles,
+                  COUNT(*) AS trip_count
+           FROM trips WHERE user_id = $1 AND start_time BETWEEN $2 AND $3
+           GROUP BY 1""",
+        user_id, start, end
+    )
+
+
+async def monthly_expense_totals(conn, user_id: str, start, end):
+    return await conn.fetch(
+        """SELECT to_char(date_trunc('month', date), 'YYYY-MM') AS month, category,
+                  SUM(amount_cents) / 100.0::float8 AS amount
+           FROM expenses WHERE user_id = $1 AND date BETWEEN $2 AND $3
+           GROUP BY 1, 2""",
+        user_id, start, end
+    )
+
+
+# Analytics: metric -> (table, time column, aggregate)
+TIMESERIES_METRICS = {
+    "miles": ("trips", "start_time", sum_miles()),
+    "business_miles": ("trips", "start_time", sum_miles("FILTER (WHERE is_business = TRUE)")),
+    "trips": ("trips", "start_time", "COUNT(*)::float8"),
+    "expenses": ("expenses", "date", "SUM(amount_cents) / 100.0::float8"),
+}
+
+# Series a metric can be split into; None is a single series
+TIMESERIES_SERIES = {
+    None: "'total'",
+    "vehicle": "vehicle_id",
+    "category": "category",
+    "business": "CASE WHEN is_business THEN 'business' ELSE 'personal' END",
+}
+
+
+async def change_seq(conn, user_id: str) -> int:
+    return await conn.fetchval(
+        "SELECT COALESCE((SELECT seq FROM sync_state WHERE user_id = $1), 0)", user_id
+    )
+
+
+async def timeseries(conn, user_id: str, metric: str, bucket: str, group_by, start, end):
+    table, column, value = TIMESERIES_METRICS[metric]
+    return await conn.fetch(
+        f"""SELECT date_trunc($4, {column}, 'UTC') AS bucket, {TIMESERIES_SERIES[group_by]} AS series,
+                  {value} AS value
+           FROM {table} WHERE user_id = $1 AND {column} >= $2 AND {column} < $3
+           GROUP BY 1, 2""",
+        user_id, start, end, bucket
+    )
+
+
+# Server-side cursors for exports; must be opened inside a transaction
+async def trip_export_cursor(conn, user_id: str, start, end):
+    return await conn.cursor(
+        f"""SELECT trip_id, start_time, start_location, end_location, purpose, {MILES} AS distance, is_business
+           FROM trips WHERE user_id = $1 AND start_time BETWEEN $2 AND $3
+           ORDER BY start_time""",
+        user_id, start, end
+    )
+
+
+async def expense_export_cursor(conn, user_id: str, start, end):
+    return await conn.cursor(
+        f"""SELECT expense_id, date, category, notes, {DOLLARS} AS amount
+           FROM expenses WHERE user_id = $1 AND date BETWEEN $2 AND $3
+           ORDER BY date""",
+        user_id, start, end
+    )
+
+
+# Subscriptions
+async def get_active_plan(conn, user_id: str):
+    return await conn.fetchval(
+        "SELECT plan_type FROM subscriptions WHERE user_id = $1 AND status = 'active' ORDER BY created_at DESC LIMIT 1",
+        user_id
+    )
+
+
+async def create_subscription(conn, subscription_id: str, user_id: str, plan_type: str):
+    await conn.execute(
+        "INSERT INTO subscriptions (subscription_id, user_id, plan_type, status) VALUES ($1, $2, $3, 'active')",
+        subscription_id, user_id, plan_type
+    )
+
+
+async def cancel_subscriptions(conn, user_id: str):
+    await conn.execute(
+        "UPDATE subscriptions SET status = 'cancelled', end_date = NOW() WHERE user_id = $1 AND status = 'active'",
+        user_id
+    )
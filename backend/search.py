@@ -0,0 +1,175 @@
+"""Ranked full-text and fuzzy search over a user's trips and expenses.
+
+Full-text matching uses GIN indexes on tsvector expressions, so no stored
+column has to be added (and no table rewritten) on existing installs. When the
+pg_trgm extension is available, trigram GIN indexes on the same text add typo
+and partial-word matches ranked by word similarity.
+
+The indexes lead with user_id (a btree_gin column), so a search only visits
+the caller's entries. They are built by `migrate` with CREATE INDEX
+CONCURRENTLY, never at startup; on a partitioned table each partition's index
+is built concurrently and attached to one created ON ONLY the parent. Fuzzy
+matching is used on each database once its trigram indexes are valid.
+
+`migrate` runs on the primary and every shard in SHARD_DATABASE_URLS.
+
+Usage:
+    python search.py migrate    # build the search indexes without blocking writes
+"""
+import argparse
+import asyncio
+import logging
+from pathlib import Path
+
+from partitioning import is_partitioned
+from repository import DOLLARS, MILES
+from sharding import cli_router
+
+logger = logging.getLogger(__name__)
+
+TEXT_SEARCH_CONFIG = "simple"
+
+TRIP_TEXT = "(coalesce(purpose, '') || ' ' || coalesce(start_location, '') || ' ' || coalesce(end_location, ''))"
+EXPENSE_TEXT = "(coalesce(notes, '') || ' ' || category)"
+
+TRIP_VECTOR = f"to_tsvector('{TEXT_SEARCH_CONFIG}', {TRIP_TEXT})"
+EXPENSE_VECTOR = f"to_tsvector('{TEXT_SEARCH_CONFIG}', {EXPENSE_TEXT})"
+
+MAX_PAGE_SIZE = 100
+
+# (table, index, GIN columns, extensions it needs)
+SEARCH_INDEXES = [
+    ("trips", "idx_trips_user_search", f"user_id, ({TRIP_VECTOR})", ("btree_gin",)),
+    ("expenses", "idx_expenses_user_search", f"user_id, ({EXPENSE_VECTOR})", ("btree_gin",)),
+    ("trips", "idx_trips_user_search_trgm", f"user_id, {TRIP_TEXT} gin_trgm_ops", ("btree_gin", "pg_trgm")),
+    ("expenses", "idx_expenses_user_search_trgm", f"user_id, {EXPENSE_TEXT} gin_trgm_ops", ("btree_gin", "pg_trgm")),
+]
+
+TRIGRAM_INDEXES = [name for _, name, _, extensions in SEARCH_INDEXES if "pg_trgm" in extensions]
+
+# Single-column indexes from before user_id led them
+LEGACY_INDEXES = ["idx_trips_search", "idx_expenses_search", "idx_trips_search_trgm", "idx_expenses_search_trgm"]
+
+
+async def index_valid(conn, name: str):
+    """True/False once the index exists, None before; an interrupted concurrent build leaves it invalid."""
+    return await conn.fetchval("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass($1)", name)
+
+
+async def create_index_concurrently(conn, table: str, name: str, columns: str):
+    if await index_valid(conn, name) is False:
+        await conn.execute(f"DROP INDEX CONCURRENTLY {name}")
+    await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} USING GIN ({columns})")
+
+
+async def build_search_index(conn, table: str, name: str, columns: str):
+    indexed = await conn.fetchval("SELECT indrelid::regclass::text FROM pg_index WHERE indexrelid = to_regclass($1)", name)
+    if indexed == table and await index_valid(conn, name):
+        return
+    if not await is_partitioned(conn, table):
+        await create_index_concurrently(conn, table, name, columns)
+        return
+    if indexed and indexed != table:
+        # Built before the table was partitioned; it now belongs to the legacy partition
+        await conn.execute(f"ALTER INDEX {name} RENAME TO {name}_{indexed.removeprefix(f'{table}_')}")
+
+    # Invalid until every partition has its index attached; partitions created meanwhile get one built
+    await conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON ONLY {table} USING GIN ({columns})")
+    partitions = await conn.fetch(
+        """SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+           WHERE i.inhparent = $1::regclass
+             AND NOT EXISTS (SELECT 1 FROM pg_inherits x JOIN pg_index p ON p.indexrelid = x.inhrelid
+                             WHERE x.inhparent = to_regclass($2) AND p.indrelid = c.oid)""",
+        table, name
+    )
+    for partition in partitions:
+        index = f"{name}_{partition['name'].removeprefix(f'{table}_')}"
+        await create_index_concurrently(conn, partition['name'], index, columns)
+        await conn.execute(f"ALTER INDEX {name} ATTACH PARTITION {index}")
+    logger.info(f"Built {name} on {len(partitions)} partitions of {table}")
+
+
+async def install_search_indexes(conn):
+    """Build the search indexes that are missing, then drop the ones they replace."""
+    available = set()
+    for extension in ("btree_gin", "pg_trgm"):
+        try:
+            await conn.execute(f"CREATE EXTENSION IF NOT EXISTS {extension}")
+            available.add(extension)
+        except Exception as e:
+            logger.warning(f"{extension} unavailable, its search indexes are skipped: {e}")
+
+    for table, name, columns, extensions in SEARCH_INDEXES:
+        if available.issuperset(extensions):
+            await build_search_index(conn, table, name, columns)
+
+    for name in LEGACY_INDEXES:
+        await conn.execute(f"DROP INDEX IF EXISTS {name}")
+
+
+async def fuzzy_search_enabled(conn) -> bool:
+    # Per database: shards are migrated one by one, and may lack pg_trgm altogether
+    return await conn.fetchval(
+        """SELECT bool_and(COALESCE(indisvalid, false))
+           FROM unnest($1::text[]) AS name LEFT JOIN pg_index ON indexrelid = to_regclass(name)""",
+        TRIGRAM_INDEXES
+    )
+
+
+def _search_query(fuzzy: bool) -> str:
+    def match(vector, text):
+        return f"({vector} @@ query OR $2 <% {text})" if fuzzy else f"{vector} @@ query"
+
+    def rank(vector, text):
+        return f"ts_rank({vector}, query) + word_similarity($2, {text})" if fuzzy else f"ts_rank({vector}, query)"
+
+    return f"""
+        SELECT kind, id, date, value, title, detail, rank FROM (
+            SELECT 'trip' AS kind, trip_id AS id, start_time AS date, {MILES} AS value,
+                   purpose AS title, concat_ws(' -> ', start_location, end_location) AS detail,
+                   {rank(TRIP_VECTOR, TRIP_TEXT)} AS rank
+            FROM trips, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', $2) AS query
+            WHERE user_id = $1 AND {match(TRIP_VECTOR, TRIP_TEXT)}
+            UNION ALL
+            SELECT 'expense', expense_id, date, {DOLLARS}, category, notes,
+                   {rank(EXPENSE_VECTOR, EXPENSE_TEXT)}
+            FROM expenses, websearch_to_tsquery('{TEXT_SEARCH_CONFIG}', $2) AS query
+            WHERE user_id = $1 AND {match(EXPENSE_VECTOR, EXPENSE_TEXT)}
+        ) hits
+        ORDER BY rank DESC, date DESC
+        LIMIT $3 OFFSET $4
+    """
+
+
+SEARCH = _search_query(fuzzy=False)
+FUZZY_SEARCH = _search_query(fuzzy=True)
+
+
+async def run_search(conn, user_id: str, q: str, limit: int, offset: int):
+    """One page of ranked hits, plus whether more follow."""
+    rows = await conn.fetch(
+        FUZZY_SEARCH if await fuzzy_search_enabled(conn) else SEARCH,
+        user_id, q, limit + 1, offset
+    )
+    return rows[:limit], len(rows) > limit
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search indexes")
+    sub = parser.add_subparsers(dest="command", required=True)
+    sub.add_parser("migrate", help="build the user_id-led search indexes concurrently")
+    parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / '.env')
+
+    async with cli_router() as router:
+        for name, pool in router.pools.items():
+            logger.info(f"Shard {name}")
+            async with pool.acquire() as conn:
+                await install_search_indexes(conn)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
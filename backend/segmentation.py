@@ -0,0 +1,217 @@
+"""Server-side trip segmentation of raw location streams.
+
+Clients upload timestamped GPS fixes, which are stored in `location_fixes`. A
+user's stream is split into trips at stops: a fix starts a stop when every fix
+from it until DWELL_SECONDS later lies within STOP_RADIUS_METERS of one point.
+Everything runs as NumPy array operations. Window extents come from a sparse
+table of range minima/maxima, so no step loops over individual fixes.
+
+Segmentation is incremental. Each user keeps an anchor, the last fix known to
+be part of a stop, and a run only reads fixes from the anchor onward. That is
+the current stop or open trip plus whatever arrived since. Closed trips are
+written with is_automatic = TRUE.
+"""
+import logging
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import repository
+from live_tracking import EARTH_RADIUS_MILES, MAX_SPEED_MPH
+from startup import lazy_import
+
+# Loaded by the first location upload rather than at server start
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+STOP_RADIUS_METERS = float(os.getenv("SEGMENT_STOP_RADIUS_METERS", "100"))
+DWELL_SECONDS = float(os.getenv("SEGMENT_DWELL_SECONDS", str(5 * 60)))
+
+# Shorter movements between stops are GPS drift, not trips
+MIN_TRIP_MILES = 0.2
+MIN_TRIP_SECONDS = 2 * 60
+
+# Largest batch of fixes accepted in one upload
+MAX_FIXES_PER_UPLOAD = 5000
+
+# Raw fixes are kept this long behind the anchor
+FIX_RETENTION_DAYS = int(os.getenv("LOCATION_FIX_RETENTION_DAYS", "30"))
+
+METERS_PER_DEGREE = 111_320.0
+
+EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+
+async def install_location_fixes(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS location_fixes (
+            user_id VARCHAR(255) NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            recorded_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            lat DOUBLE PRECISION NOT NULL,
+            lng DOUBLE PRECISION NOT NULL,
+            PRIMARY KEY (user_id, recorded_at)
+        )
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS segmentation_state (
+            user_id VARCHAR(255) PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            anchor_at TIMESTAMP WITH TIME ZONE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+
+
+def haversine_miles(lat1, lng1, lat2, lng2):
+    phi1, phi2 = np.radians(lat1), np.radians(lat2)
+    a = (
+        np.sin((phi2 - phi1) / 2) ** 2
+        + np.cos(phi1) * np.cos(phi2) * np.sin(np.radians(lng2 - lng1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_MILES * np.arcsin(np.sqrt(a))
+
+
+def drop_spikes(t, lat, lng):
+    """Mask out fixes that jump away and straight back faster than MAX_SPEED_MPH."""
+    keep = np.ones(len(t), dtype=bool)
+    if len(t) > 2:
+        speed = haversine_miles(lat[:-1], lng[:-1], lat[1:], lng[1:]) / (np.diff(t) / 3600)
+        fast = speed > MAX_SPEED_MPH
+        keep[1:-1] = ~(fast[:-1] & fast[1:])
+    return keep
+
+
+def range_extrema(values, starts, ends):
+    """Min and max of values[starts[k]:ends[k] + 1] for every k, from a sparse table."""
+    lengths = ends - starts + 1
+    levels = np.floor(np.log2(lengths)).astype(np.intp)
+    lows, highs = [values], [values]
+    for level in range(1, int(levels.max()) + 1):
+        half = 1 << (level - 1)
+        lows.append(np.minimum(lows[-1][:-half], lows[-1][half:]))
+        highs.append(np.maximum(highs[-1][:-half], highs[-1][half:]))
+
+    window_min = np.empty(len(starts))
+    window_max = np.empty(len(starts))
+    for level in np.unique(levels):
+        # Two overlapping power-of-two blocks cover each window
+        k = levels == level
+        tail = ends[k] - (1 << level) + 1
+        window_min[k] = np.minimum(lows[level][starts[k]], lows[level][tail])
+        window_max[k] = np.maximum(highs[level][starts[k]], highs[level][tail])
+    return window_min, window_max
+
+
+def stationary_mask(t, lat, lng):
+    """True for fixes inside a stop; the first fix is taken to be one."""
+    n = len(t)
+    ends = np.searchsorted(t, t + DWELL_SECONDS)
+    starts = np.nonzero(ends < n)[0]
+    stationary = np.zeros(n, dtype=bool)
+    stationary[0] = True
+    if not len(starts):
+        return stationary
+    ends = ends[starts]
+
+    lat_min, lat_max = range_extrema(lat, starts, ends)
+    lng_min, lng_max = range_extrema(lng, starts, ends)
+    height = (lat_max - lat_min) * METERS_PER_DEGREE
+    width = (lng_max - lng_min) * METERS_PER_DEGREE * np.cos(np.radians(lat[starts]))
+    # A bounding box whose diagonal fits the diameter fits inside the circle
+    dwell = np.hypot(height, width) <= 2 * STOP_RADIUS_METERS
+
+    coverage = np.bincount(starts[dwell], minlength=n + 1) - np.bincount(ends[dwell] + 1, minlength=n + 1)
+    stationary |= np.cumsum(coverage[:n]) > 0
+    return stationary
+
+
+def segment_fixes(t, lat, lng):
+    """Split time-ordered fixes into trips.
+
+    Returns ([(start index, end index, miles)], anchor index). A trip runs from
+    the last fix of one stop to the first fix of the next; movement that has
+    not reached a stop yet is left open after the anchor.
+    """
+    stationary = stationary_mask(t, lat, lng)
+    miles = np.concatenate(([0.0], np.cumsum(haversine_miles(lat[:-1], lng[:-1], lat[1:], lng[1:]))))
+
+    edges = np.diff(stationary.astype(np.int8))
+    departures = np.nonzero(edges == -1)[0]
+    arrivals = np.nonzero(edges == 1)[0] + 1
+    departures = departures[:len(arrivals)]
+
+    distances = miles[arrivals] - miles[departures]
+    real = (distances >= MIN_TRIP_MILES) & (t[arrivals] - t[departures] >= MIN_TRIP_SECONDS)
+    trips = list(zip(departures[real].tolist(), arrivals[real].tolist(), distances[real].tolist()))
+    return trips, int(np.nonzero(stationary)[0][-1])
+
+
+async def store_fixes(conn, user_id: str, fixes) -> int:
+    """Store [lat, lng, epoch_seconds] fixes; resent fixes are ignored."""
+    result = await conn.execute(
+        """INSERT INTO location_fixes (user_id, recorded_at, lat, lng)
+           SELECT $1, to_timestamp(f.ts), f.lat, f.lng
+           FROM unnest($2::float8[], $3::float8[], $4::float8[]) AS f(lat, lng, ts)
+           ON CONFLICT DO NOTHING""",
+        user_id, [f[0] for f in fixes], [f[1] for f in fixes], [f[2] for f in fixes]
+    )
+    return int(result.split()[-1])
+
+
+def location_label(lat: float, lng: float) -> str:
+    return f"{lat:.5f},{lng:.5f}"
+
+
+async def segment_user(conn, user_id: str):
+    """Segment the user's fixes since the anchor, returning the trips written."""
+    async with conn.transaction():
+        # The state row lock serializes runs for the same user
+        await conn.execute(
+            "INSERT INTO segmentation_state (user_id) VALUES ($1) ON CONFLICT DO NOTHING",
+            user_id
+        )
+        anchor_at = await conn.fetchval(
+            "SELECT anchor_at FROM segmentation_state WHERE user_id = $1 FOR UPDATE",
+            user_id
+        )
+        micros, lat, lng = await conn.fetchrow(
+            """SELECT array_agg((extract(epoch FROM recorded_at) * 1000000)::int8 ORDER BY recorded_at),
+                      array_agg(lat ORDER BY recorded_at),
+                      array_agg(lng ORDER BY recorded_at)
+               FROM location_fixes
+               WHERE user_id = $1 AND recorded_at >= coalesce($2, '-infinity'::timestamptz)""",
+            user_id, anchor_at
+        )
+        if not micros:
+            return []
+
+        micros, lat, lng = np.asarray(micros), np.asarray(lat), np.asarray(lng)
+        t = micros / 1e6
+        keep = drop_spikes(t, lat, lng)
+        micros, t, lat, lng = micros[keep], t[keep], lat[keep], lng[keep]
+        trips, anchor = segment_fixes(t, lat, lng)
+
+        def at(i):
+            return EPOCH + timedelta(microseconds=int(micros[i]))
+
+        rows = []
+        if trips:
+            rows = await repository.insert_detected_trips(conn, user_id, [
+                (f"trip_{uuid.uuid4().hex[:12]}", at(start), at(end), distance,
+                 location_label(lat[start], lng[start]), location_label(lat[end], lng[end]))
+                for start, end, distance in trips
+            ])
+
+        await conn.execute(
+            "UPDATE segmentation_state SET anchor_at = $2, updated_at = NOW() WHERE user_id = $1",
+            user_id, at(anchor)
+        )
+        await conn.execute(
+            """DELETE FROM location_fixes
+               WHERE user_id = $1 AND recorded_at < $2::timestamptz - make_interval(days => $3)""",
+            user_id, at(anchor), FIX_RETENTION_DAYS
+        )
+
+    if rows:
+        logger.info(f"Detected {len(rows)} trips for {user_id} from {len(t)} fixes")
+    return rows
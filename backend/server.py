@@ -1,47 +1,149 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, Request, Cookie
-from fastapi.responses import JSONResponse
+# First, so the startup report times every import below
+from startup import lazy_import, startup_timer
+from fastapi import FastAPI, APIRouter, HTTPException, Depends, Response, Request, Cookie, WebSocket, WebSocketDisconnect, UploadFile, File
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import os
 import logging
+import secrets
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Tuple, Union
 import uuid
 from datetime import datetime, timezone, timedelta
 import asyncpg
-import httpx
 from contextlib import asynccontextmanager
-from passlib.context import CryptContext
-from jose import JWTError, jwt
-import random
-import string
+import asyncio
+import repository
+from partitioning import PARTITIONED_TABLES, create_partitioned_table, ensure_partitions, maintain_partitions
+from compact_types import pending_compact_types
+from sync import install_change_log, fetch_changes
+from live_tracking import live_trips, MAX_FIXES_PER_MESSAGE
+from segmentation import MAX_FIXES_PER_UPLOAD, install_location_fixes, segment_user, store_fixes
+from search import run_search, MAX_PAGE_SIZE
+from idempotency import IdempotencyMiddleware, install_idempotency_keys, expire_idempotency_keys
+from jobs import install_jobs, enqueue_job, get_job, get_job_result, job_runner, validate_params
+import reports
+import archive
+import analytics
+import receipts
+from receipts import install_receipt_thumbnails
+from sharding import install_shard_directory, shard_router
+from storage import STORAGE_BACKEND, MemoryStorage, PostgresStorage
+import zipfile
+import metrics
+from singleflight import single_flight
+from load_shedding import LoadSheddingMiddleware, create_pool
+from compression import CompressionMiddleware
+from sessions import install_session_indexes, sweep_sessions
+from rate_limit import RATE_LIMIT_BACKEND, install_rate_limits, rate_limiter
+from health import close_pool, health_monitor, install_schema_version
+import logs
+from logs import RequestLogMiddleware, configure_logging
+
+# Only used by the OAuth session exchange
+httpx = lazy_import("httpx")
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
+startup_timer.mark("imports")
 
 # Database connection pool
 db_pool = None
 
+# Seconds a request waits for warm-up before being turned away
+WARM_UP_WAIT_SECONDS = 10
+WARM_UP_RETRY_SECONDS = 5
+
+# Scrapers send it as a bearer token; while unset, /api/metrics is off
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+warm_up_task = None
+background_tasks = []
+
 async def get_db_pool():
-    global db_pool
-    if db_pool is None:
-        db_pool = await asyncpg.create_pool(
-            os.environ['DATABASE_URL'],
-            min_size=2,
-            max_size=10
-        )
+    if STORAGE_BACKEND == "memory":
+        raise HTTPException(status_code=501, detail="Not available with the in-memory storage backend")
+    if not startup_timer.ready:
+        # Requests arriving during warm-up wait for it, up to a bound
+        try:
+            await asyncio.wait_for(asyncio.shield(start_warm_up()), WARM_UP_WAIT_SECONDS)
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=503, detail="Server is starting", headers={"Retry-After": str(WARM_UP_RETRY_SECONDS)})
     return db_pool
 
+async def get_user_pool(user_id: str):
+    """Pool of the shard holding the user's data"""
+    await get_db_pool()
+    return await shard_router.pool_for(user_id)
+
+# Users, sessions, vehicles, trips, expenses and subscriptions
+storage = MemoryStorage() if STORAGE_BACKEND == "memory" else PostgresStorage(get_db_pool, get_user_pool)
+
+def start_warm_up():
+    global warm_up_task
+    if warm_up_task is None:
+        warm_up_task = asyncio.ensure_future(warm_up())
+    return warm_up_task
+
+async def warm_up():
+    """Pools, schema and background work, retried until the database answers"""
+    global db_pool
+    while True:
+        try:
+            if db_pool is None:
+                # Bounded acquire waits and per-route statement timeouts
+                db_pool = await create_pool(
+                    os.environ['DATABASE_URL'],
+                    min_size=2,
+                    max_size=10
+                )
+            await shard_router.start(db_pool, lambda url: create_pool(url, min_size=2, max_size=10))
+            startup_timer.mark("pool")
+            await init_db()
+            startup_timer.mark("schema")
+            # Readiness has a ping result as soon as warm-up finishes
+            await health_monitor.check(shard_router.pools)
+            break
+        except Exception as e:
+            logger.error(f"Warm-up failed, retrying in {WARM_UP_RETRY_SECONDS}s: {e}")
+            await asyncio.sleep(WARM_UP_RETRY_SECONDS)
+            startup_timer.mark("retries")
+    
+    background_tasks.extend(asyncio.create_task(maintain_partitions(pool)) for pool in shard_router.all_pools())
+    background_tasks.append(asyncio.create_task(live_trips.run(shard_router.pool_for)))
+    background_tasks.append(asyncio.create_task(expire_idempotency_keys(db_pool)))
+    background_tasks.append(asyncio.create_task(sweep_sessions(db_pool)))
+    background_tasks.append(asyncio.create_task(health_monitor.run(lambda: dict(shard_router.pools))))
+    job_runner.start(db_pool, shard_router.pool_for)
+    startup_timer.finish()
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup
-    await get_db_pool()
-    await init_db()
+    if STORAGE_BACKEND == "memory":
+        # No database, so no schema or background work
+        startup_timer.finish()
+        yield
+        health_monitor.draining = True
+        await job_runner.stop()
+        return
+    # Startup: serve (health reports not ready) while pools and schema come up
+    if RATE_LIMIT_BACKEND == "postgres":
+        rate_limiter.use_postgres(get_db_pool)
+    start_warm_up()
     yield
-    # Shutdown
+    # Shutdown: readiness reports draining while connections are given back
+    health_monitor.draining = True
+    warm_up_task.cancel()
+    for task in background_tasks:
+        task.cancel()
+    await job_runner.stop()
+    if startup_timer.ready:
+        await live_trips.write_all(shard_router.pool_for)
+    await shard_router.close()
     if db_pool:
-        await db_pool.close()
+        await close_pool(db_pool)
 
 # Create the main app
 app = FastAPI(lifespan=lifespan)
@@ -56,16 +158,36 @@ async def root():
 
 @api_router.get("/health")
 async def health_check():
-    return {"status": "healthy", "database": "postgresql"}
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
-logger = logging.getLogger(__name__)
+    return {
+        "status": "healthy",
+        "database": "postgresql" if STORAGE_BACKEND == "postgres" else STORAGE_BACKEND,
+        "startup": startup_timer.report()
+    }
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+@api_router.get("/health/live")
+async def liveness():
+    # Answering at all is the signal; a database outage is not fixed by a restart
+    return {"status": "alive"}
+
+@api_router.get("/health/ready")
+async def readiness():
+    # Cached ping results only, so probes add no database load
+    if STORAGE_BACKEND == "memory":
+        ready, body = health_monitor.readiness(startup_timer.ready, {})
+    else:
+        ready, body = health_monitor.readiness(startup_timer.ready, shard_router.pools)
+    return JSONResponse(body, status_code=200 if ready else 503)
+
+@api_router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not secrets.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+        raise HTTPException(status_code=401, detail="Invalid metrics token", headers={"WWW-Authenticate": "Bearer"})
+    return metrics.render()
+# Configure logging: JSON records written by a background thread
+configure_logging()
+logger = logging.getLogger(__name__)
 
 # JWT settings
 SECRET_KEY = os.getenv("JWT_SECRET_KEY", "your-secret-key-change-in-production")
@@ -147,7 +269,8 @@ class Expense(BaseModel):
     category: str
     date: datetime
     notes: Optional[str] = None
-    receipt_image_base64: Optional[str] = None
+    receipt_thumbnail_base64: Optional[str] = None
+    receipt_url: Optional[str] = None
     created_at: datetime
 
 class ExpenseCreate(BaseModel):
@@ -158,6 +281,11 @@ class ExpenseCreate(BaseModel):
     notes: Optional[str] = None
     receipt_image_base64: Optional[str] = None
 
+class Columns(BaseModel):
+    """Columnar list shape: field names once, then one value array per item."""
+    columns: List[str]
+    rows: List[List[Any]]
+
 class TaxReport(BaseModel):
     total_miles: float
     business_miles: float
@@ -167,6 +295,14 @@ class TaxReport(BaseModel):
     period_start: datetime
     period_end: datetime
 
+class SyncChanges(BaseModel):
+    cursor: str
+    has_more: bool
+    vehicles: List[Vehicle]
+    trips: List[Trip]
+    expenses: List[Expense]
+    deleted: Dict[str, List[str]]
+
 class SubscriptionStatus(BaseModel):
     plan_type: str
     is_active: bool
@@ -174,93 +310,142 @@ class SubscriptionStatus(BaseModel):
     usage: Optional[dict] = None
     limits: Optional[dict] = None
 
+class SearchHit(BaseModel):
+    kind: str
+    id: str
+    date: datetime
+    value: float
+    title: Optional[str] = None
+    detail: Optional[str] = None
+    rank: float
+
+class SearchResults(BaseModel):
+    query: str
+    results: List[SearchHit]
+    limit: int
+    offset: int
+    has_more: bool
+
+class BootstrapPayload(BaseModel):
+    user: User
+    vehicles: List[Vehicle]
+    subscription: SubscriptionStatus
+    dashboard: dict
+    plans: List[dict]
+
+class JobCreate(BaseModel):
+    kind: str
+    params: dict = {}
+
+class LocationBatch(BaseModel):
+    fixes: List[Tuple[float, float, float]]
+
+class LocationUpload(BaseModel):
+    stored: int
+    trips: List[Trip]
+
+class Job(BaseModel):
+    job_id: str
+    kind: str
+    status: str
+    attempts: int
+    error: Optional[str] = None
+    created_at: datetime
+    updated_at: datetime
+
 # Database initialization
 async def init_db():
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Create tables
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id SERIAL PRIMARY KEY,
-                user_id VARCHAR(255) UNIQUE NOT NULL,
-                email VARCHAR(255) UNIQUE NOT NULL,
-                name VARCHAR(255),
-                picture TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS user_sessions (
-                id SERIAL PRIMARY KEY,
-                user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
-                session_token VARCHAR(255) UNIQUE NOT NULL,
-                expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS vehicles (
-                id SERIAL PRIMARY KEY,
-                vehicle_id VARCHAR(255) UNIQUE NOT NULL,
-                user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
-                name VARCHAR(255) NOT NULL,
-                make VARCHAR(255),
-                model VARCHAR(255),
-                year INTEGER,
-                business_percentage INTEGER DEFAULT 100,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS trips (
-                id SERIAL PRIMARY KEY,
-                trip_id VARCHAR(255) UNIQUE NOT NULL,
-                user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
-                vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
-                start_time TIMESTAMP WITH TIME ZONE NOT NULL,
-                end_time TIMESTAMP WITH TIME ZONE,
-                distance FLOAT NOT NULL,
-                start_location TEXT,
-                end_location TEXT,
-                purpose TEXT,
-                is_business BOOLEAN DEFAULT TRUE,
-                is_automatic BOOLEAN DEFAULT FALSE,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS expenses (
-                id SERIAL PRIMARY KEY,
-                expense_id VARCHAR(255) UNIQUE NOT NULL,
-                user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
-                vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
-                amount FLOAT NOT NULL,
-                category VARCHAR(255) NOT NULL,
-                date TIMESTAMP WITH TIME ZONE NOT NULL,
-                notes TEXT,
-                receipt_image_base64 TEXT,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        await conn.execute('''
-            CREATE TABLE IF NOT EXISTS subscriptions (
-                id SERIAL PRIMARY KEY,
-                subscription_id VARCHAR(255) UNIQUE NOT NULL,
-                user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
-                plan_type VARCHAR(50) NOT NULL,
-                status VARCHAR(50) NOT NULL,
-                start_date TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
-                end_date TIMESTAMP WITH TIME ZONE,
-                created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-            )
-        ''')
-        
-        logger.info("Database initialized successfully")
+    # Every shard gets the full schema; the global tables stay empty outside the primary
+    for pool in shard_router.all_pools():
+        async with pool.acquire() as conn:
+            await create_schema(conn)
+    async with shard_router.primary.acquire() as conn:
+        await install_shard_directory(conn)
+    logger.info("Database initialized successfully")
+
+async def create_schema(conn):
+    # Create tables
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            user_id VARCHAR(255) UNIQUE NOT NULL,
+            email VARCHAR(255) UNIQUE NOT NULL,
+            name VARCHAR(255),
+            picture TEXT,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_sessions (
+            id SERIAL PRIMARY KEY,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            session_token VARCHAR(255) UNIQUE NOT NULL,
+            expires_at TIMESTAMP WITH TIME ZONE NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    await install_session_indexes(conn)
+    
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS vehicles (
+            id SERIAL PRIMARY KEY,
+            vehicle_id VARCHAR(255) UNIQUE NOT NULL,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            name VARCHAR(255) NOT NULL,
+            make VARCHAR(255),
+            model VARCHAR(255),
+            year INTEGER,
+            business_percentage INTEGER DEFAULT 100,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    
+    # trips and expenses are range partitioned by month
+    for table in PARTITIONED_TABLES:
+        await create_partitioned_table(conn, table)
+    await ensure_partitions(conn)
+    
+    # Money in integer cents, distance in integer meters; the CLI converts legacy FLOAT columns online
+    # and the app starts as soon as their integer columns are filled in
+    pending = await pending_compact_types(conn)
+    if pending:
+        raise RuntimeError(f"{', '.join(pending)} still FLOAT; run `python compact_types.py migrate` first")
+    
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS subscriptions (
+            id SERIAL PRIMARY KEY,
+            subscription_id VARCHAR(255) UNIQUE NOT NULL,
+            user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+            plan_type VARCHAR(50) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            start_date TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            end_date TIMESTAMP WITH TIME ZONE,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+    
+    # Change log for delta sync
+    await install_change_log(conn)
+    
+    # Stored responses for Idempotency-Key replays
+    await install_idempotency_keys(conn)
+    
+    # Background job queue
+    await install_jobs(conn)
+    
+    # List-view receipt thumbnails
+    await install_receipt_thumbnails(conn)
+    
+    # Raw location fixes for trip segmentation
+    await install_location_fixes(conn)
+    
+    # Rate limit buckets shared by all workers
+    if RATE_LIMIT_BACKEND == "postgres":
+        await install_rate_limits(conn)
+    
+    # Last, so the recorded version means the whole schema is in place
+    await install_schema_version(conn)
 
 # Authentication helpers
 async def get_current_user(request: Request, session_token: Optional[str] = Cookie(None)) -> Optional[User]:
@@ -274,30 +459,29 @@ async def get_current_user(request: Request, session_token: Optional[str] = Cook
     if not token:
         return None
     
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Get session
-        session = await conn.fetchrow(
-            "SELECT user_id, expires_at FROM user_sessions WHERE session_token = $1",
-            token
-        )
-        
-        if not session:
-            return None
-        
-        # Check if session expired
-        if session['expires_at'] < datetime.now(timezone.utc):
-            return None
-        
-        # Get user
-        user = await conn.fetchrow(
-            "SELECT user_id, email, name, picture, created_at FROM users WHERE user_id = $1",
-            session['user_id']
-        )
-        
-        if user:
-            return User(**dict(user))
+    user = await get_user_by_token(token)
+    if user:
+        logs.set_user(user.user_id)
+    return user
+
+async def get_user_by_token(token: str) -> Optional[User]:
+    # Session and user in one lookup
+    session = await storage.get_session_user(token)
+    
+    if not session:
+        return None
+    
+    # Check if session expired
+    if session['expires_at'] < datetime.now(timezone.utc):
         return None
+    
+    return User(
+        user_id=session['user_id'],
+        email=session['email'],
+        name=session['name'],
+        picture=session['picture'],
+        created_at=session['created_at']
+    )
 
 async def require_auth(request: Request, session_token: Optional[str] = Cookie(None)) -> User:
     user = await get_current_user(request, session_token)
@@ -305,8 +489,26 @@ async def require_auth(request: Request, session_token: Optional[str] = Cookie(N
         raise HTTPException(status_code=401, detail="Not authenticated")
     return user
 
+# Rate limiting
+def rate_limit(rule: str):
+    """Route dependency taking a token from the user's bucket for `rule`"""
+    async def check(response: Response, current_user: User = Depends(require_auth)):
+        response.headers.update(await rate_limiter.check(rule, current_user.user_id))
+    return Depends(check)
+
+def ip_rate_limit(rule: str):
+    """Rate limit for unauthenticated routes, keyed by client address
+
+    Behind a proxy this is only the caller's address when uvicorn runs with
+    --proxy-headers, as the deploy start commands do.
+    """
+    async def check(request: Request, response: Response):
+        client = request.client.host if request.client else "unknown"
+        response.headers.update(await rate_limiter.check(rule, client))
+    return Depends(check)
+
 # Auth endpoints
-@api_router.post("/auth/session")
+@api_router.post("/auth/session", dependencies=[ip_rate_limit("auth")])
 async def exchange_session(request: Request, response: Response):
     body = await request.json()
     session_id = body.get("session_id")
@@ -327,34 +529,16 @@ async def exchange_session(request: Request, response: Response):
             logger.error(f"Failed to exchange session: {e}")
             raise HTTPException(status_code=400, detail="Invalid session_id")
     
-    # Save or update user
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        user_id = f"user_{uuid.uuid4().hex[:12]}"
-        
-        # Check if user exists
-        existing = await conn.fetchrow(
-            "SELECT user_id FROM users WHERE email = $1",
-            user_data['email']
-        )
-        
-        if existing:
-            user_id = existing['user_id']
-        else:
-            # Create new user
-            await conn.execute(
-                "INSERT INTO users (user_id, email, name, picture) VALUES ($1, $2, $3, $4)",
-                user_id, user_data['email'], user_data['name'], user_data.get('picture')
-            )
-        
-        # Create session
-        session_token = user_data['session_token']
-        expires_at = datetime.now(timezone.utc) + timedelta(days=7)
-        
-        await conn.execute(
-            "INSERT INTO user_sessions (user_id, session_token, expires_at) VALUES ($1, $2, $3)",
-            user_id, session_token, expires_at
-        )
+    # Create the user, or get the existing one for this email
+    user_id = await storage.upsert_user(
+        f"user_{uuid.uuid4().hex[:12]}", user_data['email'],
+        user_data['name'], user_data.get('picture')
+    )
+    
+    # Create session
+    session_token = user_data['session_token']
+    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
+    await storage.create_session(user_id, session_token, expires_at)
     
     # Set cookie
     response.set_cookie(
@@ -369,7 +553,7 @@ async def exchange_session(request: Request, response: Response):
     
     return SessionDataResponse(**user_data)
 
-@api_router.get("/auth/me")
+@api_router.get("/auth/me", dependencies=[rate_limit("reads")])
 async def get_me(current_user: User = Depends(require_auth)):
     return current_user
 
@@ -382,361 +566,548 @@ async def logout(request: Request, response: Response, session_token: Optional[s
             token = auth_header.replace("Bearer ", "")
     
     if token:
-        pool = await get_db_pool()
-        async with pool.acquire() as conn:
-            await conn.execute(
-                "DELETE FROM user_sessions WHERE session_token = $1",
-                token
-            )
+        await storage.delete_session(token)
     
     response.delete_cookie(key="session_token", path="/")
     return {"message": "Logged out"}
 
 # Vehicle endpoints
-@api_router.post("/vehicles", response_model=Vehicle)
+@api_router.post("/vehicles", response_model=Vehicle, dependencies=[rate_limit("writes")])
 async def create_vehicle(vehicle: VehicleCreate, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        vehicle_id = f"vehicle_{uuid.uuid4().hex[:12]}"
-        
-        await conn.execute(
-            """INSERT INTO vehicles (vehicle_id, user_id, name, make, model, year, business_percentage)
-               VALUES ($1, $2, $3, $4, $5, $6, $7)""",
-            vehicle_id, current_user.user_id, vehicle.name, vehicle.make, 
-            vehicle.model, vehicle.year, vehicle.business_percentage
-        )
-        
-        created = await conn.fetchrow(
-            "SELECT * FROM vehicles WHERE vehicle_id = $1",
-            vehicle_id
-        )
-        
-        return Vehicle(**dict(created))
+    vehicle_id = f"vehicle_{uuid.uuid4().hex[:12]}"
+    created = await storage.insert_vehicle(vehicle_id, current_user.user_id, vehicle)
+    return Vehicle(**dict(created))
 
-@api_router.get("/vehicles", response_model=List[Vehicle])
+@api_router.get("/vehicles", response_model=List[Vehicle], dependencies=[rate_limit("reads")])
+@single_flight
 async def get_vehicles(current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        vehicles = await conn.fetch(
-            "SELECT * FROM vehicles WHERE user_id = $1 ORDER BY created_at DESC",
-            current_user.user_id
-        )
-        return [Vehicle(**dict(v)) for v in vehicles]
+    vehicles = await storage.list_vehicles(current_user.user_id)
+    return [Vehicle(**dict(v)) for v in vehicles]
 
-@api_router.delete("/vehicles/{vehicle_id}")
+@api_router.delete("/vehicles/{vehicle_id}", dependencies=[rate_limit("writes")])
 async def delete_vehicle(vehicle_id: str, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        result = await conn.execute(
-            "DELETE FROM vehicles WHERE vehicle_id = $1 AND user_id = $2",
-            vehicle_id, current_user.user_id
-        )
-        if result == "DELETE 0":
-            raise HTTPException(status_code=404, detail="Vehicle not found")
-        return {"message": "Vehicle deleted"}
+    if not await storage.delete_vehicle(vehicle_id, current_user.user_id):
+        raise HTTPException(status_code=404, detail="Vehicle not found")
+    return {"message": "Vehicle deleted"}
+
+# List shapes
+def check_shape(shape: str):
+    if shape not in ("objects", "columns"):
+        raise HTTPException(status_code=400, detail="shape must be objects or columns")
+
+def to_columns(model, rows) -> Columns:
+    """Columnar form of list rows; keys are sent once instead of per item"""
+    columns = list(model.model_fields)
+    return Columns(columns=columns, rows=[[row[c] for c in columns] for row in rows])
 
 # Trip endpoints
-@api_router.post("/trips", response_model=Trip)
+@api_router.post("/trips", response_model=Trip, dependencies=[rate_limit("writes")])
 async def create_trip(trip: TripCreate, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        trip_id = f"trip_{uuid.uuid4().hex[:12]}"
-        
-        await conn.execute(
-            """INSERT INTO trips (trip_id, user_id, vehicle_id, start_time, end_time, 
-               distance, start_location, end_location, purpose, is_business, is_automatic)
-               VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11)""",
-            trip_id, current_user.user_id, trip.vehicle_id, trip.start_time, 
-            trip.end_time, trip.distance, trip.start_location, trip.end_location,
-            trip.purpose, trip.is_business, trip.is_automatic
-        )
-        
-        created = await conn.fetchrow(
-            "SELECT * FROM trips WHERE trip_id = $1",
-            trip_id
-        )
-        
-        return Trip(**dict(created))
+    trip_id = f"trip_{uuid.uuid4().hex[:12]}"
+    created = await storage.insert_trip(trip_id, current_user.user_id, trip)
+    return Trip(**dict(created))
 
-@api_router.get("/trips", response_model=List[Trip])
-async def get_trips(current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        trips = await conn.fetch(
-            "SELECT * FROM trips WHERE user_id = $1 ORDER BY start_time DESC LIMIT 100",
-            current_user.user_id
-        )
-        return [Trip(**dict(t)) for t in trips]
+@api_router.get("/trips", response_model=Union[List[Trip], Columns], dependencies=[rate_limit("reads")])
+async def get_trips(shape: str = "objects", current_user: User = Depends(require_auth)):
+    check_shape(shape)
+    trips = await storage.list_trips(current_user.user_id)
+    if shape == "columns":
+        return to_columns(Trip, trips)
+    return [Trip(**dict(t)) for t in trips]
 
-@api_router.put("/trips/{trip_id}", response_model=Trip)
+@api_router.put("/trips/{trip_id}", response_model=Trip, dependencies=[rate_limit("writes")])
 async def update_trip(trip_id: str, trip_update: TripUpdate, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Build update query dynamically
-        updates = []
-        values = []
-        param_count = 1
-        
-        for field, value in trip_update.dict(exclude_unset=True).items():
-            if value is not None:
-                updates.append(f"{field} = ${param_count}")
-                values.append(value)
-                param_count += 1
-        
-        if not updates:
-            raise HTTPException(status_code=400, detail="No fields to update")
-        
-        values.extend([trip_id, current_user.user_id])
-        query = f"UPDATE trips SET {', '.join(updates)} WHERE trip_id = ${param_count} AND user_id = ${param_count+1} RETURNING *"
-        
-        updated = await conn.fetchrow(query, *values)
-        
-        if not updated:
-            raise HTTPException(status_code=404, detail="Trip not found")
-        
-        return Trip(**dict(updated))
+    # Unset fields are left unchanged by the single prepared update
+    fields = {k: v for k, v in trip_update.model_dump(exclude_unset=True).items() if v is not None}
+    
+    if not fields:
+        raise HTTPException(status_code=400, detail="No fields to update")
+    
+    updated = await storage.update_trip(trip_id, current_user.user_id, fields)
+    
+    if not updated:
+        raise HTTPException(status_code=404, detail="Trip not found")
+    
+    return Trip(**dict(updated))
 
-@api_router.delete("/trips/{trip_id}")
+@api_router.delete("/trips/{trip_id}", dependencies=[rate_limit("writes")])
 async def delete_trip(trip_id: str, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
+    if not await storage.delete_trip(trip_id, current_user.user_id):
+        raise HTTPException(status_code=404, detail="Trip not found")
+    return {"message": "Trip deleted"}
+
+# Live trip tracking stream
+@api_router.websocket("/trips/live")
+async def live_trip_stream(websocket: WebSocket, token: Optional[str] = None):
+    # Query token for clients that cannot set headers, then cookie, then Authorization header
+    if not token:
+        token = websocket.cookies.get("session_token")
+    if not token:
+        auth_header = websocket.headers.get("Authorization")
+        if auth_header and auth_header.startswith("Bearer "):
+            token = auth_header.replace("Bearer ", "")
+    
+    current_user = await get_user_by_token(token) if token else None
+    if not current_user:
+        await websocket.close(code=4401)
+        return
+    
+    await websocket.accept()
+    pool = None
+    trip = None
+    
+    try:
+        while True:
+            message = await websocket.receive_json()
+            kind = message.get("type")
+            
+            # Resolved per message, so a stream survives its account moving shards
+            try:
+                pool = await get_user_pool(current_user.user_id)
+            except HTTPException as e:
+                await websocket.send_json({"type": "error", "detail": e.detail})
+                continue
+            
+            if kind == "start" and trip is None:
+                async with pool.acquire() as conn:
+                    if message.get("trip_id"):
+                        # Resume an open trip after a reconnect
+                        row = await repository.get_open_trip(conn, message["trip_id"], current_user.user_id)
+                    else:
+                        row = await repository.insert_trip(
+                            conn, f"trip_{uuid.uuid4().hex[:12]}", current_user.user_id,
+                            TripCreate(
+                                vehicle_id=message.get("vehicle_id"),
+                                start_time=datetime.now(timezone.utc),
+                                distance=0,
+                                start_location=message.get("start_location"),
+                                purpose=message.get("purpose"),
+                                is_business=message.get("is_business", True),
+                                is_automatic=True
+                            )
+                        )
+                if not row:
+                    await websocket.send_json({"type": "error", "detail": "Trip not found"})
+                    continue
+                trip = live_trips.attach(row['trip_id'], current_user.user_id, row['distance'])
+                await websocket.send_json({"type": "started", "trip": Trip(**dict(row)).model_dump(mode="json")})
+            
+            elif kind == "fixes" and trip is not None:
+                points = message.get("points") or []
+                if len(points) > MAX_FIXES_PER_MESSAGE:
+                    await websocket.send_json({"type": "error", "detail": f"At most {MAX_FIXES_PER_MESSAGE} fixes per message"})
+                    continue
+                try:
+                    for lat, lng, ts in points:
+                        trip.add_fix(float(lat), float(lng), float(ts))
+                except (TypeError, ValueError):
+                    await websocket.send_json({"type": "error", "detail": "Fixes must be [lat, lng, epoch_seconds]"})
+                    continue
+                # Clients keep a bounded number of unacknowledged batches in flight
+                await websocket.send_json({"type": "ack", "seq": message.get("seq"), "distance": round(trip.distance, 2)})
+            
+            elif kind == "stop" and trip is not None:
+                row = await live_trips.finish(pool, trip, datetime.now(timezone.utc), message.get("end_location"))
+                trip = None
+                await websocket.send_json({"type": "stopped", "trip": Trip(**dict(row)).model_dump(mode="json") if row else None})
+            
+            else:
+                await websocket.send_json({"type": "error", "detail": f"Unexpected message: {kind}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        if trip is not None:
+            try:
+                await live_trips.detach(pool, trip)
+            except Exception as e:
+                logger.error(f"Failed to save live trip {trip.trip_id}: {e}")
+
+# Background location uploads
+@api_router.post("/locations", response_model=LocationUpload, dependencies=[rate_limit("writes")])
+async def upload_locations(batch: LocationBatch, current_user: User = Depends(require_auth)):
+    """Store [lat, lng, epoch_seconds] fixes and segment any trips they complete"""
+    if len(batch.fixes) > MAX_FIXES_PER_UPLOAD:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_FIXES_PER_UPLOAD} fixes per upload")
+    if any(not (-90 <= lat <= 90 and -180 <= lng <= 180) for lat, lng, _ in batch.fixes):
+        raise HTTPException(status_code=400, detail="Fixes must be [lat, lng, epoch_seconds]")
+    
+    pool = await get_user_pool(current_user.user_id)
     async with pool.acquire() as conn:
-        result = await conn.execute(
-            "DELETE FROM trips WHERE trip_id = $1 AND user_id = $2",
-            trip_id, current_user.user_id
-        )
-        if result == "DELETE 0":
-            raise HTTPException(status_code=404, detail="Trip not found")
-        return {"message": "Trip deleted"}
+        stored = await store_fixes(conn, current_user.user_id, batch.fixes) if batch.fixes else 0
+        trips = await segment_user(conn, current_user.user_id)
+        return LocationUpload(stored=stored, trips=[Trip(**dict(t)) for t in trips])
 
 # Expense endpoints
-@api_router.post("/expenses", response_model=Expense)
+@api_router.post("/expenses", response_model=Expense, dependencies=[rate_limit("writes")])
 async def create_expense(expense: ExpenseCreate, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        expense_id = f"expense_{uuid.uuid4().hex[:12]}"
-        
-        await conn.execute(
-            """INSERT INTO expenses (expense_id, user_id, vehicle_id, amount, category, 
-               date, notes, receipt_image_base64)
-               VALUES ($1, $2, $3, $4, $5, $6, $7, $8)""",
-            expense_id, current_user.user_id, expense.vehicle_id, expense.amount,
-            expense.category, expense.date, expense.notes, expense.receipt_image_base64
-        )
-        
-        created = await conn.fetchrow(
-            "SELECT * FROM expenses WHERE expense_id = $1",
-            expense_id
-        )
-        
-        return Expense(**dict(created))
+    # Resized, metadata-free receipt and its thumbnail, encoded in a worker process
+    try:
+        receipt, thumbnail = await receipts.ingest_receipt(expense.receipt_image_base64)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    expense_id = f"expense_{uuid.uuid4().hex[:12]}"
+    created = await storage.insert_expense(expense_id, current_user.user_id, expense, receipt, thumbnail)
+    return Expense(**dict(created))
 
-@api_router.get("/expenses", response_model=List[Expense])
-async def get_expenses(current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        expenses = await conn.fetch(
-            "SELECT * FROM expenses WHERE user_id = $1 ORDER BY date DESC LIMIT 100",
-            current_user.user_id
-        )
-        return [Expense(**dict(e)) for e in expenses]
+@api_router.get("/expenses", response_model=Union[List[Expense], Columns], dependencies=[rate_limit("reads")])
+async def get_expenses(shape: str = "objects", current_user: User = Depends(require_auth)):
+    check_shape(shape)
+    expenses = await storage.list_expenses(current_user.user_id)
+    if shape == "columns":
+        return to_columns(Expense, expenses)
+    return [Expense(**dict(e)) for e in expenses]
+
+@api_router.get("/expenses/{expense_id}/receipt", dependencies=[rate_limit("reads")])
+async def get_expense_receipt(expense_id: str, current_user: User = Depends(require_auth)):
+    """Full-size receipt image; lists only carry the thumbnail"""
+    data_url = await storage.get_receipt(expense_id, current_user.user_id)
+    
+    if not data_url:
+        raise HTTPException(status_code=404, detail="Receipt not found")
+    
+    media_type = data_url[5:data_url.find(";")] if data_url.startswith("data:") else "application/octet-stream"
+    # Receipts never change after upload
+    return Response(
+        content=archive.decode_receipt(data_url),
+        media_type=media_type,
+        headers={"Cache-Control": "private, max-age=86400"}
+    )
 
-@api_router.delete("/expenses/{expense_id}")
+@api_router.delete("/expenses/{expense_id}", dependencies=[rate_limit("writes")])
 async def delete_expense(expense_id: str, current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        result = await conn.execute(
-            "DELETE FROM expenses WHERE expense_id = $1 AND user_id = $2",
-            expense_id, current_user.user_id
-        )
-        if result == "DELETE 0":
-            raise HTTPException(status_code=404, detail="Expense not found")
-        return {"message": "Expense deleted"}
+    if not await storage.delete_expense(expense_id, current_user.user_id):
+        raise HTTPException(status_code=404, detail="Expense not found")
+    return {"message": "Expense deleted"}
 
 # Dashboard stats
-@api_router.get("/dashboard/stats")
+@api_router.get("/dashboard/stats", dependencies=[rate_limit("reads")])
+@single_flight
 async def get_dashboard_stats(current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Get current month and year stats
-        now = datetime.now(timezone.utc)
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        # Monthly miles
-        month_miles = await conn.fetchval(
-            "SELECT COALESCE(SUM(distance), 0) FROM trips WHERE user_id = $1 AND is_business = TRUE AND start_time >= $2",
-            current_user.user_id, month_start
-        )
-        
-        # Yearly miles
-        year_miles = await conn.fetchval(
-            "SELECT COALESCE(SUM(distance), 0) FROM trips WHERE user_id = $1 AND is_business = TRUE AND start_time >= $2",
-            current_user.user_id, year_start
-        )
-        
-        # Total expenses
-        total_expenses = await conn.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = $1 AND date >= $2",
-            current_user.user_id, year_start
-        )
-        
-        # IRS 2025 rate: $0.67 per mile
-        IRS_RATE = 0.67
-        mileage_deduction = year_miles * IRS_RATE
-        total_deduction = mileage_deduction + total_expenses
-        
-        # Estimated tax savings (assuming 25% tax bracket)
-        estimated_tax_savings = total_deduction * 0.25
-        
-        return {
-            "month_miles": round(month_miles, 2),
-            "year_miles": round(year_miles, 2),
-            "total_expenses": round(total_expenses, 2),
-            "mileage_deduction": round(mileage_deduction, 2),
-            "total_deduction": round(total_deduction, 2),
-            "estimated_tax_savings": round(estimated_tax_savings, 2)
-        }
+    # Get current month and year stats
+    now = datetime.now(timezone.utc)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    year_start = now.replace(month=1, day=1, hour=0, minute=0, second=0, microsecond=0)
+    
+    # Monthly miles, yearly miles and total expenses in one round trip
+    totals = await storage.dashboard_totals(current_user.user_id, month_start, year_start)
+    month_miles = totals['month_miles']
+    year_miles = totals['year_miles']
+    total_expenses = totals['total_expenses']
+    
+    # IRS 2025 rate: $0.67 per mile
+    IRS_RATE = 0.67
+    mileage_deduction = year_miles * IRS_RATE
+    total_deduction = mileage_deduction + total_expenses
+    
+    # Estimated tax savings (assuming 25% tax bracket)
+    estimated_tax_savings = total_deduction * 0.25
+    
+    return {
+        "month_miles": round(month_miles, 2),
+        "year_miles": round(year_miles, 2),
+        "total_expenses": round(total_expenses, 2),
+        "mileage_deduction": round(mileage_deduction, 2),
+        "total_deduction": round(total_deduction, 2),
+        "estimated_tax_savings": round(estimated_tax_savings, 2)
+    }
 
 # Reports
-@api_router.get("/reports/tax", response_model=TaxReport)
+@api_router.get("/reports/tax", response_model=TaxReport, dependencies=[rate_limit("reports")])
 async def get_tax_report(
     start_date: str,
     end_date: str,
     current_user: User = Depends(require_auth)
 ):
+    start = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
+    end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
+    
+    # Trip and expense totals over the partitions pruned to the period
+    totals = await storage.tax_report_totals(current_user.user_id, start, end)
+    total_miles = totals['total_miles']
+    business_miles = totals['business_miles']
+    total_expenses = totals['total_expenses']
+    
+    IRS_RATE = 0.67
+    total_deduction = (business_miles * IRS_RATE) + total_expenses
+    total_tax_savings = total_deduction * 0.25
+    
+    return TaxReport(
+        total_miles=round(total_miles or 0, 2),
+        business_miles=round(business_miles or 0, 2),
+        total_deduction=round(total_deduction or 0, 2),
+        total_expenses=round(total_expenses or 0, 2),
+        total_tax_savings=round(total_tax_savings or 0, 2),
+        period_start=start,
+        period_end=end
+    )
+
+# Analytics
+@api_router.get("/analytics/timeseries", dependencies=[rate_limit("reports")])
+@single_flight
+async def get_timeseries(
+    metric: str,
+    bucket: str = "month",
+    group_by: Optional[str] = None,
+    start_date: Optional[str] = None,
+    end_date: Optional[str] = None,
+    current_user: User = Depends(require_auth)
+):
+    if metric not in analytics.METRICS:
+        raise HTTPException(status_code=400, detail=f"metric must be one of {', '.join(analytics.METRICS)}")
+    if bucket not in analytics.BUCKETS:
+        raise HTTPException(status_code=400, detail=f"bucket must be one of {', '.join(analytics.BUCKETS)}")
+    if group_by is not None and group_by not in analytics.METRICS[metric]:
+        raise HTTPException(status_code=400, detail=f"{metric} can be grouped by {', '.join(analytics.METRICS[metric])}")
+    
+    # Defaults to this year and last, for year-over-year comparison
+    now = datetime.now(timezone.utc)
+    try:
+        start = datetime.fromisoformat(start_date.replace('Z', '+00:00')) if start_date else now.replace(
+            year=now.year - 1, month=1, day=1, hour=0, minute=0, second=0, microsecond=0
+        )
+        end = datetime.fromisoformat(end_date.replace('Z', '+00:00')) if end_date else now
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start_date and end_date must be ISO 8601")
+    
+    return await analytics.timeseries(storage, current_user.user_id, metric, bucket, group_by, start, end, now)
+
+@api_router.get("/reports/tax/export", dependencies=[rate_limit("exports")])
+async def export_tax_report(
+    start_date: str,
+    end_date: str,
+    format: str = "csv",
+    current_user: User = Depends(require_auth)
+):
+    """Stream trip and expense line items as CSV or PDF"""
+    if format not in ("csv", "pdf"):
+        raise HTTPException(status_code=400, detail="format must be csv or pdf")
+    
+    plan_type = await storage.get_active_plan(current_user.user_id) or "basic"
+    if plan_type != "premium":
+        raise HTTPException(status_code=403, detail="Tax report export is only available on Premium plan")
+    
+    try:
+        start, end = reports.parse_period(start_date, end_date)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="start_date and end_date must be ISO 8601")
+    if end < start:
+        raise HTTPException(status_code=400, detail="end_date is before start_date")
+    
+    pool = await get_user_pool(current_user.user_id)
+    filename = f"tax-report-{start.date().isoformat()}-{end.date().isoformat()}.{format}"
+    if format == "csv":
+        body, media_type = reports.stream_csv(pool, current_user.user_id, start, end), "text/csv"
+    else:
+        body, media_type = reports.stream_pdf(pool, current_user.user_id, start, end), "application/pdf"
+    return StreamingResponse(
+        body,
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Account export & import
+@api_router.get("/account/export", dependencies=[rate_limit("exports")])
+async def export_account(current_user: User = Depends(require_auth)):
+    """Stream a zip archive of all of the user's data"""
+    pool = await get_user_pool(current_user.user_id)
+    filename = f"ledger-export-{datetime.now(timezone.utc):%Y-%m-%d}.zip"
+    return StreamingResponse(
+        archive.stream_archive(pool, current_user.user_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@api_router.post("/account/import", dependencies=[rate_limit("exports")])
+async def import_account(file: UploadFile = File(...), current_user: User = Depends(require_auth)):
+    """Restore an account export; rows that already exist are skipped"""
+    pool = await get_user_pool(current_user.user_id)
+    try:
+        # Reading the central directory is file I/O on the spooled upload
+        with await asyncio.to_thread(zipfile.ZipFile, file.file) as upload:
+            imported = await archive.import_archive(pool, current_user.user_id, upload)
+    except (zipfile.BadZipFile, KeyError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+    except (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError) as e:
+        # Malformed CSV, bad values or rows breaking a constraint, as reported by COPY and INSERT
+        raise HTTPException(status_code=400, detail=f"Invalid archive: {e}")
+    
+    # Restored receipts get their thumbnails in the background
+    if imported.get("expenses"):
+        jobs_pool = await get_db_pool()
+        async with jobs_pool.acquire() as conn:
+            await enqueue_job(conn, current_user.user_id, "receipt_thumbnails", {})
+        job_runner.notify()
+    
+    logger.info(f"Imported archive for {current_user.user_id}: {imported}")
+    return {"imported": imported}
+
+# Background jobs
+@api_router.post("/jobs", response_model=Job, status_code=202, dependencies=[rate_limit("reports")])
+async def create_job(job: JobCreate, current_user: User = Depends(require_auth)):
+    try:
+        params = validate_params(job.kind, job.params)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
     pool = await get_db_pool()
     async with pool.acquire() as conn:
-        start = datetime.fromisoformat(start_date.replace('Z', '+00:00'))
-        end = datetime.fromisoformat(end_date.replace('Z', '+00:00'))
-        
-        # Get trips
-        total_miles = await conn.fetchval(
-            "SELECT COALESCE(SUM(distance), 0) FROM trips WHERE user_id = $1 AND start_time BETWEEN $2 AND $3",
-            current_user.user_id, start, end
-        )
-        
-        business_miles = await conn.fetchval(
-            "SELECT COALESCE(SUM(distance), 0) FROM trips WHERE user_id = $1 AND is_business = TRUE AND start_time BETWEEN $2 AND $3",
-            current_user.user_id, start, end
-        )
+        row = await enqueue_job(conn, current_user.user_id, job.kind, params)
+    job_runner.notify()
+    return Job(**dict(row))
+
+@api_router.get("/jobs/{job_id}", response_model=Job, dependencies=[rate_limit("reads")])
+async def get_job_status(job_id: str, current_user: User = Depends(require_auth)):
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        row = await get_job(conn, job_id, current_user.user_id)
+        if not row:
+            raise HTTPException(status_code=404, detail="Job not found")
+        return Job(**dict(row))
+
+@api_router.get("/jobs/{job_id}/result", dependencies=[rate_limit("reads")])
+async def get_job_output(job_id: str, current_user: User = Depends(require_auth)):
+    pool = await get_db_pool()
+    async with pool.acquire() as conn:
+        row = await get_job_result(conn, job_id, current_user.user_id)
+    if not row:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if row['status'] != 'succeeded':
+        raise HTTPException(status_code=409, detail=f"Job is {row['status']}")
+    return Response(content=row['result'], media_type=row['content_type'])
+
+# Search
+@api_router.get("/search", response_model=SearchResults, dependencies=[rate_limit("search")])
+async def search_records(
+    q: str,
+    limit: int = 20,
+    offset: int = 0,
+    current_user: User = Depends(require_auth)
+):
+    q = q.strip()
+    if not q:
+        raise HTTPException(status_code=400, detail="Search query required")
+    if not 1 <= limit <= MAX_PAGE_SIZE or offset < 0:
+        raise HTTPException(status_code=400, detail="Invalid pagination")
+    
+    pool = await get_user_pool(current_user.user_id)
+    async with pool.acquire() as conn:
+        hits, has_more = await run_search(conn, current_user.user_id, q, limit, offset)
         
-        # Get expenses
-        total_expenses = await conn.fetchval(
-            "SELECT COALESCE(SUM(amount), 0) FROM expenses WHERE user_id = $1 AND date BETWEEN $2 AND $3",
-            current_user.user_id, start, end
+        return SearchResults(
+            query=q,
+            results=[SearchHit(**dict(h)) for h in hits],
+            limit=limit,
+            offset=offset,
+            has_more=has_more
         )
+
+# Delta sync
+@api_router.get("/sync", response_model=SyncChanges, dependencies=[rate_limit("sync")])
+async def sync_changes(since: str = "0", current_user: User = Depends(require_auth)):
+    try:
+        since_seq = int(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid sync cursor")
+    
+    pool = await get_user_pool(current_user.user_id)
+    async with pool.acquire() as conn:
+        cursor, has_more, rows, deleted = await fetch_changes(conn, current_user.user_id, since_seq)
         
-        IRS_RATE = 0.67
-        total_deduction = (business_miles * IRS_RATE) + total_expenses
-        total_tax_savings = total_deduction * 0.25
-        
-        return TaxReport(
-            total_miles=round(total_miles or 0, 2),
-            business_miles=round(business_miles or 0, 2),
-            total_deduction=round(total_deduction or 0, 2),
-            total_expenses=round(total_expenses or 0, 2),
-            total_tax_savings=round(total_tax_savings or 0, 2),
-            period_start=start,
-            period_end=end
+        return SyncChanges(
+            cursor=str(cursor),
+            has_more=has_more,
+            vehicles=[Vehicle(**dict(v)) for v in rows["vehicles"]],
+            trips=[Trip(**dict(t)) for t in rows["trips"]],
+            expenses=[Expense(**dict(e)) for e in rows["expenses"]],
+            deleted=deleted
         )
 
 # Subscription (real with usage tracking)
-@api_router.get("/subscription/status", response_model=SubscriptionStatus)
+@api_router.get("/subscription/status", response_model=SubscriptionStatus, dependencies=[rate_limit("reads")])
+@single_flight
 async def get_subscription_status(current_user: User = Depends(require_auth)):
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Get or create subscription
-        subscription = await conn.fetchrow(
-            "SELECT * FROM subscriptions WHERE user_id = $1 AND status = 'active' ORDER BY created_at DESC LIMIT 1",
-            current_user.user_id
-        )
-        
-        # If no subscription, assign free basic plan
-        if not subscription:
-            subscription_id = f"sub_{uuid.uuid4().hex[:12]}"
-            await conn.execute(
-                "INSERT INTO subscriptions (subscription_id, user_id, plan_type, status) VALUES ($1, $2, $3, $4)",
-                subscription_id, current_user.user_id, "basic", "active"
-            )
-            plan_type = "basic"
-        else:
-            plan_type = subscription['plan_type']
-        
-        # Calculate usage for current month
-        now = datetime.now(timezone.utc)
-        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-        
-        auto_trips_count = await conn.fetchval(
-            "SELECT COUNT(*) FROM trips WHERE user_id = $1 AND is_automatic = TRUE AND created_at >= $2",
-            current_user.user_id, month_start
-        )
-        
-        bank_accounts_count = 0  # Will be implemented with Plaid
-        
-        # Define plan limits and features
-        plans = {
-            "basic": {
-                "features": [
-                    "Manual mileage tracking (unlimited)",
-                    "20 automatic GPS trips/month",
-                    "Basic expense tracking",
-                    "Simple reports",
-                    "1 vehicle"
-                ],
-                "limits": {
-                    "auto_trips_per_month": 20,
-                    "vehicles": 1,
-                    "bank_accounts": 0
-                }
-            },
-            "mid": {
-                "features": [
-                    "Everything in Basic",
-                    "Unlimited automatic GPS tracking",
-                    "Expense tracking with receipt photos",
-                    "Basic tax reports",
-                    "Up to 3 vehicles",
-                    "Email support"
-                ],
-                "limits": {
-                    "auto_trips_per_month": -1,  # unlimited
-                    "vehicles": 3,
-                    "bank_accounts": 0
-                }
-            },
-            "premium": {
-                "features": [
-                    "Everything in Mid-Tier",
-                    "Unlimited bank account linking",
-                    "Automatic earnings tracking",
-                    "AI-powered expense categorization",
-                    "Advanced tax reports (PDF/CSV)",
-                    "Unlimited vehicles",
-                    "Priority support",
-                    "Cloud backup"
-                ],
-                "limits": {
-                    "auto_trips_per_month": -1,  # unlimited
-                    "vehicles": -1,  # unlimited
-                    "bank_accounts": -1  # unlimited
-                }
+    # Get or create subscription
+    plan_type = await storage.get_active_plan(current_user.user_id)
+    
+    # If no subscription, assign free basic plan
+    if not plan_type:
+        subscription_id = f"sub_{uuid.uuid4().hex[:12]}"
+        await storage.create_subscription(subscription_id, current_user.user_id, "basic")
+        plan_type = "basic"
+    
+    # Calculate usage for current month
+    now = datetime.now(timezone.utc)
+    month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    
+    auto_trips_count = await storage.count_auto_trips_since(current_user.user_id, month_start)
+    
+    bank_accounts_count = 0  # Will be implemented with Plaid
+    
+    # Define plan limits and features
+    plans = {
+        "basic": {
+            "features": [
+                "Manual mileage tracking (unlimited)",
+                "20 automatic GPS trips/month",
+                "Basic expense tracking",
+                "Simple reports",
+                "1 vehicle"
+            ],
+            "limits": {
+                "auto_trips_per_month": 20,
+                "vehicles": 1,
+                "bank_accounts": 0
+            }
+        },
+        "mid": {
+            "features": [
+                "Everything in Basic",
+                "Unlimited automatic GPS tracking",
+                "Expense tracking with receipt photos",
+                "Basic tax reports",
+                "Up to 3 vehicles",
+                "Email support"
+            ],
+            "limits": {
+                "auto_trips_per_month": -1,  # unlimited
+                "vehicles": 3,
+                "bank_accounts": 0
+            }
+        },
+        "premium": {
+            "features": [
+                "Everything in Mid-Tier",
+                "Unlimited bank account linking",
+                "Automatic earnings tracking",
+                "AI-powered expense categorization",
+                "Advanced tax reports (PDF/CSV)",
+                "Unlimited vehicles",
+                "Priority support",
+                "Cloud backup"
+            ],
+            "limits": {
+                "auto_trips_per_month": -1,  # unlimited
+                "vehicles": -1,  # unlimited
+                "bank_accounts": -1  # unlimited
             }
         }
-        
-        plan_config = plans.get(plan_type, plans["basic"])
-        
-        return SubscriptionStatus(
-            plan_type=plan_type,
-            is_active=True,
-            features=plan_config["features"],
-            usage={
-                "auto_trips_this_month": auto_trips_count,
-                "bank_accounts": bank_accounts_count
-            },
-            limits=plan_config["limits"]
-        )
+    }
+    
+    plan_config = plans.get(plan_type, plans["basic"])
+    
+    return SubscriptionStatus(
+        plan_type=plan_type,
+        is_active=True,
+        features=plan_config["features"],
+        usage={
+            "auto_trips_this_month": auto_trips_count,
+            "bank_accounts": bank_accounts_count
+        },
+        limits=plan_config["limits"]
+    )
 
-@api_router.post("/subscription/change-plan")
+@api_router.post("/subscription/change-plan", dependencies=[rate_limit("writes")])
 async def change_subscription_plan(
     plan_type: str,
     current_user: User = Depends(require_auth)
@@ -744,71 +1115,51 @@ async def change_subscription_plan(
     if plan_type not in ["basic", "mid", "premium"]:
         raise HTTPException(status_code=400, detail="Invalid plan type")
     
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        # Deactivate old subscriptions
-        await conn.execute(
-            "UPDATE subscriptions SET status = 'cancelled', end_date = NOW() WHERE user_id = $1 AND status = 'active'",
-            current_user.user_id
-        )
-        
-        # Create new subscription
-        subscription_id = f"sub_{uuid.uuid4().hex[:12]}"
-        await conn.execute(
-            "INSERT INTO subscriptions (subscription_id, user_id, plan_type, status) VALUES ($1, $2, $3, $4)",
-            subscription_id, current_user.user_id, plan_type, "active"
-        )
-        
-        return {"message": f"Subscription changed to {plan_type}", "plan_type": plan_type}
+    # Deactivate old subscriptions and create the new one
+    subscription_id = f"sub_{uuid.uuid4().hex[:12]}"
+    await storage.change_plan(subscription_id, current_user.user_id, plan_type)
+    
+    return {"message": f"Subscription changed to {plan_type}", "plan_type": plan_type}
 
-@api_router.get("/subscription/check-limit")
+@api_router.get("/subscription/check-limit", dependencies=[rate_limit("reads")])
+@single_flight
 async def check_subscription_limit(
     feature: str,
     current_user: User = Depends(require_auth)
 ):
     """Check if user can use a feature based on their plan"""
-    pool = await get_db_pool()
-    async with pool.acquire() as conn:
-        subscription = await conn.fetchrow(
-            "SELECT plan_type FROM subscriptions WHERE user_id = $1 AND status = 'active' ORDER BY created_at DESC LIMIT 1",
-            current_user.user_id
-        )
+    plan_type = await storage.get_active_plan(current_user.user_id) or "basic"
+    
+    if feature == "auto_trip":
+        now = datetime.now(timezone.utc)
+        month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
         
-        plan_type = subscription['plan_type'] if subscription else "basic"
+        auto_trips_count = await storage.count_auto_trips_since(current_user.user_id, month_start)
         
-        if feature == "auto_trip":
-            now = datetime.now(timezone.utc)
-            month_start = now.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
-            
-            auto_trips_count = await conn.fetchval(
-                "SELECT COUNT(*) FROM trips WHERE user_id = $1 AND is_automatic = TRUE AND created_at >= $2",
-                current_user.user_id, month_start
-            )
-            
-            if plan_type == "basic":
-                limit = 20
-                can_use = auto_trips_count < limit
-                remaining = max(0, limit - auto_trips_count)
-            else:  # mid or premium
-                can_use = True
-                remaining = -1  # unlimited
-            
-            return {
-                "can_use": can_use,
-                "used": auto_trips_count,
-                "remaining": remaining,
-                "plan_type": plan_type
-            }
+        if plan_type == "basic":
+            limit = 20
+            can_use = auto_trips_count < limit
+            remaining = max(0, limit - auto_trips_count)
+        else:  # mid or premium
+            can_use = True
+            remaining = -1  # unlimited
         
-        elif feature == "bank_link":
-            can_use = plan_type == "premium"
-            return {
-                "can_use": can_use,
-                "plan_type": plan_type,
-                "message": "Bank linking is only available on Premium plan" if not can_use else "Available"
-            }
-        
-        return {"can_use": True, "plan_type": plan_type}
+        return {
+            "can_use": can_use,
+            "used": auto_trips_count,
+            "remaining": remaining,
+            "plan_type": plan_type
+        }
+    
+    elif feature == "bank_link":
+        can_use = plan_type == "premium"
+        return {
+            "can_use": can_use,
+            "plan_type": plan_type,
+            "message": "Bank linking is only available on Premium plan" if not can_use else "Available"
+        }
+    
+    return {"can_use": True, "plan_type": plan_type}
 
 @api_router.get("/subscription/plans")
 async def get_subscription_plans():
@@ -874,9 +1225,39 @@ async def get_subscription_plans():
         ]
     }
 
+# App startup payload: one auth check, startup queries fanned out over the pool
+@api_router.get("/bootstrap", response_model=BootstrapPayload, dependencies=[rate_limit("bootstrap")])
+async def bootstrap(current_user: User = Depends(require_auth)):
+    vehicles, subscription, dashboard = await asyncio.gather(
+        get_vehicles(current_user),
+        get_subscription_status(current_user),
+        get_dashboard_stats(current_user)
+    )
+    plans = await get_subscription_plans()
+    
+    return BootstrapPayload(
+        user=current_user,
+        vehicles=vehicles,
+        subscription=subscription,
+        dashboard=dashboard,
+        plans=plans["plans"]
+    )
+
 # Include the router in the main app
 app.include_router(api_router)
 
+async def session_user_id(token: str) -> Optional[str]:
+    user = await get_user_by_token(token)
+    return user.user_id if user else None
+
+app.add_middleware(IdempotencyMiddleware, get_pool=get_db_pool, get_user_id=session_user_id)
+
+# Admission control runs before idempotency keys are claimed
+app.add_middleware(LoadSheddingMiddleware)
+
+# Outside idempotency, so stored responses stay uncompressed and are negotiated per replay
+app.add_middleware(CompressionMiddleware)
+
 app.add_middleware(
     CORSMiddleware,
     allow_credentials=True,
@@ -884,3 +1265,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+
+# Outermost, so the access log times everything including shed requests
+app.add_middleware(RequestLogMiddleware)
+
+startup_timer.mark("app")
@@ -0,0 +1,80 @@
+"""Bounded growth for user_sessions.
+
+Every login inserts a session row. Expired rows are deleted by a background
+sweeper in small index-ordered batches, and each user keeps at most
+`MAX_SESSIONS_PER_USER` sessions; older ones are dropped at login.
+"""
+import asyncio
+import logging
+import os
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL_SECONDS", str(10 * 60)))
+SWEEP_BATCH_SIZE = 500
+MAX_SESSIONS_PER_USER = int(os.getenv("MAX_SESSIONS_PER_USER", "10"))
+
+expired_deleted = metrics.counter("sessions_expired_deleted_total", "Expired sessions deleted by the sweeper")
+capped_deleted = metrics.counter("sessions_capped_deleted_total", "Sessions dropped by the per-user cap")
+last_sweep = metrics.gauge("sessions_last_sweep_timestamp_seconds", "Unix time of the last completed sweep")
+last_sweep_duration = metrics.gauge("sessions_last_sweep_duration_seconds", "Duration of the last sweep")
+
+
+async def install_session_indexes(conn):
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_expires_at ON user_sessions (expires_at)")
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_sessions_user ON user_sessions (user_id, created_at)")
+
+
+async def cap_sessions(conn, user_id: str, keep: int = MAX_SESSIONS_PER_USER) -> int:
+    """Drop all but the user's newest `keep` sessions."""
+    result = await conn.execute(
+        """DELETE FROM user_sessions WHERE id IN (
+               SELECT id FROM user_sessions WHERE user_id = $1
+               ORDER BY created_at DESC, id DESC OFFSET $2
+           )""",
+        user_id, keep
+    )
+    deleted = int(result.split()[-1])
+    if deleted:
+        capped_deleted.inc(deleted)
+    return deleted
+
+
+async def sweep_expired_sessions(pool) -> int:
+    started = time.monotonic()
+    total = 0
+    async with pool.acquire() as conn:
+        while True:
+            result = await conn.execute(
+                """DELETE FROM user_sessions WHERE id IN (
+                       SELECT id FROM user_sessions WHERE expires_at < NOW()
+                       ORDER BY expires_at LIMIT $1
+                   )""",
+                SWEEP_BATCH_SIZE
+            )
+            deleted = int(result.split()[-1])
+            total += deleted
+            expired_deleted.inc(deleted)
+            if deleted < SWEEP_BATCH_SIZE:
+                break
+            # Let request handlers in between batches
+            await asyncio.sleep(0)
+
+    last_sweep.set(time.time())
+    last_sweep_duration.set(round(time.monotonic() - started, 3))
+    if total:
+        logger.info(f"Deleted {total} expired sessions in {time.monotonic() - started:.2f}s")
+    return total
+
+
+async def sweep_sessions(pool, interval: float = SWEEP_INTERVAL):
+    """Background loop deleting expired sessions."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await sweep_expired_sessions(pool)
+        except Exception as e:
+            logger.error(f"Session sweep failed: {e}")
@@ -0,0 +1,331 @@
+"""Routing of per-user data across several Postgres databases.
+
+The primary database (DATABASE_URL) holds the global tables: users, sessions,
+jobs, idempotency keys, rate limits and the `user_shards` directory. Per-user
+data (vehicles, trips, expenses, subscriptions, sync state, location fixes)
+lives on the user's shard, which also keeps a copy of the user's `users` row
+for foreign keys.
+
+Extra shards are configured as SHARD_DATABASE_URLS="name=url,name=url". New
+users are placed by consistent hashing over all shard names and recorded in the
+directory. Users without a directory row live on the primary, where all data
+was before sharding. With no extra shards, routing is a no-op.
+
+A move freezes the user (requests get 503 + Retry-After), waits for directory
+caches to expire and in-flight requests to finish, copies the user's rows to
+the target in one transaction, flips the directory and deletes the originals.
+Only the moving user is affected.
+
+Usage:
+    python sharding.py move <user_id> <shard>   # move one user's rows
+    python sharding.py rebalance [--limit N]    # move users to their hashed shard
+"""
+import argparse
+import asyncio
+import bisect
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+
+import asyncpg
+from fastapi import HTTPException
+
+from health import close_pool
+
+logger = logging.getLogger(__name__)
+
+PRIMARY_SHARD = "primary"
+
+# Points per shard on the hash ring; more points even out the split
+VIRTUAL_NODES = 64
+
+DIRECTORY_CACHE_SECONDS = float(os.getenv("SHARD_DIRECTORY_CACHE_SECONDS", "5"))
+DIRECTORY_CACHE_SIZE = 100_000
+
+# Time for requests already routed to the source shard to finish before a copy
+MOVE_GRACE_SECONDS = float(os.getenv("SHARD_MOVE_GRACE_SECONDS", "10"))
+RETRY_AFTER_SECONDS = 5
+
+# Per-user tables in copy order, parents first; surrogate `id` keys are regenerated
+SHARDED_TABLES = ["vehicles", "subscriptions", "trips", "expenses", "location_fixes", "segmentation_state"]
+
+# Written by the change-log triggers while the tables above are copied, so
+# replaced with the source rows afterwards
+SYNC_TABLES = ["sync_state", "change_log"]
+
+# Rows spooled in memory per table before spilling to disk
+COPY_SPOOL_BYTES = 16 * 1024 * 1024
+
+
+def parse_shards(spec: str) -> dict:
+    shards = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, url = item.partition("=")
+        shards[name.strip()] = url.strip()
+    return shards
+
+
+def ring_position(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent hashing: adding a shard only takes keys from its ring neighbours."""
+
+    def __init__(self, names, vnodes: int = VIRTUAL_NODES):
+        points = sorted((ring_position(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self.positions = [position for position, _ in points]
+        self.names = [name for _, name in points]
+
+    def shard_for(self, key: str) -> str:
+        i = bisect.bisect(self.positions, ring_position(key)) % len(self.positions)
+        return self.names[i]
+
+
+async def install_shard_directory(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_shards (
+            user_id VARCHAR(255) PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            shard VARCHAR(100) NOT NULL,
+            moving BOOLEAN NOT NULL DEFAULT FALSE,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        )
+    ''')
+
+
+class ShardRouter:
+    def __init__(self, urls: dict):
+        self.urls = urls
+        self.pools = {}
+        self.ring = HashRing([PRIMARY_SHARD, *urls])
+        # user_id -> (shard, moving, expires at)
+        self.directory = {}
+
+    @property
+    def sharded(self) -> bool:
+        return bool(self.urls)
+
+    @property
+    def primary(self):
+        return self.pools[PRIMARY_SHARD]
+
+    def all_pools(self):
+        return list(self.pools.values())
+
+    async def start(self, primary_pool, create_pool):
+        self.pools[PRIMARY_SHARD] = primary_pool
+        for name, url in self.urls.items():
+            if name not in self.pools:
+                self.pools[name] = await create_pool(url)
+
+    async def close(self):
+        for name, pool in list(self.pools.items()):
+            if name != PRIMARY_SHARD:
+                await close_pool(pool)
+        self.pools = {name: pool for name, pool in self.pools.items() if name == PRIMARY_SHARD}
+
+    async def lookup(self, user_id: str, cached: bool = True):
+        """(shard, moving) for the user from the directory."""
+        now = time.monotonic()
+        entry = self.directory.get(user_id)
+        if cached and entry is not None and entry[2] > now:
+            return entry[0], entry[1]
+
+        async with self.primary.acquire() as conn:
+            row = await conn.fetchrow("SELECT shard, moving FROM user_shards WHERE user_id = $1", user_id)
+        shard, moving = (row['shard'], row['moving']) if row else (PRIMARY_SHARD, False)
+        if len(self.directory) >= DIRECTORY_CACHE_SIZE:
+            self.directory.clear()
+        self.directory[user_id] = (shard, moving, now + DIRECTORY_CACHE_SECONDS)
+        return shard, moving
+
+    async def pool_for(self, user_id: str):
+        """Pool of the database holding the user's data."""
+        if not self.sharded:
+            return self.primary
+        shard, moving = await self.lookup(user_id)
+        if moving:
+            raise HTTPException(
+                status_code=503,
+                detail="Account is being moved, please retry shortly",
+                headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+            )
+        return self.pools[shard]
+
+    async def place_new_user(self, conn, user_id: str):
+        """Record the hashed shard of a newly created user; `conn` is on the primary."""
+        if not self.sharded:
+            return
+        shard = self.ring.shard_for(user_id)
+        if shard != PRIMARY_SHARD:
+            user = await conn.fetchrow(
+                "SELECT user_id, email, name, picture, created_at FROM users WHERE user_id = $1",
+                user_id
+            )
+            async with self.pools[shard].acquire() as shard_conn:
+                await copy_user_row(shard_conn, user)
+        await conn.execute(
+            "INSERT INTO user_shards (user_id, shard) VALUES ($1, $2) ON CONFLICT (user_id) DO NOTHING",
+            user_id, shard
+        )
+
+
+async def copy_user_row(conn, user):
+    await conn.execute(
+        """INSERT INTO users (user_id, email, name, picture, created_at) VALUES ($1, $2, $3, $4, $5)
+           ON CONFLICT (user_id) DO NOTHING""",
+        *user
+    )
+
+
+async def table_columns(conn, table: str):
+    rows = await conn.fetch(
+        """SELECT column_name FROM information_schema.columns
+           WHERE table_schema = current_schema() AND table_name = $1
+             AND column_name <> 'id' AND is_generated = 'NEVER'
+           ORDER BY ordinal_position""",
+        table
+    )
+    return [row['column_name'] for row in rows]
+
+
+async def copy_user(source, target, user_id: str) -> dict:
+    """Copy the user's rows from one pool to another, replacing any on the target."""
+    counts = {}
+    async with source.acquire() as src, target.acquire() as dst:
+        async with src.transaction(isolation='repeatable_read', readonly=True), dst.transaction():
+            user = await src.fetchrow(
+                "SELECT user_id, email, name, picture, created_at FROM users WHERE user_id = $1",
+                user_id
+            )
+            await copy_user_row(dst, user)
+            # Leftovers of an earlier interrupted move
+            for table in [*reversed(SHARDED_TABLES), *SYNC_TABLES]:
+                await dst.execute(f"DELETE FROM {table} WHERE user_id = $1", user_id)
+
+            for table in [*SHARDED_TABLES, *SYNC_TABLES]:
+                if table in SYNC_TABLES:
+                    await dst.execute(f"DELETE FROM {table} WHERE user_id = $1", user_id)
+                columns = await table_columns(dst, table)
+                with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_BYTES) as spool:
+                    await src.copy_from_query(
+                        f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = $1",
+                        user_id, output=spool, format="binary"
+                    )
+                    spool.seek(0)
+                    result = await dst.copy_to_table(table, source=spool, columns=columns, format="binary")
+                counts[table] = int(result.split()[-1])
+    return counts
+
+
+async def delete_user_rows(pool, user_id: str, keep_user: bool):
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            for table in [*reversed(SHARDED_TABLES), *SYNC_TABLES]:
+                await conn.execute(f"DELETE FROM {table} WHERE user_id = $1", user_id)
+            if not keep_user:
+                await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+
+
+async def set_moving(conn, user_id: str, shard: str, moving: bool):
+    await conn.execute(
+        """INSERT INTO user_shards (user_id, shard, moving) VALUES ($1, $2, $3)
+           ON CONFLICT (user_id) DO UPDATE SET shard = $2, moving = $3, updated_at = NOW()""",
+        user_id, shard, moving
+    )
+
+
+async def move_user(router: ShardRouter, user_id: str, target: str, grace: float = MOVE_GRACE_SECONDS) -> dict:
+    """Move one user's rows to `target` while every other user keeps being served."""
+    if target not in router.pools:
+        raise ValueError(f"Unknown shard: {target}")
+    source, moving = await router.lookup(user_id, cached=False)
+    if moving:
+        raise ValueError(f"{user_id} is already being moved")
+    if source == target:
+        return {}
+
+    async with router.primary.acquire() as conn:
+        await set_moving(conn, user_id, source, True)
+    try:
+        await asyncio.sleep(DIRECTORY_CACHE_SECONDS + grace)
+        counts = await copy_user(router.pools[source], router.pools[target], user_id)
+    except BaseException:
+        async with router.primary.acquire() as conn:
+            await set_moving(conn, user_id, source, False)
+        raise
+
+    async with router.primary.acquire() as conn:
+        await set_moving(conn, user_id, target, False)
+    # The primary keeps every users row; shards only their own users'
+    await delete_user_rows(router.pools[source], user_id, keep_user=source == PRIMARY_SHARD)
+    logger.info(f"Moved {user_id} from {source} to {target}: {counts}")
+    return counts
+
+
+async def rebalance(router: ShardRouter, limit: int = None, grace: float = MOVE_GRACE_SECONDS) -> int:
+    """Move users whose shard differs from their place on the hash ring."""
+    moved = 0
+    last_user = ""
+    while limit is None or moved < limit:
+        async with router.primary.acquire() as conn:
+            batch = await conn.fetch(
+                """SELECT u.user_id, coalesce(s.shard, $2) AS shard FROM users u
+                   LEFT JOIN user_shards s ON s.user_id = u.user_id
+                   WHERE u.user_id > $1 ORDER BY u.user_id LIMIT 500""",
+                last_user, PRIMARY_SHARD
+            )
+        if not batch:
+            break
+        for user_id, shard in batch:
+            target = router.ring.shard_for(user_id)
+            if target != shard and (limit is None or moved < limit):
+                await move_user(router, user_id, target, grace)
+                moved += 1
+        last_user = batch[-1]['user_id']
+    return moved
+
+
+shard_router = ShardRouter(parse_shards(os.getenv("SHARD_DATABASE_URLS", "")))
+
+
+@asynccontextmanager
+async def cli_router():
+    """A router with small pools to the primary and every shard, for command line tools."""
+    router = ShardRouter(parse_shards(os.getenv("SHARD_DATABASE_URLS", "")))
+    primary = await asyncpg.create_pool(os.environ['DATABASE_URL'], min_size=1, max_size=2)
+    try:
+        await router.start(primary, lambda url: asyncpg.create_pool(url, min_size=1, max_size=2))
+        yield router
+    finally:
+        await router.close()
+        await primary.close()
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-user database shards")
+    sub = parser.add_subparsers(dest="command", required=True)
+    move_parser = sub.add_parser("move", help="move one user's rows to another shard")
+    move_parser.add_argument("user_id")
+    move_parser.add_argument("shard")
+    rebalance_parser = sub.add_parser("rebalance", help="move users to their consistent-hash shard")
+    rebalance_parser.add_argument("--limit", type=int)
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / '.env')
+
+    async with cli_router() as router:
+        if args.command == "move":
+            print(await move_user(router, args.user_id, args.shard))
+        elif args.command == "rebalance":
+            print(f"Moved {await rebalance(router, args.limit)} users")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -0,0 +1,42 @@
+"""Coalesce identical concurrent calls into one in-flight computation.
+
+Apps resuming from the background fire the same read several times within
+milliseconds. A handler wrapped with `single_flight` runs once per distinct
+set of arguments at a time; callers arriving while it runs await the same
+task and share its result (or exception).
+"""
+import asyncio
+import functools
+
+import metrics
+
+shared_calls = metrics.counter("singleflight_shared_total", "Calls served by an identical in-flight call")
+
+
+def _key_part(value):
+    # Authenticated users are identified by id rather than by every profile field
+    user_id = getattr(value, "user_id", None)
+    return user_id if user_id is not None else repr(value)
+
+
+def single_flight(func):
+    """Opt-in coalescing for read handlers whose arguments fully determine the result."""
+    in_flight = {}
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        key = (
+            tuple(_key_part(a) for a in args),
+            tuple(sorted((name, _key_part(value)) for name, value in kwargs.items())),
+        )
+        task = in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            in_flight[key] = task
+            task.add_done_callback(lambda _: in_flight.pop(key, None))
+        else:
+            shared_calls.inc()
+        # A disconnecting caller must not cancel the work the others wait for
+        return await asyncio.shield(task)
+
+    return wrapper
@@ -0,0 +1,81 @@
+"""Cold start helpers: lazy imports and the startup time report.
+
+`server` is imported first thing by uvicorn, so everything it imports eagerly
+delays the first request. Modules only some requests need (numpy for location
+segmentation, Pillow for receipts, httpx for the OAuth exchange) are loaded
+with `lazy_import` on first use instead.
+
+The server answers requests while pools and schema are brought up in the
+background. `startup_timer` records how long each phase took; the breakdown is
+logged once the server is ready and served by /api/health.
+"""
+import importlib.util
+import logging
+import os
+import sys
+import time
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+startup_seconds = metrics.gauge("startup_seconds", "Seconds from process start until ready")
+
+
+def lazy_import(name: str):
+    """The module, executed on first attribute access rather than now."""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"No module named {name!r}", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def process_age() -> float:
+    """Seconds since this process started (Linux), 0 where unknown."""
+    try:
+        with open("/proc/self/stat") as f:
+            # Fields after the parenthesized command name; starttime is field 22
+            started_ticks = int(f.read().rpartition(")")[2].split()[19])
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, ValueError, IndexError):
+        return 0.0
+    return max(uptime - started_ticks / os.sysconf("SC_CLK_TCK"), 0.0)
+
+
+class StartupTimer:
+    """Durations of consecutive startup phases, each ending at `mark`."""
+
+    def __init__(self):
+        # Interpreter and server launch before this module was imported
+        self.phases = {"interpreter": process_age()}
+        self.last = time.perf_counter()
+        self.ready = False
+
+    def mark(self, phase: str):
+        now = time.perf_counter()
+        self.phases[phase] = self.phases.get(phase, 0.0) + now - self.last
+        self.last = now
+
+    def finish(self):
+        self.ready = True
+        total = sum(self.phases.values())
+        startup_seconds.set(round(total, 3))
+        breakdown = ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.phases.items())
+        logger.info(f"Ready in {total:.2f}s: {breakdown}")
+
+    def report(self) -> dict:
+        return {
+            "ready": self.ready,
+            "phases": {phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+        }
+
+
+startup_timer = StartupTimer()
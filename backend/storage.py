@@ -0,0 +1,507 @@
+"""Storage backends for users, sessions, vehicles, trips, expenses and subscriptions.
+
+Handlers reach these records through `Storage`. `PostgresStorage` (the default)
+runs the statements in repository.py on the user's shard. `MemoryStorage` keeps
+everything in dicts, with trips and expenses held per user in time order, so
+the API can run in-process without a database (STORAGE_BACKEND=memory), e.g.
+for the test suite.
+
+Both return rows as mappings with the same keys and values, distances in miles
+and amounts in dollars rounded exactly as the SQL does. Features built on
+Postgres itself (sync, search, exports, jobs, live tracking, location uploads)
+are not part of the interface and are unavailable on the memory backend.
+"""
+from abc import ABC, abstractmethod
+import bisect
+from collections import defaultdict
+from datetime import datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal
+import os
+
+import receipts
+import repository
+from analytics import truncate
+from repository import METERS_PER_MILE, TRIP_UPDATE_FIELDS, cents, meters
+from sessions import MAX_SESSIONS_PER_USER, cap_sessions
+from sharding import shard_router
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "postgres")
+
+
+class Storage(ABC):
+    """The record operations handlers use; every method is scoped to one user."""
+
+    # Users & sessions
+    @abstractmethod
+    async def get_session_user(self, token: str):
+        """User fields plus the session's expires_at, or None."""
+
+    @abstractmethod
+    async def upsert_user(self, user_id: str, email: str, name: str, picture) -> str:
+        """Create the user unless the email is known; returns the stored user_id."""
+
+    @abstractmethod
+    async def create_session(self, user_id: str, session_token: str, expires_at):
+        """Store a session, dropping all but the user's newest MAX_SESSIONS_PER_USER."""
+
+    @abstractmethod
+    async def delete_session(self, session_token: str):
+        ...
+
+    # Vehicles
+    @abstractmethod
+    async def insert_vehicle(self, vehicle_id: str, user_id: str, vehicle):
+        ...
+
+    @abstractmethod
+    async def list_vehicles(self, user_id: str):
+        ...
+
+    @abstractmethod
+    async def delete_vehicle(self, vehicle_id: str, user_id: str) -> bool:
+        ...
+
+    # Trips
+    @abstractmethod
+    async def insert_trip(self, trip_id: str, user_id: str, trip):
+        ...
+
+    @abstractmethod
+    async def list_trips(self, user_id: str):
+        """The latest LIST_LIMIT trips, newest first."""
+
+    @abstractmethod
+    async def update_trip(self, trip_id: str, user_id: str, fields: dict):
+        """Apply the non-None TRIP_UPDATE_FIELDS; returns the trip or None."""
+
+    @abstractmethod
+    async def delete_trip(self, trip_id: str, user_id: str) -> bool:
+        ...
+
+    @abstractmethod
+    async def count_auto_trips_since(self, user_id: str, since) -> int:
+        ...
+
+    # Expenses
+    @abstractmethod
+    async def insert_expense(self, expense_id: str, user_id: str, expense, receipt=None, thumbnail=None):
+        ...
+
+    @abstractmethod
+    async def list_expenses(self, user_id: str):
+        """The latest LIST_LIMIT expenses, newest first."""
+
+    @abstractmethod
+    async def get_receipt(self, expense_id: str, user_id: str):
+        ...
+
+    @abstractmethod
+    async def delete_expense(self, expense_id: str, user_id: str) -> bool:
+        ...
+
+    # Dashboard & reports
+    @abstractmethod
+    async def dashboard_totals(self, user_id: str, month_start, year_start):
+        """month_miles and year_miles of business trips, total_expenses since year_start."""
+
+    @abstractmethod
+    async def tax_report_totals(self, user_id: str, start, end):
+        """total_miles, business_miles and total_expenses between start and end, inclusive."""
+
+    # Analytics
+    @abstractmethod
+    async def change_seq(self, user_id: str) -> int:
+        """Counter bumped by every write to the user's vehicles, trips and expenses."""
+
+    @abstractmethod
+    async def timeseries(self, user_id: str, metric: str, bucket: str, group_by, start, end):
+        """bucket, series and value rows of a metric for start <= time < end, see analytics.py."""
+
+    # Subscriptions
+    @abstractmethod
+    async def get_active_plan(self, user_id: str):
+        ...
+
+    @abstractmethod
+    async def create_subscription(self, subscription_id: str, user_id: str, plan_type: str):
+        ...
+
+    @abstractmethod
+    async def change_plan(self, subscription_id: str, user_id: str, plan_type: str):
+        """Cancel the active subscriptions and start one on `plan_type`."""
+
+
+class PostgresStorage(Storage):
+    """Global tables on the primary pool, per-user tables on the user's shard."""
+
+    def __init__(self, get_pool, get_user_pool):
+        self.get_pool = get_pool
+        self.get_user_pool = get_user_pool
+
+    async def _run(self, user_id: str, statement, *args):
+        pool = await self.get_user_pool(user_id)
+        async with pool.acquire() as conn:
+            return await statement(conn, *args)
+
+    async def get_session_user(self, token):
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            return await repository.get_session_user(conn, token)
+
+    async def upsert_user(self, user_id, email, name, picture):
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            stored_id = await repository.upsert_user(conn, user_id, email, name, picture)
+            if stored_id == user_id:
+                await shard_router.place_new_user(conn, user_id)
+            return stored_id
+
+    async def create_session(self, user_id, session_token, expires_at):
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await repository.create_session(conn, user_id, session_token, expires_at)
+            await cap_sessions(conn, user_id)
+
+    async def delete_session(self, session_token):
+        pool = await self.get_pool()
+        async with pool.acquire() as conn:
+            await repository.delete_session(conn, session_token)
+
+    async def insert_vehicle(self, vehicle_id, user_id, vehicle):
+        return await self._run(user_id, repository.insert_vehicle, vehicle_id, user_id, vehicle)
+
+    async def list_vehicles(self, user_id):
+        return await self._run(user_id, repository.list_vehicles, user_id)
+
+    async def delete_vehicle(self, vehicle_id, user_id):
+        return await self._run(user_id, repository.delete_vehicle, vehicle_id, user_id)
+
+    async def insert_trip(self, trip_id, user_id, trip):
+        return await self._run(user_id, repository.insert_trip, trip_id, user_id, trip)
+
+    async def list_trips(self, user_id):
+        return await self._run(user_id, repository.list_trips, user_id)
+
+    async def update_trip(self, trip_id, user_id, fields):
+        return await self._run(user_id, repository.update_trip, trip_id, user_id, fields)
+
+    async def delete_trip(self, trip_id, user_id):
+        return await self._run(user_id, repository.delete_trip, trip_id, user_id)
+
+    async def count_auto_trips_since(self, user_id, since):
+        return await self._run(user_id, repository.count_auto_trips_since, user_id, since)
+
+    async def insert_expense(self, expense_id, user_id, expense, receipt=None, thumbnail=None):
+        return await self._run(user_id, repository.insert_expense, expense_id, user_id, expense, receipt, thumbnail)
+
+    async def list_expenses(self, user_id):
+        return await self._run(user_id, repository.list_expenses, user_id)
+
+    async def get_receipt(self, expense_id, user_id):
+        return await self._run(user_id, receipts.get_receipt, expense_id, user_id)
+
+    async def delete_expense(self, expense_id, user_id):
+        return await self._run(user_id, repository.delete_expense, expense_id, user_id)
+
+    async def dashboard_totals(self, user_id, month_start, year_start):
+        return await self._run(user_id, repository.dashboard_totals, user_id, month_start, year_start)
+
+    async def tax_report_totals(self, user_id, start, end):
+        return await self._run(user_id, repository.tax_report_totals, user_id, start, end)
+
+    async def change_seq(self, user_id):
+        return await self._run(user_id, repository.change_seq, user_id)
+
+    async def timeseries(self, user_id, metric, bucket, group_by, start, end):
+        return await self._run(user_id, repository.timeseries, user_id, metric, bucket, group_by, start, end)
+
+    async def get_active_plan(self, user_id):
+        return await self._run(user_id, repository.get_active_plan, user_id)
+
+    async def create_subscription(self, subscription_id, user_id, plan_type):
+        await self._run(user_id, repository.create_subscription, subscription_id, user_id, plan_type)
+
+    async def change_plan(self, subscription_id, user_id, plan_type):
+        pool = await self.get_user_pool(user_id)
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await repository.cancel_subscriptions(conn, user_id)
+                await repository.create_subscription(conn, subscription_id, user_id, plan_type)
+
+
+def utc(value):
+    """timestamptz semantics: naive datetimes are UTC, results come back in UTC."""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def to_miles(distance_m: int) -> float:
+    # round(numeric, 3) rounds half away from zero
+    return float((Decimal(distance_m) / Decimal(str(METERS_PER_MILE))).quantize(Decimal("0.001"), ROUND_HALF_UP))
+
+
+class TimeIndex:
+    """Rows kept per user in order of one timestamp column, for range scans by bisection."""
+
+    def __init__(self, column: str):
+        self.column = column
+        # user_id -> sorted [(time, row id)]
+        self.keys = defaultdict(list)
+        self.rows = {}
+
+    def add(self, row_id: str, row: dict):
+        self.rows[row_id] = row
+        bisect.insort(self.keys[row['user_id']], (row[self.column], row_id))
+
+    def get(self, row_id: str, user_id: str):
+        row = self.rows.get(row_id)
+        return row if row is not None and row['user_id'] == user_id else None
+
+    def remove(self, row_id: str, user_id: str):
+        row = self.get(row_id, user_id)
+        if row is not None:
+            keys = self.keys[user_id]
+            del keys[bisect.bisect_left(keys, (row[self.column], row_id))]
+            del self.rows[row_id]
+        return row
+
+    def between(self, user_id: str, start=None, end=None):
+        """Rows with start <= time <= end, oldest first; either bound may be None."""
+        keys = self.keys.get(user_id, [])
+        lo = bisect.bisect_left(keys, (start,)) if start is not None else 0
+        # (end, chr(0x10FFFF)) sorts after every (end, row id)
+        hi = bisect.bisect_right(keys, (end, chr(0x10FFFF))) if end is not None else len(keys)
+        return [self.rows[row_id] for _, row_id in keys[lo:hi]]
+
+    def latest(self, user_id: str, limit: int):
+        keys = self.keys.get(user_id, [])
+        return [self.rows[row_id] for _, row_id in reversed(keys[-limit:])]
+
+    def for_user(self, user_id: str):
+        return self.between(user_id)
+
+
+class MemoryStorage(Storage):
+    """Process-local storage for tests and demos; nothing survives a restart."""
+
+    def __init__(self):
+        self.users = {}
+        self.user_ids_by_email = {}
+        self.sessions = {}
+        self.vehicles = {}
+        self.trips = TimeIndex("start_time")
+        self.expenses = TimeIndex("date")
+        # user_id -> subscriptions in creation order
+        self.subscriptions = defaultdict(list)
+        # user_id -> writes to vehicles, trips and expenses, like sync_state.seq
+        self.seq = defaultdict(int)
+
+    # Users & sessions
+    async def get_session_user(self, token):
+        session = self.sessions.get(token)
+        if session is None:
+            return None
+        return {**self.users[session['user_id']], "expires_at": session['expires_at']}
+
+    async def upsert_user(self, user_id, email, name, picture):
+        if email in self.user_ids_by_email:
+            return self.user_ids_by_email[email]
+        self.users[user_id] = {
+            "user_id": user_id, "email": email, "name": name, "picture": picture,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self.user_ids_by_email[email] = user_id
+        return user_id
+
+    async def create_session(self, user_id, session_token, expires_at):
+        self.sessions[session_token] = {
+            "user_id": user_id, "expires_at": utc(expires_at), "created_at": datetime.now(timezone.utc),
+        }
+        # Dicts keep insertion order, so the user's oldest sessions come first
+        tokens = [token for token, s in self.sessions.items() if s['user_id'] == user_id]
+        for token in tokens[:-MAX_SESSIONS_PER_USER]:
+            del self.sessions[token]
+
+    async def delete_session(self, session_token):
+        self.sessions.pop(session_token, None)
+
+    # Vehicles
+    async def insert_vehicle(self, vehicle_id, user_id, vehicle):
+        row = {
+            "vehicle_id": vehicle_id, "user_id": user_id, "name": vehicle.name, "make": vehicle.make,
+            "model": vehicle.model, "year": vehicle.year, "business_percentage": vehicle.business_percentage,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self.vehicles[vehicle_id] = row
+        self.seq[user_id] += 1
+        return dict(row)
+
+    async def list_vehicles(self, user_id):
+        rows = [dict(v) for v in self.vehicles.values() if v['user_id'] == user_id]
+        return sorted(rows, key=lambda v: v['created_at'], reverse=True)
+
+    async def delete_vehicle(self, vehicle_id, user_id):
+        vehicle = self.vehicles.get(vehicle_id)
+        if vehicle is None or vehicle['user_id'] != user_id:
+            return False
+        del self.vehicles[vehicle_id]
+        self.seq[user_id] += 1
+        # ON DELETE SET NULL
+        for row in [*self.trips.for_user(user_id), *self.expenses.for_user(user_id)]:
+            if row['vehicle_id'] == vehicle_id:
+                row['vehicle_id'] = None
+        return True
+
+    # Trips
+    @staticmethod
+    def trip_row(row: dict) -> dict:
+        trip = {k: v for k, v in row.items() if k != "distance_m"}
+        trip["distance"] = to_miles(row['distance_m'])
+        return trip
+
+    async def insert_trip(self, trip_id, user_id, trip):
+        row = {
+            "trip_id": trip_id, "user_id": user_id, "vehicle_id": trip.vehicle_id,
+            "start_time": utc(trip.start_time), "end_time": utc(trip.end_time),
+            "distance_m": meters(trip.distance), "start_location": trip.start_location,
+            "end_location": trip.end_location, "purpose": trip.purpose, "is_business": trip.is_business,
+            "is_automatic": trip.is_automatic, "created_at": datetime.now(timezone.utc),
+        }
+        self.trips.add(trip_id, row)
+        self.seq[user_id] += 1
+        return self.trip_row(row)
+
+    async def list_trips(self, user_id):
+        return [self.trip_row(t) for t in self.trips.latest(user_id, repository.LIST_LIMIT)]
+
+    async def update_trip(self, trip_id, user_id, fields):
+        row = self.trips.remove(trip_id, user_id)
+        if row is None:
+            return None
+        for field, column in TRIP_UPDATE_FIELDS.items():
+            value = fields.get(field)
+            if value is None:
+                continue
+            if field == "distance":
+                value = meters(value)
+            elif field in ("start_time", "end_time"):
+                value = utc(value)
+            row[column] = value
+        self.trips.add(trip_id, row)
+        self.seq[user_id] += 1
+        return self.trip_row(row)
+
+    async def delete_trip(self, trip_id, user_id):
+        if self.trips.remove(trip_id, user_id) is None:
+            return False
+        self.seq[user_id] += 1
+        return True
+
+    async def count_auto_trips_since(self, user_id, since):
+        since = utc(since)
+        return sum(1 for t in self.trips.for_user(user_id) if t['is_automatic'] and t['created_at'] >= since)
+
+    # Expenses
+    @staticmethod
+    def expense_row(row: dict) -> dict:
+        expense = {k: v for k, v in row.items() if k not in ("amount_cents", "receipt_image_base64")}
+        expense["amount"] = row['amount_cents'] / 100.0
+        expense["receipt_url"] = (
+            f"/api/expenses/{row['expense_id']}/receipt" if row['receipt_thumbnail_base64'] is not None else None
+        )
+        return expense
+
+    async def insert_expense(self, expense_id, user_id, expense, receipt=None, thumbnail=None):
+        row = {
+            "expense_id": expense_id, "user_id": user_id, "vehicle_id": expense.vehicle_id,
+            "amount_cents": cents(expense.amount), "category": expense.category, "date": utc(expense.date),
+            "notes": expense.notes, "receipt_image_base64": receipt, "receipt_thumbnail_base64": thumbnail,
+            "created_at": datetime.now(timezone.utc),
+        }
+        self.expenses.add(expense_id, row)
+        self.seq[user_id] += 1
+        return self.expense_row(row)
+
+    async def list_expenses(self, user_id):
+        return [self.expense_row(e) for e in self.expenses.latest(user_id, repository.LIST_LIMIT)]
+
+    async def get_receipt(self, expense_id, user_id):
+        row = self.expenses.get(expense_id, user_id)
+        return row['receipt_image_base64'] if row is not None else None
+
+    async def delete_expense(self, expense_id, user_id):
+        if self.expenses.remove(expense_id, user_id) is None:
+            return False
+        self.seq[user_id] += 1
+        return True
+
+    # Dashboard & reports
+    async def dashboard_totals(self, user_id, month_start, year_start):
+        month_start = utc(month_start)
+        business = [t for t in self.trips.between(user_id, utc(year_start)) if t['is_business']]
+        return {
+            "month_miles": sum(t['distance_m'] for t in business if t['start_time'] >= month_start) / METERS_PER_MILE,
+            "year_miles": sum(t['distance_m'] for t in business) / METERS_PER_MILE,
+            "total_expenses": sum(e['amount_cents'] for e in self.expenses.between(user_id, utc(year_start))) / 100.0,
+        }
+
+    async def tax_report_totals(self, user_id, start, end):
+        trips = self.trips.between(user_id, utc(start), utc(end))
+        return {
+            "total_miles": sum(t['distance_m'] for t in trips) / METERS_PER_MILE,
+            "business_miles": sum(t['distance_m'] for t in trips if t['is_business']) / METERS_PER_MILE,
+            "total_expenses": sum(e['amount_cents'] for e in self.expenses.between(user_id, utc(start), utc(end))) / 100.0,
+        }
+
+    # Analytics
+    async def change_seq(self, user_id):
+        return self.seq[user_id]
+
+    async def timeseries(self, user_id, metric, bucket, group_by, start, end):
+        start, end = utc(start), utc(end)
+        index = self.expenses if metric == "expenses" else self.trips
+        totals = defaultdict(int)
+        for row in index.between(user_id, start, end):
+            if row[index.column] == end:
+                continue
+            if group_by is None:
+                series = "total"
+            elif group_by == "vehicle":
+                series = row['vehicle_id']
+            elif group_by == "category":
+                series = row['category']
+            else:
+                series = "business" if row['is_business'] else "personal"
+            key = (truncate(row[index.column], bucket), series)
+            if metric == "expenses":
+                totals[key] += row['amount_cents']
+            elif metric == "trips":
+                totals[key] += 1
+            else:
+                totals[key] += row['distance_m'] if metric == "miles" or row['is_business'] else 0
+        scale = {"miles": METERS_PER_MILE, "business_miles": METERS_PER_MILE, "trips": 1, "expenses": 100.0}[metric]
+        return [
+            {"bucket": bucket_start, "series": series, "value": total / scale}
+            for (bucket_start, series), total in totals.items()
+        ]
+
+    # Subscriptions
+    async def get_active_plan(self, user_id):
+        active = [s for s in self.subscriptions[user_id] if s['status'] == 'active']
+        return active[-1]['plan_type'] if active else None
+
+    async def create_subscription(self, subscription_id, user_id, plan_type):
+        self.subscriptions[user_id].append({
+            "subscription_id": subscription_id, "plan_type": plan_type, "status": "active",
+            "created_at": datetime.now(timezone.utc), "end_date": None,
+        })
+
+    async def change_plan(self, subscription_id, user_id, plan_type):
+        for subscription in self.subscriptions[user_id]:
+            if subscription['status'] == 'active':
+                subscription['status'] = 'cancelled'
+                subscription['end_date'] = datetime.now(timezone.utc)
+        await self.create_subscription(subscription_id, user_id, plan_type)
@@ -0,0 +1,148 @@
+"""Per-user change log backing the delta sync endpoint.
+
+Row triggers on vehicles, trips and expenses record every write in
+`change_log`, numbered from a per-user counter in `sync_state`. The counter
+row is locked by each write, so a user's sequence numbers are handed out in
+commit order and a client cursor never skips a change. The log keeps only the
+latest entry per entity, which turns deletes into compact tombstones.
+
+Maintenance that moves rows without changing them (between partitions, say)
+runs `skip_change_log` first, so the move is not synced as deletes.
+"""
+import logging
+
+from repository import TABLE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# Synced table -> external id column
+SYNCED_TABLES = {
+    "vehicles": "vehicle_id",
+    "trips": "trip_id",
+    "expenses": "expense_id",
+}
+
+SYNC_PAGE_SIZE = 500
+
+
+async def install_change_log(conn):
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS sync_state (
+            user_id VARCHAR(255) PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            seq BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS change_log (
+            user_id VARCHAR(255) NOT NULL REFERENCES users(user_id) ON DELETE CASCADE,
+            entity VARCHAR(20) NOT NULL,
+            entity_id VARCHAR(255) NOT NULL,
+            op VARCHAR(10) NOT NULL,
+            seq BIGINT NOT NULL,
+            changed_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (user_id, entity, entity_id)
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_change_log_user_seq ON change_log (user_id, seq)")
+
+    await conn.execute('''
+        CREATE OR REPLACE FUNCTION log_change() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+            next_seq BIGINT;
+        BEGIN
+            -- Set by skip_change_log for the rest of a transaction
+            IF current_setting('ledger.skip_change_log', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+
+            -- Writes cascading from a deleted user account need no log
+            IF NOT EXISTS (SELECT 1 FROM users WHERE user_id = rec.user_id) THEN
+                RETURN NULL;
+            END IF;
+
+            INSERT INTO sync_state (user_id, seq) VALUES (rec.user_id, 1)
+            ON CONFLICT (user_id) DO UPDATE SET seq = sync_state.seq + 1
+            RETURNING seq INTO next_seq;
+
+            INSERT INTO change_log (user_id, entity, entity_id, op, seq)
+            VALUES (
+                rec.user_id, TG_ARGV[0], to_jsonb(rec) ->> TG_ARGV[1],
+                CASE WHEN TG_OP = 'DELETE' THEN 'delete' ELSE 'upsert' END, next_seq
+            )
+            ON CONFLICT (user_id, entity, entity_id)
+            DO UPDATE SET op = EXCLUDED.op, seq = EXCLUDED.seq, changed_at = NOW();
+
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+
+    for table in SYNCED_TABLES:
+        await install_change_trigger(conn, table)
+
+
+async def skip_change_log(conn):
+    """Stop logging changes until the current transaction ends."""
+    await conn.execute("SET LOCAL ledger.skip_change_log = 'on'")
+
+
+async def install_change_trigger(conn, table: str):
+    await conn.execute(
+        f"""CREATE OR REPLACE TRIGGER {table}_change_log
+            AFTER INSERT OR UPDATE OR DELETE ON {table}
+            FOR EACH ROW EXECUTE FUNCTION log_change('{table}', '{SYNCED_TABLES[table]}')"""
+    )
+
+
+async def fetch_changes(conn, user_id: str, since: int, limit: int = SYNC_PAGE_SIZE):
+    """Rows changed after `since` plus tombstones, read from one snapshot.
+
+    Returns (cursor, has_more, rows_by_table, deleted_by_table). A `since`
+    of 0 returns a full snapshot of the user's data.
+    """
+    rows = {table: [] for table in SYNCED_TABLES}
+    deleted = {table: [] for table in SYNCED_TABLES}
+
+    async with conn.transaction(isolation='repeatable_read', readonly=True):
+        if since <= 0:
+            cursor = await conn.fetchval(
+                "SELECT seq FROM sync_state WHERE user_id = $1",
+                user_id
+            ) or 0
+            for table in SYNCED_TABLES:
+                rows[table] = await conn.fetch(
+                    f"SELECT {TABLE_COLUMNS[table]} FROM {table} WHERE user_id = $1",
+                    user_id
+                )
+            return cursor, False, rows, deleted
+
+        changes = await conn.fetch(
+            """SELECT entity, entity_id, op, seq FROM change_log
+               WHERE user_id = $1 AND seq > $2 ORDER BY seq LIMIT $3""",
+            user_id, since, limit
+        )
+
+        changed = {table: [] for table in SYNCED_TABLES}
+        for change in changes:
+            if change['op'] == 'delete':
+                deleted[change['entity']].append(change['entity_id'])
+            else:
+                changed[change['entity']].append(change['entity_id'])
+
+        for table, ids in changed.items():
+            if ids:
+                rows[table] = await conn.fetch(
+                    f"SELECT {TABLE_COLUMNS[table]} FROM {table} WHERE user_id = $1 AND {SYNCED_TABLES[table]} = ANY($2)",
+                    user_id, ids
+                )
+
+    cursor = changes[-1]['seq'] if changes else since
+    return cursor, len(changes) == limit, rows, deleted
@@ -0,0 +1,185 @@
+"""Merge overlapping automatic trips.
+
+Retries and double-started tracking leave overlapping `is_automatic` trips for
+the same vehicle, which inflate mileage totals and plan usage. For each
+(user, vehicle) the trips are swept in start order by window functions: a trip
+starting before the latest end seen so far joins the current cluster. Each
+cluster becomes its first trip stretched to the cluster's end. Every trip's
+distance counts only for the part of its interval no earlier trip covered, so
+exact duplicates add nothing.
+
+Users are processed one at a time and clusters are streamed from a cursor, so
+memory is bounded by the largest cluster, not by the number of trips. The
+primary and every shard in SHARD_DATABASE_URLS are processed in turn.
+
+Usage:
+    python trip_dedup.py diff    # print the merges that would be made
+    python trip_dedup.py apply   # make them, printing the same diff
+"""
+import argparse
+import asyncio
+import logging
+import sys
+from pathlib import Path
+
+import asyncpg
+
+from repository import METERS_PER_MILE
+from sharding import cli_router
+
+logger = logging.getLogger(__name__)
+
+USER_BATCH_SIZE = 500
+
+# Overlapping automatic trips of one user, tagged with their cluster
+OVERLAPS_QUERY = """
+    WITH swept AS (
+        SELECT trip_id, vehicle_id, start_time, end_time, distance_m, end_location,
+               max(end_time) OVER (
+                   PARTITION BY vehicle_id ORDER BY start_time, end_time DESC, trip_id
+                   ROWS BETWEEN UNBOUNDED PRECEDING AND 1 PRECEDING
+               ) AS covered_until
+        FROM trips
+        WHERE user_id = $1 AND is_automatic AND end_time IS NOT NULL
+    ), clustered AS (
+        SELECT *, sum(CASE WHEN covered_until > start_time THEN 0 ELSE 1 END) OVER (
+                   PARTITION BY vehicle_id ORDER BY start_time, end_time DESC, trip_id
+               ) AS cluster
+        FROM swept
+    ), sized AS (
+        SELECT *, count(*) OVER (PARTITION BY vehicle_id, cluster) AS size FROM clustered
+    )
+    SELECT trip_id, vehicle_id, start_time, end_time, distance_m, end_location, covered_until, cluster
+    FROM sized
+    WHERE size > 1
+    ORDER BY vehicle_id NULLS FIRST, cluster, start_time, end_time DESC, trip_id
+"""
+
+
+def merge_cluster(trips) -> dict:
+    """The merge for one cluster of trips, in sweep order."""
+    survivor = trips[0]
+    last = max(trips, key=lambda t: t['end_time'])
+    distance_m = 0.0
+    for trip in trips:
+        covered_until = trip['covered_until'] or trip['start_time']
+        duration = (trip['end_time'] - trip['start_time']).total_seconds()
+        uncovered = (trip['end_time'] - max(trip['start_time'], covered_until)).total_seconds()
+        if duration > 0:
+            distance_m += trip['distance_m'] * max(uncovered, 0) / duration
+        elif trip is survivor:
+            distance_m += trip['distance_m']
+    return {
+        "survivor": survivor,
+        "removed": trips[1:],
+        "end_time": last['end_time'],
+        "end_location": last['end_location'],
+        "distance_m": round(distance_m),
+    }
+
+
+def describe(trip, end_time=None, distance_m=None) -> str:
+    end_time = end_time or trip['end_time']
+    distance_m = trip['distance_m'] if distance_m is None else distance_m
+    return (
+        f"{trip['trip_id']}  {trip['start_time'].isoformat()} -> {end_time.isoformat()}  "
+        f"{distance_m / METERS_PER_MILE:.3f} mi"
+    )
+
+
+def format_merge(user_id: str, merge: dict) -> str:
+    survivor = merge['survivor']
+    lines = [f"@@ {user_id} vehicle={survivor['vehicle_id']} ({len(merge['removed']) + 1} trips)"]
+    lines.append(f"- {describe(survivor)}")
+    lines.extend(f"- {describe(trip)}" for trip in merge['removed'])
+    lines.append(f"+ {describe(survivor, merge['end_time'], merge['distance_m'])}")
+    return "\n".join(lines)
+
+
+async def apply_merge(conn, user_id: str, merge: dict):
+    survivor = merge['survivor']
+    # By id alone, like every other write: a trip is still merged if an edit moved its start_time
+    await conn.execute(
+        """UPDATE trips SET end_time = $3, end_location = $4, distance_m = $5
+           WHERE trip_id = $1 AND user_id = $2""",
+        survivor['trip_id'], user_id, merge['end_time'], merge['end_location'], merge['distance_m']
+    )
+    await conn.execute(
+        "DELETE FROM trips WHERE trip_id = ANY($1::varchar[]) AND user_id = $2",
+        [trip['trip_id'] for trip in merge['removed']],
+        user_id
+    )
+
+
+async def dedup_user(conn, user_id: str, apply: bool = False, out=sys.stdout) -> int:
+    """Print (and with `apply`, make) the merges for one user; returns trips removed."""
+    removed = 0
+    # Repeatable read: the clusters cannot shift under the merge
+    async with conn.transaction(isolation='repeatable_read', readonly=not apply):
+        rows = conn.cursor(OVERLAPS_QUERY, user_id)
+        async for _, cluster in groupby_async(rows, key=lambda r: (r['vehicle_id'], r['cluster'])):
+            merge = merge_cluster(cluster)
+            print(format_merge(user_id, merge), file=out)
+            removed += len(merge['removed'])
+            if apply:
+                await apply_merge(conn, user_id, merge)
+    return removed
+
+
+async def groupby_async(rows, key):
+    """itertools.groupby over an async iterator; holds one group at a time."""
+    group, group_key = [], None
+    async for row in rows:
+        row_key = key(row)
+        if group and row_key != group_key:
+            yield group_key, group
+            group = []
+        group_key = row_key
+        group.append(row)
+    if group:
+        yield group_key, group
+
+
+async def dedup_all(conn, apply: bool = False, out=sys.stdout) -> dict:
+    """Run dedup_user for every user, walking users in id order."""
+    users = trips = 0
+    last_user = ""
+    while True:
+        batch = await conn.fetch(
+            "SELECT user_id FROM users WHERE user_id > $1 ORDER BY user_id LIMIT $2",
+            last_user, USER_BATCH_SIZE
+        )
+        if not batch:
+            break
+        for (user_id,) in batch:
+            try:
+                removed = await dedup_user(conn, user_id, apply, out)
+            except asyncpg.SerializationError:
+                logger.warning(f"Trips of {user_id} changed during dedup; skipped")
+                continue
+            if removed:
+                users += 1
+                trips += removed
+        last_user = batch[-1]['user_id']
+    logger.info(f"{'Merged' if apply else 'Found'} {trips} overlapping trips for {users} users")
+    return {"users": users, "trips": trips}
+
+
+async def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge overlapping automatic trips")
+    parser.add_argument("command", choices=["diff", "apply"])
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    load_dotenv(Path(__file__).parent / '.env')
+
+    async with cli_router() as router:
+        for name, pool in router.pools.items():
+            logger.info(f"Shard {name}")
+            async with pool.acquire() as conn:
+                await dedup_all(conn, apply=args.command == "apply")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    asyncio.run(main())
@@ -477,6 +477,33 @@ class MileageTrackerTester:
             except Exception as e:
                 self.log_result("DELETE /vehicles/{id} - Delete vehicle", False, f"Exception: {str(e)}")
     
+    def test_delta_sync(self):
+        """Test delta sync cursor and tombstones"""
+        print("\n🔄 Testing Delta Sync...")
+        
+        try:
+            response = requests.get(f"{self.base_url}/sync", headers=self.headers)
+            if response.status_code != 200:
+                self.log_result("GET /sync - Full snapshot", False, f"Status code: {response.status_code}")
+                return
+            cursor = response.json().get("cursor")
+            self.log_result("GET /sync - Full snapshot", True, f"Cursor: {cursor}")
+            
+            vehicle = requests.post(f"{self.base_url}/vehicles", headers=self.headers, json={"name": "Sync Vehicle"}).json()
+            requests.delete(f"{self.base_url}/vehicles/{vehicle['vehicle_id']}", headers=self.headers)
+            
+            response = requests.get(f"{self.base_url}/sync", headers=self.headers, params={"since": cursor})
+            if response.status_code == 200:
+                data = response.json()
+                if vehicle["vehicle_id"] in data.get("deleted", {}).get("vehicles", []) and data.get("cursor") != cursor:
+                    self.log_result("GET /sync?since= - Delta with tombstones", True, f"New cursor: {data.get('cursor')}")
+                else:
+                    self.log_result("GET /sync?since= - Delta with tombstones", False, f"Missing tombstone: {data}")
+            else:
+                self.log_result("GET /sync?since= - Delta with tombstones", False, f"Status code: {response.status_code}")
+        except Exception as e:
+            self.log_result("GET /sync - Delta sync", False, f"Exception: {str(e)}")
+    
     def run_all_tests(self):
         """Run all tests in sequence"""
         print("🚀 Starting Mileage Tracker Backend API Tests")
@@ -496,6 +523,7 @@ class MileageTrackerTester:
         self.test_expenses_crud()
         self.test_dashboard_reports()
         self.test_cleanup_operations()
+        self.test_delta_sync()
         
         # Cleanup
         self.cleanup_test_data()
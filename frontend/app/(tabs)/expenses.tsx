@@ -214,10 +214,10 @@ export default function ExpensesScreen() {
               {expense.notes && (
                 <Text style={styles.expenseNotes}>{expense.notes}</Text>
               )}
-              {expense.receipt_image_base64 && (
+              {expense.receipt_thumbnail_base64 && (
                 <View style={styles.receiptContainer}>
                   <Image 
-                    source={{ uri: expense.receipt_image_base64 }} 
+                    source={{ uri: expense.receipt_thumbnail_base64 }} 
                     style={styles.receiptImage}
                   />
                 </View>
@@ -0,0 +1,20 @@
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "backend"))
+
+# In-process API tests run without a database unless a backend is chosen explicitly
+os.environ.setdefault("STORAGE_BACKEND", "memory")
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+def new_email() -> str:
+    return f"test_{uuid.uuid4().hex[:12]}@example.com"
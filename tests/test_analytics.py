@@ -0,0 +1,98 @@
+"""Bucketing and the closed-bucket cache of the time-series analytics."""
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+import analytics
+from storage import MemoryStorage
+
+from .test_storage import expense, trip
+
+pytestmark = pytest.mark.anyio
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+def test_truncate_matches_date_trunc():
+    value = utc(2024, 2, 29, 13, 45)
+    assert analytics.truncate(value, "day") == utc(2024, 2, 29)
+    assert analytics.truncate(value, "week") == utc(2024, 2, 26)
+    assert analytics.truncate(value, "month") == utc(2024, 2, 1)
+    assert analytics.truncate(value, "year") == utc(2024, 1, 1)
+    assert analytics.truncate(datetime(2024, 2, 29, 13, 45), "day") == utc(2024, 2, 29)
+
+
+def test_bucket_range_covers_partial_buckets():
+    assert analytics.bucket_range(utc(2024, 11, 15), utc(2025, 1, 1), "month") == [utc(2024, 11, 1), utc(2024, 12, 1)]
+    assert analytics.bucket_range(utc(2024, 12, 31), utc(2025, 1, 1, 0, 1), "year") == [utc(2024, 1, 1), utc(2025, 1, 1)]
+
+
+def test_bucket_range_takes_naive_bounds_as_utc():
+    # As parsed from date-only start_date/end_date
+    assert analytics.bucket_range(datetime(2025, 1, 1), datetime(2025, 3, 1), "month") == [utc(2025, 1, 1), utc(2025, 2, 1)]
+    assert analytics.bucket_range(utc(2025, 1, 1), datetime(2025, 1, 3), "day") == [utc(2025, 1, 1), utc(2025, 1, 2)]
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super().__init__()
+        self.queries = []
+
+    async def timeseries(self, user_id, metric, bucket, group_by, start, end):
+        self.queries.append((start, end))
+        return await super().timeseries(user_id, metric, bucket, group_by, start, end)
+
+
+@pytest.fixture
+def store():
+    analytics.cache.clear()
+    return CountingStorage()
+
+
+async def test_zero_filled_series(store):
+    user_id = "user_" + uuid.uuid4().hex[:12]
+    await store.insert_expense("e1", user_id, expense(utc(2025, 1, 5), 10))
+    await store.insert_expense("e2", user_id, expense(utc(2025, 3, 5), 4.5, category="tolls"))
+
+    result = await analytics.timeseries(store, user_id, "expenses", "month", "category", utc(2025, 1, 1), utc(2025, 4, 1))
+    assert result["buckets"] == [utc(2025, 1, 1), utc(2025, 2, 1), utc(2025, 3, 1)]
+    assert result["series"] == [{"name": "fuel", "values": [10, 0, 0]}, {"name": "tolls", "values": [0, 0, 4.5]}]
+
+
+async def test_only_the_current_bucket_is_requeried(store):
+    user_id = "user_" + uuid.uuid4().hex[:12]
+    now = utc(2025, 6, 15, 12)
+    await store.insert_trip("t1", user_id, trip(utc(2024, 3, 1), 10))
+    await store.insert_trip("t2", user_id, trip(utc(2025, 6, 2), 5))
+
+    def series(result):
+        return {utc(2024, 3, 1): result["series"][0]["values"][2], utc(2025, 6, 1): result["series"][0]["values"][-1]}
+
+    first = await analytics.timeseries(store, user_id, "miles", "month", None, utc(2024, 1, 1), now, now)
+    assert series(first) == {utc(2024, 3, 1): 10, utc(2025, 6, 1): 5}
+    assert store.queries == [(utc(2024, 1, 1), utc(2025, 7, 1))]
+
+    # Unchanged data: the cached closed months and the open month queried again
+    again = await analytics.timeseries(store, user_id, "miles", "month", None, utc(2024, 1, 1), now, now)
+    assert again == first
+    assert store.queries[-1] == (utc(2025, 6, 1), utc(2025, 7, 1))
+
+    # Any write invalidates, wherever it falls
+    await store.insert_trip("t3", user_id, trip(utc(2024, 3, 2), 1))
+    changed = await analytics.timeseries(store, user_id, "miles", "month", None, utc(2024, 1, 1), now, now)
+    assert series(changed) == {utc(2024, 3, 1): 11, utc(2025, 6, 1): 5}
+    assert store.queries[-1] == (utc(2024, 1, 1), utc(2025, 7, 1))
+
+    # So does the current month closing
+    later = utc(2025, 7, 2)
+    await analytics.timeseries(store, user_id, "miles", "month", None, utc(2024, 1, 1), later, later)
+    assert store.queries[-1] == (utc(2024, 1, 1), utc(2025, 8, 1))
+
+    # A range entirely in the past is served from the cache alone
+    queries = len(store.queries)
+    past = await analytics.timeseries(store, user_id, "miles", "month", None, utc(2024, 2, 1), utc(2024, 4, 1), later)
+    assert past["series"] == [{"name": "total", "values": [0, 11]}]
+    assert len(store.queries) == queries
@@ -0,0 +1,315 @@
+"""API tests run in-process against the configured storage backend (memory by default)."""
+import base64
+import io
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from .conftest import new_email
+
+
+@pytest.fixture(scope="module")
+def client():
+    import server
+    with TestClient(server.app) as client:
+        yield client
+
+
+def login(client, name="Test User") -> dict:
+    """Auth headers for a new user with a session."""
+    import server
+
+    async def create():
+        user_id = await server.storage.upsert_user(f"user_{uuid.uuid4().hex[:12]}", new_email(), name, None)
+        token = uuid.uuid4().hex
+        await server.storage.create_session(user_id, token, datetime.now(timezone.utc) + timedelta(days=7))
+        return token
+
+    return {"Authorization": f"Bearer {client.portal.call(create)}"}
+
+
+@pytest.fixture
+def headers(client):
+    return login(client)
+
+
+def png_data_url() -> str:
+    from PIL import Image
+    buffer = io.BytesIO()
+    Image.new("RGB", (800, 600), "white").save(buffer, "PNG")
+    return f"data:image/png;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def test_health(client):
+    assert client.get("/api/").json()["status"] == "running"
+    assert client.get("/api/health").json()["status"] == "healthy"
+
+
+def test_requires_auth(client):
+    assert client.get("/api/auth/me").status_code == 401
+    assert client.get("/api/trips", headers={"Authorization": "Bearer nope"}).status_code == 401
+
+
+def test_me_and_logout(client, headers):
+    me = client.get("/api/auth/me", headers=headers)
+    assert me.status_code == 200
+    assert me.json()["name"] == "Test User"
+
+    assert client.post("/api/auth/logout", headers=headers).json() == {"message": "Logged out"}
+    assert client.get("/api/auth/me", headers=headers).status_code == 401
+
+
+def test_vehicles_crud(client, headers):
+    created = client.post("/api/vehicles", json={"name": "Work Car", "make": "Toyota", "year": 2021}, headers=headers)
+    assert created.status_code == 200
+    vehicle = created.json()
+    assert vehicle["business_percentage"] == 100
+
+    assert [v["vehicle_id"] for v in client.get("/api/vehicles", headers=headers).json()] == [vehicle["vehicle_id"]]
+
+    assert client.delete(f"/api/vehicles/{vehicle['vehicle_id']}", headers=headers).status_code == 200
+    assert client.delete(f"/api/vehicles/{vehicle['vehicle_id']}", headers=headers).status_code == 404
+    assert client.get("/api/vehicles", headers=headers).json() == []
+
+
+def test_trips_crud(client, headers):
+    start = "2025-03-10T09:00:00Z"
+    created = client.post("/api/trips", json={
+        "start_time": start, "distance": 12.5, "purpose": "Client meeting", "start_location": "Office"
+    }, headers=headers)
+    assert created.status_code == 200
+    trip = created.json()
+    assert trip["distance"] == 12.5 and trip["is_business"] and trip["end_time"] is None
+
+    updated = client.put(f"/api/trips/{trip['trip_id']}", json={
+        "distance": 15.2, "end_time": "2025-03-10T10:00:00Z", "end_location": "Client site"
+    }, headers=headers)
+    assert updated.status_code == 200
+    assert updated.json()["distance"] == 15.2
+    assert updated.json()["purpose"] == "Client meeting"
+
+    assert client.put(f"/api/trips/{trip['trip_id']}", json={}, headers=headers).status_code == 400
+    assert client.put("/api/trips/trip_missing", json={"distance": 1}, headers=headers).status_code == 404
+
+    trips = client.get("/api/trips", headers=headers).json()
+    assert [t["trip_id"] for t in trips] == [trip["trip_id"]]
+
+    assert client.delete(f"/api/trips/{trip['trip_id']}", headers=headers).status_code == 200
+    assert client.delete(f"/api/trips/{trip['trip_id']}", headers=headers).status_code == 404
+
+
+def test_trips_are_private(client, headers):
+    trip = client.post("/api/trips", json={"start_time": "2025-03-10T09:00:00Z", "distance": 1}, headers=headers).json()
+
+    other = login(client, "Other")
+    assert client.get("/api/trips", headers=other).json() == []
+    assert client.delete(f"/api/trips/{trip['trip_id']}", headers=other).status_code == 404
+
+
+def test_columns_shape(client, headers):
+    for day in range(3):
+        client.post("/api/trips", json={"start_time": f"2025-03-1{day}T09:00:00Z", "distance": day + 1}, headers=headers)
+
+    objects = client.get("/api/trips", headers=headers).json()
+    columns = client.get("/api/trips", params={"shape": "columns"}, headers=headers).json()
+    assert [dict(zip(columns["columns"], row)) for row in columns["rows"]] == objects
+    assert client.get("/api/trips", params={"shape": "rows"}, headers=headers).status_code == 400
+
+
+def test_expenses_crud(client, headers):
+    created = client.post("/api/expenses", json={
+        "amount": 45.5, "category": "fuel", "date": "2025-03-10T00:00:00Z", "notes": "Gas"
+    }, headers=headers)
+    assert created.status_code == 200
+    expense = created.json()
+    assert expense["amount"] == 45.5 and expense["receipt_url"] is None
+
+    expenses = client.get("/api/expenses", headers=headers).json()
+    assert [e["expense_id"] for e in expenses] == [expense["expense_id"]]
+
+    assert client.get(f"/api/expenses/{expense['expense_id']}/receipt", headers=headers).status_code == 404
+    assert client.delete(f"/api/expenses/{expense['expense_id']}", headers=headers).status_code == 200
+    assert client.delete(f"/api/expenses/{expense['expense_id']}", headers=headers).status_code == 404
+
+
+def test_expense_receipt(client, headers):
+    created = client.post("/api/expenses", json={
+        "amount": 12, "category": "parking", "date": "2025-03-10T00:00:00Z", "receipt_image_base64": png_data_url()
+    }, headers=headers).json()
+    assert created["receipt_thumbnail_base64"].startswith("data:image/webp;base64,")
+
+    receipt = client.get(created["receipt_url"], headers=headers)
+    assert receipt.status_code == 200
+    assert receipt.headers["content-type"] == "image/webp"
+
+    bad = client.post("/api/expenses", json={
+        "amount": 1, "category": "parking", "date": "2025-03-10T00:00:00Z",
+        "receipt_image_base64": "data:image/png;base64," + base64.b64encode(b"not an image").decode()
+    }, headers=headers)
+    assert bad.status_code == 400
+
+
+def test_dashboard_and_tax_report(client, headers):
+    now = datetime.now(timezone.utc)
+    client.post("/api/trips", json={"start_time": now.isoformat(), "distance": 100}, headers=headers)
+    client.post("/api/trips", json={"start_time": now.isoformat(), "distance": 10, "is_business": False}, headers=headers)
+    client.post("/api/expenses", json={"amount": 20, "category": "fuel", "date": now.isoformat()}, headers=headers)
+
+    stats = client.get("/api/dashboard/stats", headers=headers).json()
+    assert stats["month_miles"] == 100 and stats["year_miles"] == 100
+    assert stats["total_expenses"] == 20
+    assert stats["mileage_deduction"] == 67
+    assert stats["estimated_tax_savings"] == 21.75
+
+    report = client.get("/api/reports/tax", params={
+        "start_date": (now - timedelta(days=1)).isoformat().replace("+00:00", "Z"),
+        "end_date": (now + timedelta(days=1)).isoformat().replace("+00:00", "Z"),
+    }, headers=headers).json()
+    assert report["total_miles"] == 110
+    assert report["business_miles"] == 100
+    assert report["total_deduction"] == 87
+
+
+def test_subscriptions(client, headers):
+    status = client.get("/api/subscription/status", headers=headers).json()
+    assert status["plan_type"] == "basic"
+    assert status["limits"]["auto_trips_per_month"] == 20
+
+    client.post("/api/trips", json={
+        "start_time": datetime.now(timezone.utc).isoformat(), "distance": 1, "is_automatic": True
+    }, headers=headers)
+    limit = client.get("/api/subscription/check-limit", params={"feature": "auto_trip"}, headers=headers).json()
+    assert limit == {"can_use": True, "used": 1, "remaining": 19, "plan_type": "basic"}
+
+    assert client.post("/api/subscription/change-plan", params={"plan_type": "gold"}, headers=headers).status_code == 400
+    changed = client.post("/api/subscription/change-plan", params={"plan_type": "premium"}, headers=headers)
+    assert changed.json()["plan_type"] == "premium"
+    assert client.get("/api/subscription/status", headers=headers).json()["plan_type"] == "premium"
+    assert client.get("/api/subscription/check-limit", params={"feature": "bank_link"}, headers=headers).json()["can_use"]
+
+    plans = client.get("/api/subscription/plans").json()["plans"]
+    assert [p["id"] for p in plans] == ["basic", "mid", "premium"]
+
+
+def test_bootstrap(client, headers):
+    client.post("/api/vehicles", json={"name": "Van"}, headers=headers)
+    payload = client.get("/api/bootstrap", headers=headers).json()
+    assert payload["user"]["name"] == "Test User"
+    assert [v["name"] for v in payload["vehicles"]] == ["Van"]
+    assert payload["subscription"]["plan_type"] == "basic"
+    assert payload["dashboard"]["year_miles"] == 0
+    assert len(payload["plans"]) == 3
+
+
+def test_bootstrap_matches_the_separate_endpoints(client, headers):
+    client.post("/api/trips", json={"start_time": datetime.now(timezone.utc).isoformat(), "distance": 12}, headers=headers)
+    payload = client.get("/api/bootstrap", headers=headers).json()
+    assert payload["user"] == client.get("/api/auth/me", headers=headers).json()
+    assert payload["vehicles"] == client.get("/api/vehicles", headers=headers).json()
+    assert payload["subscription"] == client.get("/api/subscription/status", headers=headers).json()
+    assert payload["dashboard"] == client.get("/api/dashboard/stats", headers=headers).json()
+    assert payload["plans"] == client.get("/api/subscription/plans").json()["plans"]
+    assert client.get("/api/bootstrap").status_code == 401
+
+
+def test_liveness_and_readiness(client):
+    assert client.get("/api/health/live").json() == {"status": "alive"}
+    ready = client.get("/api/health/ready")
+    assert ready.status_code == 200
+    assert ready.json()["status"] == "ready"
+
+
+def test_timeseries(client, headers):
+    for day, distance in ((3, 10), (10, 2), (11, 3)):
+        client.post("/api/trips", json={"start_time": f"2025-03-{day:02d}T09:00:00Z", "distance": distance}, headers=headers)
+    params = {"metric": "miles", "bucket": "week", "start_date": "2025-03-01T00:00:00Z", "end_date": "2025-03-17T00:00:00Z"}
+
+    result = client.get("/api/analytics/timeseries", params=params, headers=headers).json()
+    assert result["buckets"] == ["2025-02-24T00:00:00+00:00", "2025-03-03T00:00:00+00:00", "2025-03-10T00:00:00+00:00"]
+    assert result["series"] == [{"name": "total", "values": [0, 10, 5]}]
+
+    date_only = {**params, "start_date": "2025-03-01", "end_date": "2025-03-17"}
+    assert client.get("/api/analytics/timeseries", params=date_only, headers=headers).json() == result
+
+    bad = {**params, "metric": "expenses", "group_by": "business"}
+    assert client.get("/api/analytics/timeseries", params=bad, headers=headers).status_code == 400
+    too_long = {**params, "bucket": "day", "start_date": "1990-01-01T00:00:00Z"}
+    assert client.get("/api/analytics/timeseries", params=too_long, headers=headers).status_code == 400
+
+
+def test_sync_cursor_is_validated(client, headers):
+    assert client.get("/api/sync", params={"since": "yesterday"}, headers=headers).status_code == 400
+
+
+def test_job_params_are_validated_on_submit(client, headers):
+    def submit(kind, params):
+        return client.post("/api/jobs", json={"kind": kind, "params": params}, headers=headers)
+
+    assert submit("nope", {}).status_code == 400
+    assert submit("tax_report", {"start_date": "2025-01-01"}).status_code == 400
+    assert submit("tax_report", {"start_date": "January", "end_date": "2025-12-31"}).status_code == 400
+    assert submit("tax_report", {"start_date": 2025, "end_date": "2025-12-31"}).status_code == 400
+    assert submit("tax_report", {"start_date": "2025-12-31", "end_date": "2025-01-01"}).status_code == 400
+    assert submit("receipt_thumbnails", {"limit": 5}).status_code == 400
+
+
+def test_routes_are_rate_limited():
+    import server
+    from fastapi.routing import APIRoute
+
+    # No database work, only removing the caller's own session, or behind the metrics token
+    exempt = {"/api/", "/api/health", "/api/health/live", "/api/health/ready", "/api/metrics",
+              "/api/auth/logout", "/api/subscription/plans"}
+    limits = {"rate_limit.<locals>.check", "ip_rate_limit.<locals>.check"}
+    for route in server.app.routes:
+        if isinstance(route, APIRoute) and route.path.startswith("/api") and route.path not in exempt:
+            assert limits & {d.call.__qualname__ for d in route.dependant.dependencies}, route.path
+
+
+@pytest.mark.anyio
+async def test_unauthenticated_limits_are_per_client_address(monkeypatch):
+    import httpx
+    from fastapi import FastAPI
+
+    import rate_limit
+    import server
+
+    monkeypatch.setattr(server, "rate_limiter", rate_limit.RateLimiter())
+    monkeypatch.setitem(rate_limit.RATE_LIMITS, "auth", (2, 60))
+    app = FastAPI()
+    app.post("/login", dependencies=[server.ip_rate_limit("auth")])(lambda: {})
+
+    async def post(host):
+        transport = httpx.ASGITransport(app=app, client=(host, 50000))
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as caller:
+            return (await caller.post("/login")).status_code
+
+    assert [await post("203.0.113.7") for _ in range(3)] == [200, 200, 429]
+    assert await post("198.51.100.4") == 200
+
+
+def test_deploy_trusts_the_proxy_for_client_addresses():
+    import tomllib
+    from pathlib import Path
+
+    # Without proxy headers every caller has the proxy's address and shares one bucket
+    config = tomllib.loads((Path(__file__).parent.parent / "railway.toml").read_text())
+    backend, = (service for service in config["services"] if service["name"] == "backend")
+    command = backend["deploy"]["startCommand"]
+    assert "--proxy-headers" in command and "--forwarded-allow-ips" in command
+
+
+def test_metrics_need_the_token(client, monkeypatch):
+    import server
+
+    monkeypatch.setattr(server, "METRICS_TOKEN", None)
+    assert client.get("/api/metrics").status_code == 404
+
+    monkeypatch.setattr(server, "METRICS_TOKEN", "scrape-secret")
+    assert client.get("/api/metrics").status_code == 401
+    assert client.get("/api/metrics", headers={"Authorization": "Bearer nope"}).status_code == 401
+    scraped = client.get("/api/metrics", headers={"Authorization": "Bearer scrape-secret"})
+    assert scraped.status_code == 200
+    assert "rate_limited_total" in scraped.text
@@ -0,0 +1,121 @@
+"""Account export and import against a scratch Postgres database (TEST_DATABASE_URL)."""
+import io
+import os
+import uuid
+import zipfile
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+async def pool():
+    import asyncpg
+    import server
+
+    pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=4)
+    try:
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        yield pool
+    finally:
+        await pool.close()
+
+
+async def test_import_skips_ids_that_exist_at_another_time(pool):
+    import archive
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    trip_id, expense_id = f"trip_{uuid.uuid4().hex[:12]}", f"expense_{uuid.uuid4().hex[:12]}"
+    async with pool.acquire() as conn:
+        await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'A')", user_id, new_email())
+        await conn.execute(
+            "INSERT INTO trips (trip_id, user_id, start_time, distance_m) VALUES ($1, $2, '2025-03-10', 1609)",
+            trip_id, user_id
+        )
+        await conn.execute(
+            """INSERT INTO expenses (expense_id, user_id, amount_cents, category, date)
+               VALUES ($1, $2, 1234, 'fuel', '2025-03-10')""",
+            expense_id, user_id
+        )
+    try:
+        data = b"".join([chunk async for chunk in archive.stream_archive(pool, user_id)])
+
+        # Edited since the export, so the archived rows no longer match on (id, time)
+        async with pool.acquire() as conn:
+            await conn.execute("UPDATE trips SET start_time = '2025-03-11' WHERE trip_id = $1", trip_id)
+            await conn.execute("UPDATE expenses SET date = '2025-03-11' WHERE expense_id = $1", expense_id)
+
+        with zipfile.ZipFile(io.BytesIO(data)) as upload:
+            imported = await archive.import_archive(pool, user_id, upload)
+        assert imported == {"vehicles": 0, "trips": 0, "expenses": 0}
+
+        async with pool.acquire() as conn:
+            assert await conn.fetchval("SELECT count(*) FROM trips WHERE trip_id = $1", trip_id) == 1
+            assert await conn.fetchval("SELECT count(*) FROM expenses WHERE expense_id = $1", expense_id) == 1
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+
+
+def rewritten(data: bytes, name: str, contents: bytes) -> zipfile.ZipFile:
+    """The archive with one entry's contents replaced."""
+    out = io.BytesIO()
+    with zipfile.ZipFile(io.BytesIO(data)) as original, zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as copy:
+        for info in original.infolist():
+            copy.writestr(info.filename, contents if info.filename == name else original.read(info))
+    return zipfile.ZipFile(out)
+
+
+async def exported(pool) -> tuple:
+    """A new user and an export of their (empty) account."""
+    import archive
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    async with pool.acquire() as conn:
+        await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'A')", user_id, new_email())
+    return user_id, b"".join([chunk async for chunk in archive.stream_archive(pool, user_id)])
+
+
+async def test_import_refuses_archives_that_expand_past_the_limit(pool, monkeypatch):
+    import archive
+
+    user_id, data = await exported(pool)
+    try:
+        # Compresses to a few KB
+        upload = rewritten(data, "trips.csv", b"\n" * (1 << 20))
+        monkeypatch.setattr(archive, "MAX_IMPORT_BYTES", 1 << 19)
+        with upload, pytest.raises(ValueError, match="expands to"):
+            await archive.import_archive(pool, user_id, upload)
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+
+
+async def test_rows_breaking_a_constraint_fail_the_whole_import(pool):
+    import asyncpg
+    import archive
+
+    user_id, data = await exported(pool)
+    try:
+        with zipfile.ZipFile(io.BytesIO(data)) as original:
+            header = original.read("trips.csv").decode().splitlines()[0]
+        # A trip without a start_time
+        row = ",".join(f"trip_{uuid.uuid4().hex[:12]}" if c == "trip_id" else "" for c in header.split(","))
+        with rewritten(data, "trips.csv", f"{header}\n{row}\n".encode()) as upload:
+            # import_account answers these 400, like malformed CSV (DataError)
+            with pytest.raises(asyncpg.IntegrityConstraintViolationError):
+                await archive.import_archive(pool, user_id, upload)
+        async with pool.acquire() as conn:
+            assert await conn.fetchval("SELECT count(*) FROM trips WHERE user_id = $1", user_id) == 0
+    finally:
+        async with pool.acquire() as conn:
+            await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
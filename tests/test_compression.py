@@ -0,0 +1,87 @@
+"""Negotiated response compression, driven as raw ASGI messages."""
+import gzip
+import zlib
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+@pytest.mark.parametrize("accept, expected", [
+    ("", None),
+    ("gzip", "gzip"),
+    ("gzip, deflate, br, zstd", "zstd"),
+    ("br;q=1.0, zstd;q=0.5, gzip;q=0.8", "br"),
+    ("gzip;q=0, identity", None),
+    ("*", "zstd"),
+    ("gzip;q=nonsense", None),
+])
+def test_negotiate_prefers_the_best_accepted_coding(accept, expected, monkeypatch):
+    import compression
+
+    # Independent of which optional packages are installed
+    monkeypatch.setattr(compression, "ENCODERS", {"zstd": None, "br": None, "gzip": compression.GzipEncoder})
+    assert compression.negotiate(accept) == expected
+
+
+def app_sending(chunks, content_type="application/json", content_length=True):
+    async def app(scope, receive, send):
+        headers = [(b"content-type", content_type.encode())]
+        if content_length:
+            headers.append((b"content-length", str(sum(map(len, chunks))).encode()))
+        await send({"type": "http.response.start", "status": 200, "headers": headers})
+        for i, chunk in enumerate(chunks):
+            await send({"type": "http.response.body", "body": chunk, "more_body": i < len(chunks) - 1})
+
+    return app
+
+
+async def respond(app, accept="gzip"):
+    """(headers, [body chunks]) as the client receives them."""
+    from compression import CompressionMiddleware
+
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": "GET", "path": "/", "headers": [(b"accept-encoding", accept.encode())]}
+    await CompressionMiddleware(app, minimum_size=1024)(scope, None, send)
+    start, *bodies = messages
+    headers = {name.decode(): value.decode() for name, value in start["headers"]}
+    return headers, [message["body"] for message in bodies]
+
+
+async def test_small_responses_are_left_alone():
+    headers, bodies = await respond(app_sending([b'{"ok": true}']))
+    assert "content-encoding" not in headers
+    assert headers["vary"] == "Accept-Encoding"
+    assert bodies == [b'{"ok": true}']
+
+
+async def test_large_json_is_compressed_with_its_length():
+    body = b'{"trips": [' + b",".join([b'{"distance": 12.5}'] * 500) + b"]}"
+    headers, bodies = await respond(app_sending([body]))
+    assert headers["content-encoding"] == "gzip"
+    assert headers["content-length"] == str(len(bodies[0])) != str(len(body))
+    assert gzip.decompress(bodies[0]) == body
+
+
+async def test_streamed_bodies_are_flushed_chunk_by_chunk():
+    chunks = [b"type,id,miles\n" + b"trip,trip_1,12.5\n" * 100] * 3
+    headers, bodies = await respond(app_sending(chunks, "text/csv", content_length=False))
+    assert headers["content-encoding"] == "gzip"
+    assert "content-length" not in headers
+
+    decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    # Each chunk decodes completely as it arrives
+    assert [decoder.decompress(body) for body in bodies] == chunks
+    assert decoder.eof
+
+
+@pytest.mark.parametrize("accept, content_type", [("gzip", "image/png"), ("", "application/json")])
+async def test_other_types_and_clients_get_the_body_unchanged(accept, content_type):
+    body = b"\x89PNG" + bytes(4096)
+    headers, bodies = await respond(app_sending([body], content_type), accept=accept)
+    assert "content-encoding" not in headers
+    assert b"".join(bodies) == body
@@ -0,0 +1,96 @@
+"""Readiness from cached pings, against stand-in pools."""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+import health
+from health import SCHEMA_VERSION, HealthMonitor
+
+pytestmark = pytest.mark.anyio
+
+
+class Connection:
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def fetchval(self, query):
+        if self.pool.hang:
+            await asyncio.sleep(60)
+        if self.pool.down:
+            raise ConnectionRefusedError("connection refused")
+        return self.pool.version
+
+
+class Pool:
+    """Just enough of asyncpg.Pool for the monitor."""
+
+    def __init__(self, version=SCHEMA_VERSION, down=False, hang=False):
+        self.version = version
+        self.down = down
+        self.hang = hang
+
+    @asynccontextmanager
+    async def acquire(self):
+        yield Connection(self)
+
+    def get_size(self):
+        return 2
+
+    def get_idle_size(self):
+        return 1
+
+    def get_max_size(self):
+        return 10
+
+
+async def test_ready_when_every_shard_answers():
+    monitor = HealthMonitor()
+    pools = {"primary": Pool(), "s1": Pool()}
+    await monitor.check(pools)
+    ready, body = monitor.readiness(True, pools)
+    assert ready and body["status"] == "ready"
+    assert body["shards"]["s1"]["schema_version"] == SCHEMA_VERSION
+    assert body["shards"]["s1"]["pool"] == {"size": 2, "idle": 1, "max": 10}
+
+
+async def test_not_ready_before_warm_up_and_while_draining():
+    monitor = HealthMonitor()
+    pools = {"primary": Pool()}
+    await monitor.check(pools)
+    assert monitor.readiness(False, pools) == (False, {"status": "starting"})
+    monitor.draining = True
+    assert monitor.readiness(True, pools) == (False, {"status": "draining"})
+
+
+async def test_failed_slow_or_unchecked_shard_is_unavailable(monkeypatch):
+    monkeypatch.setattr(health, "PING_TIMEOUT", 0.05)
+    monitor = HealthMonitor()
+    pools = {"primary": Pool(), "down": Pool(down=True), "slow": Pool(hang=True)}
+    await monitor.check(pools)
+    pools["new"] = Pool()
+    ready, body = monitor.readiness(True, pools)
+    assert not ready and body["status"] == "unavailable"
+    assert body["shards"]["primary"]["ok"]
+    assert "refused" in body["shards"]["down"]["error"]
+    assert body["shards"]["slow"]["error"].startswith("TimeoutError")
+    assert body["shards"]["new"]["error"] == "Not checked yet"
+
+    # Recovers on the next refresh
+    pools["down"].down = pools["slow"].hang = False
+    await monitor.check(pools)
+    assert monitor.readiness(True, pools)[0]
+
+
+async def test_stale_ping_and_old_schema_are_unavailable(monkeypatch):
+    monitor = HealthMonitor()
+    pools = {"primary": Pool(version=SCHEMA_VERSION - 1)}
+    await monitor.check(pools)
+    ready, body = monitor.readiness(True, pools)
+    assert not ready and body["shards"]["primary"]["error"].startswith("Schema is behind")
+
+    pools["primary"].version = SCHEMA_VERSION
+    await monitor.check(pools)
+    monkeypatch.setattr(health, "PING_STALE_SECONDS", -1)
+    ready, body = monitor.readiness(True, pools)
+    assert not ready and body["shards"]["primary"]["error"] == "Last ping is stale"
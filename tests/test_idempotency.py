@@ -0,0 +1,204 @@
+"""Idempotency-Key handling, on a small app behind the middleware."""
+import asyncio
+import os
+import threading
+from datetime import timedelta
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.testclient import TestClient
+
+from idempotency import IdempotencyMiddleware, _digest, install_idempotency_keys
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+requires_postgres = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+
+AUTH = {"Authorization": "Bearer token-a"}
+
+# Session token -> user; token-a2 is the same user signed in again
+SESSIONS = {"token-a": "user_a", "token-a2": "user_a", "token-b": "user_b"}
+
+
+async def get_user_id(token):
+    return SESSIONS.get(token)
+
+
+def make_app(get_pool):
+    app = FastAPI()
+    app.state.calls = 0
+    app.state.fail = None
+    app.state.gate = None
+
+    @app.post("/items")
+    async def create_item():
+        app.state.calls += 1
+        if app.state.gate is not None:
+            await app.state.gate.wait()
+        if app.state.fail is not None:
+            raise app.state.fail
+        return {"call": app.state.calls}
+
+    app.add_middleware(IdempotencyMiddleware, get_pool=get_pool, get_user_id=get_user_id)
+    return app
+
+
+def test_memory_backend_passes_through():
+    async def get_pool():
+        raise HTTPException(status_code=501, detail="Not available with the in-memory storage backend")
+
+    with TestClient(make_app(get_pool)) as client:
+        first = client.post("/items", headers={**AUTH, "Idempotency-Key": "k1"})
+        second = client.post("/items", headers={**AUTH, "Idempotency-Key": "k1"})
+    assert (first.status_code, second.json()) == (200, {"call": 2})
+
+
+def test_warm_up_error_is_returned_not_raised():
+    async def get_pool():
+        raise HTTPException(status_code=503, detail="Server is starting", headers={"Retry-After": "5"})
+
+    with TestClient(make_app(get_pool)) as client:
+        response = client.post("/items", headers={**AUTH, "Idempotency-Key": "k1"})
+    assert response.status_code == 503
+    assert response.headers["Retry-After"] == "5"
+
+
+@pytest.fixture
+def postgres_app():
+    import asyncpg
+
+    state = {}
+
+    async def get_pool():
+        if "pool" not in state:
+            state["pool"] = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=4)
+            async with state["pool"].acquire() as conn:
+                await install_idempotency_keys(conn)
+                await conn.execute("DELETE FROM idempotency_keys")
+        return state["pool"]
+
+    app = make_app(get_pool)
+    with TestClient(app) as client:
+        client.portal.call(get_pool)
+        yield app, client, state["pool"]
+        client.portal.call(state["pool"].close)
+
+
+@requires_postgres
+def test_replays_and_scopes(postgres_app):
+    app, client, _ = postgres_app
+    first = client.post("/items", headers={**AUTH, "Idempotency-Key": "k1"})
+    replay = client.post("/items", headers={**AUTH, "Idempotency-Key": "k1"})
+    assert replay.json() == first.json() == {"call": 1}
+    assert replay.headers["Idempotent-Replayed"] == "true"
+
+    # A retry after signing in again is still the same user's key
+    relogin = client.post("/items", headers={"Authorization": "Bearer token-a2", "Idempotency-Key": "k1"})
+    assert relogin.json() == {"call": 1}
+
+    # Another user's key with the same name is their own
+    other = client.post("/items", headers={"Authorization": "Bearer token-b", "Idempotency-Key": "k1"})
+    assert other.json() == {"call": 2}
+
+    # Anonymous requests and unknown sessions have no scope, so they are never replayed
+    for headers in ({}, {}, {"Authorization": "Bearer expired"}, {"Authorization": "Bearer expired"}):
+        response = client.post("/items", headers={**headers, "Idempotency-Key": "k1"})
+        assert "Idempotent-Replayed" not in response.headers
+    assert app.state.calls == 6
+
+
+@requires_postgres
+def test_failed_request_releases_its_key(postgres_app):
+    app, client, pool = postgres_app
+    app.state.fail = RuntimeError("boom")
+    with pytest.raises(RuntimeError):
+        client.post("/items", headers={**AUTH, "Idempotency-Key": "k-fail"})
+
+    app.state.fail = None
+    retry = client.post("/items", headers={**AUTH, "Idempotency-Key": "k-fail"})
+    assert retry.json() == {"call": 2}
+
+
+@requires_postgres
+def test_abandoned_claim_expires_after_its_lease(postgres_app):
+    app, client, pool = postgres_app
+    scope = _digest(b"user_a")
+    request_hash = _digest(b"POST", b"/items", b"", b"")
+
+    async def abandon(locked_until):
+        # What a worker that died in the handler leaves behind
+        async with pool.acquire() as conn:
+            await conn.execute(
+                """INSERT INTO idempotency_keys (scope, idem_key, request_hash, expires_at, locked_until)
+                   VALUES ($1, 'k-dead', $2, NOW() + INTERVAL '1 day', NOW() + $3)
+                   ON CONFLICT (scope, idem_key) DO UPDATE SET locked_until = EXCLUDED.locked_until""",
+                scope, request_hash, locked_until
+            )
+
+    client.portal.call(abandon, timedelta(minutes=1))
+    assert client.post("/items", headers={**AUTH, "Idempotency-Key": "k-dead"}).status_code == 409
+    client.portal.call(abandon, timedelta(seconds=-1))
+    assert client.post("/items", headers={**AUTH, "Idempotency-Key": "k-dead"}).json() == {"call": 1}
+
+
+@requires_postgres
+def test_loser_of_a_race_sees_in_progress(postgres_app):
+    app, client, pool = postgres_app
+    scope = _digest(b"user_a")
+    request_hash = _digest(b"POST", b"/items", b"", b"")
+
+    async def hold_claim(claimed: threading.Event, release: threading.Event):
+        # A concurrent request that has inserted its claim but not yet committed
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    """INSERT INTO idempotency_keys (scope, idem_key, request_hash, expires_at, locked_until)
+                       VALUES ($1, 'race', $2, NOW() + INTERVAL '1 hour', NOW() + INTERVAL '1 hour')""",
+                    scope, request_hash
+                )
+                claimed.set()
+                while not release.is_set():
+                    await asyncio.sleep(0.01)
+
+    claimed, release = threading.Event(), threading.Event()
+    holder = threading.Thread(target=client.portal.call, args=(hold_claim, claimed, release))
+    holder.start()
+    claimed.wait(5)
+    threading.Timer(0.2, release.set).start()
+    response = client.post("/items", headers={**AUTH, "Idempotency-Key": "race"})
+    holder.join(5)
+
+    assert response.status_code == 409
+    assert app.state.calls == 0
+
+
+@requires_postgres
+@pytest.mark.anyio
+async def test_cancelled_request_releases_its_key():
+    import asyncpg
+    import httpx
+
+    pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=4)
+    try:
+        async with pool.acquire() as conn:
+            await install_idempotency_keys(conn)
+            await conn.execute("DELETE FROM idempotency_keys")
+
+        async def get_pool():
+            return pool
+
+        app = make_app(get_pool)
+        app.state.gate = asyncio.Event()
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            # The client goes away while the handler runs
+            request = asyncio.create_task(client.post("/items", headers={**AUTH, "Idempotency-Key": "k-gone"}))
+            while app.state.calls == 0:
+                await asyncio.sleep(0.01)
+            request.cancel()
+            with pytest.raises(asyncio.CancelledError):
+                await request
+
+            async with pool.acquire() as conn:
+                assert await conn.fetchval("SELECT count(*) FROM idempotency_keys WHERE idem_key = 'k-gone'") == 0
+    finally:
+        await pool.close()
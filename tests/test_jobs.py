@@ -0,0 +1,129 @@
+"""Job leases against a scratch Postgres database (TEST_DATABASE_URL).
+
+Each test gets its own schema, so the queue holds only the test's own jobs.
+"""
+import asyncio
+import os
+import uuid
+
+import pytest
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+async def pool():
+    import asyncpg
+    import server
+
+    schema = f"jobs_{uuid.uuid4().hex[:8]}"
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    pool = await asyncpg.create_pool(f"{TEST_DATABASE_URL}{separator}search_path={schema}", min_size=1, max_size=4)
+    try:
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        yield pool
+    finally:
+        await pool.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+def make_runner(pool):
+    import jobs
+
+    async def pool_for(user_id):
+        return pool
+
+    runner = jobs.JobRunner()
+    runner.pool_for = pool_for
+    return runner
+
+
+async def expire_lease(pool, job_id: str):
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE jobs SET locked_until = NOW() - INTERVAL '1 second' WHERE job_id = $1", job_id)
+
+
+async def test_running_job_keeps_its_lease(pool, monkeypatch):
+    import jobs
+
+    monkeypatch.setattr(jobs, "JOB_LEASE_SECONDS", 1)
+    monkeypatch.setattr(jobs, "JOB_HEARTBEAT_SECONDS", 0.2)
+    release = asyncio.Event()
+
+    async def slow(pool, user_id, params):
+        await release.wait()
+        return b"done", "text/plain"
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, "test_slow", slow)
+
+    runner, other = make_runner(pool), make_runner(pool)
+    async with pool.acquire() as conn:
+        job = await jobs.enqueue_job(conn, None, "test_slow", {})
+        [claimed] = await runner.claim(conn, 10)
+    task = asyncio.create_task(runner.execute(pool, claimed))
+    try:
+        # Well past the original lease, another worker still finds nothing to reclaim
+        await asyncio.sleep(2)
+        async with pool.acquire() as conn:
+            assert await other.claim(conn, 10) == []
+        release.set()
+        await task
+        async with pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT status, attempts, result FROM jobs WHERE job_id = $1", job['job_id'])
+        assert (row['status'], row['attempts'], row['result']) == ("succeeded", 1, b"done")
+    finally:
+        release.set()
+
+
+async def test_last_attempt_that_lost_its_lease_fails(pool):
+    import jobs
+
+    runner = make_runner(pool)
+    async with pool.acquire() as conn:
+        job = await jobs.enqueue_job(conn, None, "test_hang", {})
+        await conn.execute("UPDATE jobs SET max_attempts = 2 WHERE job_id = $1", job['job_id'])
+        assert len(await runner.claim(conn, 10)) == 1
+    await expire_lease(pool, job['job_id'])
+    async with pool.acquire() as conn:
+        assert len(await runner.claim(conn, 10)) == 1
+    await expire_lease(pool, job['job_id'])
+    async with pool.acquire() as conn:
+        assert await runner.claim(conn, 10) == []
+        row = await conn.fetchrow("SELECT status, attempts FROM jobs WHERE job_id = $1", job['job_id'])
+    assert (row['status'], row['attempts']) == ("failed", 2)
+
+
+async def test_worker_that_lost_its_lease_keeps_out_of_the_reclaimed_attempt(pool, monkeypatch):
+    import jobs
+
+    results = iter([b"first", b"second"])
+
+    async def handler(pool, user_id, params):
+        return next(results), "text/plain"
+
+    monkeypatch.setitem(jobs.JOB_HANDLERS, "test_twice", handler)
+    first, second = make_runner(pool), make_runner(pool)
+    async with pool.acquire() as conn:
+        job = await jobs.enqueue_job(conn, None, "test_twice", {})
+        [stale] = await first.claim(conn, 10)
+    await expire_lease(pool, job['job_id'])
+    async with pool.acquire() as conn:
+        [current] = await second.claim(conn, 10)
+
+    async def state():
+        async with pool.acquire() as conn:
+            return tuple(await conn.fetchrow("SELECT status, attempts, result FROM jobs WHERE job_id = $1", job['job_id']))
+
+    await first.execute(pool, stale)
+    assert await state() == ("running", 2, None)
+    await second.execute(pool, current)
+    assert await state() == ("succeeded", 2, b"second")
@@ -0,0 +1,168 @@
+"""Live trip WebSocket: auth, per-message limits and batched distance writes.
+
+Tests touching trips run against a scratch Postgres schema (TEST_DATABASE_URL).
+"""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
+
+from .conftest import new_email
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+needs_postgres = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+
+# Two fixes a minute apart, about 0.69 miles
+FIXES = [[40.0, -75.0, 1_700_000_000], [40.01, -75.0, 1_700_000_060]]
+
+
+@pytest.fixture(scope="module")
+def client():
+    import server
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def pool(client, monkeypatch):
+    """A scratch schema on the client's event loop, holding every user's trips."""
+    import asyncpg
+    import server
+
+    schema = f"live_{uuid.uuid4().hex[:8]}"
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+
+    async def create():
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        await admin.close()
+        pool = await asyncpg.create_pool(f"{TEST_DATABASE_URL}{separator}search_path={schema}", min_size=1, max_size=2)
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        return pool
+
+    async def drop(pool):
+        await pool.close()
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+    pool = client.portal.call(create)
+
+    async def get_user_pool(user_id):
+        return pool
+
+    monkeypatch.setattr(server, "get_user_pool", get_user_pool)
+    yield pool
+    client.portal.call(drop, pool)
+
+
+def login(client, pool=None):
+    """(user_id, session token); with `pool`, the user also exists there for the trips to reference."""
+    import server
+
+    async def create():
+        user_id = await server.storage.upsert_user(f"user_{uuid.uuid4().hex[:12]}", new_email(), "Live", None)
+        token = uuid.uuid4().hex
+        await server.storage.create_session(user_id, token, datetime.now(timezone.utc) + timedelta(days=7))
+        if pool is not None:
+            async with pool.acquire() as conn:
+                await conn.execute(
+                    "INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'Live')", user_id, new_email()
+                )
+        return user_id, token
+
+    return client.portal.call(create)
+
+
+def test_noisy_fixes_add_no_distance():
+    from live_tracking import LiveTrip
+
+    trip = LiveTrip("trip_x", "user_x", 0.0)
+    for lat, lng, ts in FIXES:
+        trip.add_fix(lat, lng, ts)
+    distance = trip.distance
+    # Out of order, then a jump of ~70 miles in a minute
+    trip.add_fix(40.02, -75.0, FIXES[0][2])
+    trip.add_fix(41.0, -75.0, FIXES[1][2] + 60)
+    assert trip.distance == distance == pytest.approx(0.69, abs=0.01)
+
+
+@pytest.mark.parametrize("query", ["", "?token=not-a-session"])
+def test_stream_needs_a_session(client, query):
+    with pytest.raises(WebSocketDisconnect) as closed:
+        with client.websocket_connect(f"/api/trips/live{query}") as ws:
+            ws.receive_json()
+    assert closed.value.code == 4401
+
+
+def test_stream_accepts_the_session_from_a_header(client):
+    _, token = login(client)
+    with client.websocket_connect("/api/trips/live", headers={"Authorization": f"Bearer {token}"}) as ws:
+        ws.send_json({"type": "fixes", "points": FIXES})
+        # Accepted: the error comes back over the open socket
+        assert ws.receive_json()["type"] == "error"
+
+
+@needs_postgres
+def test_fixes_are_acknowledged_and_bounded(client, pool):
+    from live_tracking import MAX_FIXES_PER_MESSAGE
+
+    _, token = login(client, pool)
+    with client.websocket_connect(f"/api/trips/live?token={token}") as ws:
+        ws.send_json({"type": "start", "purpose": "Site visit"})
+        started = ws.receive_json()
+        assert started["type"] == "started"
+
+        ws.send_json({"type": "fixes", "seq": 1, "points": [FIXES[0]] * (MAX_FIXES_PER_MESSAGE + 1)})
+        assert ws.receive_json()["detail"] == f"At most {MAX_FIXES_PER_MESSAGE} fixes per message"
+        ws.send_json({"type": "fixes", "seq": 2, "points": [["40.0", "east"]]})
+        assert ws.receive_json()["detail"] == "Fixes must be [lat, lng, epoch_seconds]"
+
+        # Rejected batches added nothing; every accepted batch is acked with its seq
+        ws.send_json({"type": "fixes", "seq": 3, "points": FIXES})
+        ack = ws.receive_json()
+        assert (ack["type"], ack["seq"]) == ("ack", 3)
+        assert ack["distance"] == pytest.approx(0.69, abs=0.01)
+
+        ws.send_json({"type": "stop"})
+        stopped = ws.receive_json()
+        assert stopped["trip"]["trip_id"] == started["trip"]["trip_id"]
+        assert stopped["trip"]["distance"] == pytest.approx(0.69, abs=0.01)
+
+
+@needs_postgres
+def test_flush_follows_a_trip_whose_start_was_edited(client, pool):
+    from live_tracking import live_trips
+
+    user_id, token = login(client, pool)
+    with client.websocket_connect(f"/api/trips/live?token={token}") as ws:
+        ws.send_json({"type": "start"})
+        trip_id = ws.receive_json()["trip"]["trip_id"]
+        ws.send_json({"type": "fixes", "seq": 1, "points": FIXES})
+        ws.receive_json()
+
+        async def move_and_flush():
+            async with pool.acquire() as conn:
+                # An edit moves the open trip to another month's partition
+                await conn.execute(
+                    "UPDATE trips SET start_time = start_time - INTERVAL '45 days' WHERE trip_id = $1", trip_id
+                )
+            await live_trips.write_all(pool_for)
+            async with pool.acquire() as conn:
+                return await conn.fetchval("SELECT distance_m FROM trips WHERE trip_id = $1", trip_id)
+
+        async def pool_for(user):
+            assert user == user_id
+            return pool
+
+        assert client.portal.call(move_and_flush) == pytest.approx(0.69 * 1609.344, abs=20)
+
+        ws.send_json({"type": "stop", "end_location": "Office"})
+        stopped = ws.receive_json()
+        assert stopped["type"] == "stopped"
+        assert stopped["trip"]["end_location"] == "Office"
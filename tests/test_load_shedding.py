@@ -0,0 +1,104 @@
+"""Admission order, queue bounds and cancellation of the load-shedding limiter."""
+import asyncio
+
+import asyncpg
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from load_shedding import LoadSheddingMiddleware, PriorityLimiter
+
+pytestmark = pytest.mark.anyio
+
+
+async def wait_queued(limiter, count: int):
+    while len(limiter.waiting) < count:
+        await asyncio.sleep(0)
+
+
+async def test_slots_go_to_the_highest_priority_waiter():
+    limiter = PriorityLimiter(limit=1, max_waiting=10)
+    assert await limiter.acquire(1)
+    order = []
+
+    async def request(name, priority):
+        assert await limiter.acquire(priority)
+        order.append(name)
+        limiter.release()
+
+    tasks = [asyncio.create_task(request("heavy", 2)), asyncio.create_task(request("read", 1))]
+    await wait_queued(limiter, 1)
+    tasks.append(asyncio.create_task(request("write", 0)))
+    await wait_queued(limiter, 3)
+    limiter.release()
+    await asyncio.gather(*tasks)
+    assert order == ["write", "read", "heavy"]
+    assert limiter.active == 0
+
+
+async def test_full_queue_sheds_the_lowest_priority():
+    limiter = PriorityLimiter(limit=1, max_waiting=1)
+    assert await limiter.acquire(0)
+    read = asyncio.create_task(limiter.acquire(1))
+    await wait_queued(limiter, 1)
+
+    # Ranks no higher than the waiter, so it is shed itself
+    assert await limiter.acquire(2) is False
+    # Ranks higher, so it takes the waiter's place
+    write = asyncio.create_task(limiter.acquire(0))
+    assert await read is False
+    limiter.release()
+    assert await write is True
+    limiter.release()
+    assert limiter.active == 0
+
+
+async def test_waiting_too_long_is_shed():
+    limiter = PriorityLimiter(limit=1, max_waiting=10)
+    assert await limiter.acquire(0)
+    assert await limiter.acquire(1, timeout=0.01) is False
+    assert limiter.waiting == []
+
+
+@pytest.mark.parametrize("handed_over", [False, True])
+async def test_cancelled_waiter_does_not_leak_its_slot(handed_over):
+    limiter = PriorityLimiter(limit=1, max_waiting=10)
+    assert await limiter.acquire(0)
+    # Without a timeout the wait is a plain await, which raises even once the slot is set
+    waiter = asyncio.create_task(limiter.acquire(1, timeout=None))
+    await wait_queued(limiter, 1)
+    if handed_over:
+        # The slot is passed to the waiter, which is cancelled before it resumes
+        limiter.release()
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    if not handed_over:
+        limiter.release()
+    assert (limiter.active, limiter.waiting) == (0, [])
+
+
+def make_app(error):
+    app = FastAPI()
+
+    @app.get("/api/slow")
+    async def slow():
+        raise error
+
+    app.add_middleware(LoadSheddingMiddleware, limiter=PriorityLimiter(limit=1, max_waiting=1))
+    return app
+
+
+def test_pool_timeout_asks_for_a_retry():
+    with TestClient(make_app(asyncio.TimeoutError())) as client:
+        response = client.get("/api/slow")
+    assert response.status_code == 503
+    assert response.headers["Retry-After"]
+
+
+def test_statement_timeout_does_not_ask_for_a_retry():
+    error = asyncpg.QueryCanceledError("canceling statement due to statement timeout")
+    with TestClient(make_app(error)) as client:
+        response = client.get("/api/slow")
+    assert response.status_code == 504
+    assert "Retry-After" not in response.headers
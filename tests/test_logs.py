@@ -0,0 +1,115 @@
+"""The queued JSON logging pipeline and the request log middleware."""
+import io
+import json
+import logging
+import logging.handlers
+import queue
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+import logs
+from logs import ContextFilter, JSONFormatter, NonBlockingQueueHandler, RepeatFilter, RequestLogMiddleware
+
+
+@pytest.fixture
+def pipeline():
+    """A logger wired like configure_logging, writing JSON lines to a buffer."""
+    output = io.StringIO()
+    stream = logging.StreamHandler(output)
+    stream.setFormatter(JSONFormatter())
+    handler = NonBlockingQueueHandler(queue.Queue(100))
+    handler.addFilter(RepeatFilter(burst=2, window=60))
+    handler.addFilter(ContextFilter())
+    listener = logging.handlers.QueueListener(handler.queue, stream)
+    listener.start()
+
+    logger = logging.getLogger("test_logs")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.handlers = [handler]
+
+    def records():
+        listener.stop()
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    yield logger, records
+    logger.handlers = []
+
+
+def test_records_are_json_with_request_context(pipeline):
+    logger, records = pipeline
+    context = logs.RequestContext("req-1", {"path": "/api/trips/trip_1", "route": None})
+    token = logs.current_request.set(context)
+    logs.set_user("user_1")
+    try:
+        raise ValueError("boom")
+    except ValueError:
+        logger.exception("Failed %s", "here")
+    finally:
+        logs.current_request.reset(token)
+    logger.info("outside", extra={"rows": 3})
+
+    failed, outside = records()
+    assert failed["message"] == "Failed here" and failed["level"] == "ERROR"
+    assert (failed["request_id"], failed["route"], failed["user_id"]) == ("req-1", "/api/trips/trip_1", "user_1")
+    assert "ValueError: boom" in failed["exception"]
+    assert outside == {**outside, "message": "outside", "rows": 3}
+    assert "request_id" not in outside
+
+
+def test_repeated_errors_are_limited_per_call_site(pipeline, monkeypatch):
+    logger, records = pipeline
+
+    def fail(i):
+        logger.error(f"Failed to exchange session: {i}")
+
+    for i in range(5):
+        fail(i)
+    logger.info("not limited")
+    logger.info("not limited")
+
+    # The next window reports what was suppressed
+    monkeypatch.setattr(logs.time, "monotonic", lambda: float("inf"))
+    fail(5)
+
+    messages = [(r["message"], r.get("suppressed")) for r in records()]
+    assert messages == [
+        ("Failed to exchange session: 0", None),
+        ("Failed to exchange session: 1", None),
+        ("not limited", None),
+        ("not limited", None),
+        ("Failed to exchange session: 5", 3),
+    ]
+
+
+def test_full_queue_drops_instead_of_blocking():
+    handler = NonBlockingQueueHandler(queue.Queue(1))
+    record = logging.makeLogRecord({"msg": "x"})
+    handler.handle(record)
+    handler.handle(record)
+    assert handler.queue.qsize() == 1
+
+
+def test_middleware_sets_request_id_and_logs_access(caplog):
+    app = FastAPI()
+
+    @app.get("/items/{item_id}")
+    async def item(item_id: str):
+        logs.set_user("user_9")
+        logging.getLogger("test_logs.app").warning("looked up")
+        return {"item_id": item_id}
+
+    app.add_middleware(RequestLogMiddleware)
+    caplog.handler.addFilter(ContextFilter())
+    with caplog.at_level(logging.INFO), TestClient(app) as client:
+        response = client.get("/items/7", headers={"X-Request-ID": "abc"})
+        generated = client.get("/items/8").headers["x-request-id"]
+
+    assert response.headers["x-request-id"] == "abc"
+    assert len(generated) == 32
+    warning, access = [r for r in caplog.records if r.name in ("test_logs.app", "access")][:2]
+    assert (warning.request_id, warning.route, warning.user_id) == ("abc", "/items/{item_id}", "user_9")
+    assert (access.status, access.route, access.user_id) == (200, "/items/{item_id}", "user_9")
+    assert access.latency_ms >= 0
@@ -0,0 +1,290 @@
+"""Partition maintenance against a scratch Postgres database (TEST_DATABASE_URL)."""
+import os
+import random
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+async def conn():
+    import asyncpg
+    import server
+
+    conn = await asyncpg.connect(TEST_DATABASE_URL)
+    try:
+        await server.create_schema(conn)
+        yield conn
+    finally:
+        await conn.close()
+
+
+async def test_moving_rows_out_of_the_default_partition_is_not_synced(conn):
+    from partitioning import create_partition, partition_name
+    from sync import fetch_changes
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'P')", user_id, new_email())
+    # A month far enough ahead that only the default partition covers it
+    month = datetime(random.randint(2200, 2900), random.randint(1, 12), 1, tzinfo=timezone.utc)
+    await conn.execute(
+        "INSERT INTO trips (trip_id, user_id, start_time, distance_m) VALUES ($1, $2, $3, 1000)",
+        f"trip_{uuid.uuid4().hex[:12]}", user_id, month.replace(day=15)
+    )
+    cursor, _, rows, _ = await fetch_changes(conn, user_id, 0)
+    assert len(rows["trips"]) == 1
+
+    name = partition_name("trips", month)
+    try:
+        assert await create_partition(conn, "trips", month)
+        assert await conn.fetchval(f"SELECT COUNT(*) FROM {name} WHERE user_id = $1", user_id) == 1
+
+        after, _, changed, deleted = await fetch_changes(conn, user_id, cursor)
+        assert after == cursor
+        assert deleted["trips"] == [] and changed["trips"] == []
+        # Logging resumes once the move has committed
+        await conn.execute("UPDATE trips SET purpose = 'moved' WHERE user_id = $1", user_id)
+        assert len((await fetch_changes(conn, user_id, cursor))[2]["trips"]) == 1
+    finally:
+        await conn.execute(f"DROP TABLE IF EXISTS {name}")
+        await conn.execute("DELETE FROM users WHERE user_id = $1", user_id)
+
+
+# The tables as they were before partitioning and integer columns
+LEGACY_DDL = """
+    CREATE TABLE users (
+        id SERIAL PRIMARY KEY,
+        user_id VARCHAR(255) UNIQUE NOT NULL,
+        email VARCHAR(255) UNIQUE NOT NULL,
+        name VARCHAR(255),
+        picture TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+    CREATE TABLE vehicles (
+        id SERIAL PRIMARY KEY,
+        vehicle_id VARCHAR(255) UNIQUE NOT NULL,
+        user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+        name VARCHAR(255) NOT NULL,
+        make VARCHAR(255),
+        model VARCHAR(255),
+        year INTEGER,
+        business_percentage INTEGER DEFAULT 100,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+    CREATE TABLE trips (
+        id SERIAL PRIMARY KEY,
+        trip_id VARCHAR(255) UNIQUE NOT NULL,
+        user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+        vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
+        start_time TIMESTAMP WITH TIME ZONE NOT NULL,
+        end_time TIMESTAMP WITH TIME ZONE,
+        distance FLOAT NOT NULL,
+        start_location TEXT,
+        end_location TEXT,
+        purpose TEXT,
+        is_business BOOLEAN DEFAULT TRUE,
+        is_automatic BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+    CREATE TABLE expenses (
+        id SERIAL PRIMARY KEY,
+        expense_id VARCHAR(255) UNIQUE NOT NULL,
+        user_id VARCHAR(255) REFERENCES users(user_id) ON DELETE CASCADE,
+        vehicle_id VARCHAR(255) REFERENCES vehicles(vehicle_id) ON DELETE SET NULL,
+        amount FLOAT NOT NULL,
+        category VARCHAR(255) NOT NULL,
+        date TIMESTAMP WITH TIME ZONE NOT NULL,
+        notes TEXT,
+        receipt_image_base64 TEXT,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    );
+    INSERT INTO users (user_id, email) VALUES ('user_legacy', 'legacy@example.com');
+    INSERT INTO trips (trip_id, user_id, start_time, distance) VALUES ('trip_legacy', 'user_legacy', '2023-05-01', 12.5);
+    INSERT INTO expenses (expense_id, user_id, amount, category, date)
+    VALUES ('expense_legacy', 'user_legacy', 19.99, 'fuel', '2023-05-01');
+"""
+
+
+@pytest.fixture
+async def legacy_schemas():
+    """Creates fresh schemas holding the legacy tables; returns a URL for each."""
+    import asyncpg
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schemas = []
+
+    async def create():
+        schema = f"legacy_{uuid.uuid4().hex[:8]}"
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        schemas.append(schema)
+        separator = "&" if "?" in TEST_DATABASE_URL else "?"
+        url = f"{TEST_DATABASE_URL}{separator}search_path={schema}"
+        conn = await asyncpg.connect(url)
+        await conn.execute(LEGACY_DDL)
+        await conn.close()
+        return url
+
+    try:
+        yield create
+    finally:
+        for schema in schemas:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+@pytest.fixture
+async def legacy_database(legacy_schemas, monkeypatch):
+    """DATABASE_URL pointing at a fresh schema holding the legacy tables, no shards."""
+    url = await legacy_schemas()
+    monkeypatch.setenv("DATABASE_URL", url)
+    monkeypatch.setenv("SHARD_DATABASE_URLS", "")
+    return url
+
+
+async def test_startup_leaves_float_columns_to_the_cli(legacy_database):
+    import asyncpg
+    import server
+    from compact_types import column_type
+
+    conn = await asyncpg.connect(legacy_database)
+    try:
+        with pytest.raises(RuntimeError, match="compact_types.py migrate"):
+            await server.create_schema(conn)
+        assert await column_type(conn, "trips", "distance") == "double precision"
+        assert await column_type(conn, "expenses", "amount") == "double precision"
+    finally:
+        await conn.close()
+
+
+async def test_migrate_converts_online_keeping_both_columns_in_step(legacy_database):
+    import asyncpg
+    from compact_types import has_column, migrate_compact_types, pending_compact_types
+    from repository import METERS_PER_MILE
+
+    conn = await asyncpg.connect(legacy_database)
+    try:
+        await conn.execute(
+            """INSERT INTO trips (trip_id, user_id, start_time, distance)
+               SELECT 'trip_' || i, 'user_legacy', '2023-06-01', i / 4.0 FROM generate_series(1, 10) AS i"""
+        )
+        await migrate_compact_types(conn, batch=3, keep_legacy=True)
+        # Filled in, so the app can start while older instances still use the FLOAT columns
+        assert await pending_compact_types(conn) == []
+        assert await conn.fetchval("SELECT COUNT(*) FROM trips WHERE distance_m IS NULL") == 0
+        assert await conn.fetchval("SELECT distance_m FROM trips WHERE trip_id = 'trip_7'") == round(1.75 * METERS_PER_MILE)
+
+        # Writers of either column see the other's rows
+        await conn.execute(
+            """INSERT INTO trips (trip_id, user_id, start_time, distance)
+               VALUES ('trip_old', 'user_legacy', '2023-06-02', 2.0)"""
+        )
+        await conn.execute(
+            """INSERT INTO trips (trip_id, user_id, start_time, distance_m)
+               VALUES ('trip_new', 'user_legacy', '2023-06-02', 1609)"""
+        )
+        await conn.execute("UPDATE trips SET distance_m = 3219 WHERE trip_id = 'trip_legacy'")
+        await conn.execute("UPDATE trips SET distance = 0.5 WHERE trip_id = 'trip_1'")
+        rows = {
+            row['trip_id']: (row['distance'], row['distance_m'])
+            for row in await conn.fetch("SELECT trip_id, distance, distance_m FROM trips")
+        }
+        assert rows['trip_old'] == (2.0, round(2 * METERS_PER_MILE))
+        assert rows['trip_new'] == (pytest.approx(1609 / METERS_PER_MILE), 1609)
+        assert rows['trip_legacy'] == (pytest.approx(3219 / METERS_PER_MILE), 3219)
+        assert rows['trip_1'] == (0.5, round(0.5 * METERS_PER_MILE))
+        # The backfill left the legacy values untouched
+        assert rows['trip_9'][0] == 2.25
+
+        await migrate_compact_types(conn)
+        assert not await has_column(conn, "trips", "distance")
+        assert not await has_column(conn, "expenses", "amount")
+        assert await conn.fetchval(
+            "SELECT attnotnull FROM pg_attribute WHERE attrelid = 'trips'::regclass AND attname = 'distance_m'"
+        )
+        assert await conn.fetchval("SELECT amount_cents FROM expenses WHERE expense_id = 'expense_legacy'") == 1999
+        assert await conn.fetchval(
+            "SELECT COUNT(*) FROM pg_trigger WHERE tgrelid IN ('trips'::regclass, 'expenses'::regclass) AND tgname LIKE '%sync'"
+        ) == 0
+    finally:
+        await conn.close()
+
+
+async def test_migrate_cli_widens_integer_cents(legacy_database):
+    import asyncpg
+    import compact_types
+    import partitioning
+    from compact_types import column_type
+
+    await partitioning.main(["migrate"])
+    conn = await asyncpg.connect(legacy_database)
+    try:
+        # As converted before amount_cents was BIGINT
+        await conn.execute("ALTER TABLE expenses ALTER COLUMN amount_cents TYPE INTEGER")
+        await compact_types.main(["migrate"])
+        assert await column_type(conn, "expenses", "amount_cents") == "bigint"
+        assert await column_type(conn, "trips", "distance_m") == "integer"
+        assert await conn.fetchval("SELECT amount_cents FROM expenses WHERE expense_id = 'expense_legacy'") == 1999
+    finally:
+        await conn.close()
+
+
+async def test_migrate_cli_converts_a_legacy_database(legacy_database):
+    import asyncpg
+    import partitioning
+    import server
+    from compact_types import column_type
+    from storage import PostgresStorage
+
+    await partitioning.main(["migrate"])
+
+    conn = await asyncpg.connect(legacy_database)
+    try:
+        for table in partitioning.PARTITIONED_TABLES:
+            assert await partitioning.is_partitioned(conn, table)
+        assert await column_type(conn, "expenses", "amount_cents") == "bigint"
+        # The app starts on the migrated tables and reads the legacy rows through them
+        await server.create_schema(conn)
+    finally:
+        await conn.close()
+
+    pool = await asyncpg.create_pool(legacy_database, min_size=1, max_size=2)
+    try:
+        async def get_pool(*args):
+            return pool
+
+        store = PostgresStorage(get_pool, get_pool)
+        [trip] = await store.list_trips("user_legacy")
+        [expense] = await store.list_expenses("user_legacy")
+        assert (trip['trip_id'], trip['distance']) == ("trip_legacy", 12.5)
+        assert (expense['expense_id'], expense['amount'], expense['receipt_url']) == ("expense_legacy", 19.99, None)
+    finally:
+        await pool.close()
+
+
+async def test_migrate_cli_converts_every_shard(legacy_schemas, monkeypatch):
+    import asyncpg
+    import partitioning
+
+    primary, shard = await legacy_schemas(), await legacy_schemas()
+    monkeypatch.setenv("DATABASE_URL", primary)
+    monkeypatch.setenv("SHARD_DATABASE_URLS", f"east={shard}")
+
+    await partitioning.main(["migrate"])
+
+    for url in (primary, shard):
+        conn = await asyncpg.connect(url)
+        try:
+            for table in partitioning.PARTITIONED_TABLES:
+                assert await partitioning.is_partitioned(conn, table)
+        finally:
+            await conn.close()
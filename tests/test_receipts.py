@@ -0,0 +1,58 @@
+"""Receipt normalization, run in-process."""
+import base64
+import io
+
+import pytest
+
+
+def jpeg_data_url(size, exif=None) -> str:
+    from PIL import Image
+
+    buffer = io.BytesIO()
+    Image.new("RGB", size, "white").save(buffer, "JPEG", exif=exif or Image.Exif())
+    return f"data:image/jpeg;base64,{base64.b64encode(buffer.getvalue()).decode()}"
+
+
+def opened(data_url: str):
+    from PIL import Image
+
+    header, _, data = data_url.partition(",")
+    assert header == "data:image/webp;base64"
+    return Image.open(io.BytesIO(base64.b64decode(data)))
+
+
+def test_phone_photos_are_upright_scaled_and_stripped():
+    from PIL import Image
+    from receipts import MAX_DIMENSION, THUMBNAIL_DIMENSION, normalize_receipt
+
+    exif = Image.Exif()
+    # Taken sideways, with a location
+    exif[0x0112] = 6
+    exif[0x8825] = {2: (40.0, 0.0, 0.0)}
+    receipt, thumbnail = normalize_receipt(jpeg_data_url((3000, 1500), exif))
+
+    with opened(receipt) as image:
+        assert image.size == (MAX_DIMENSION // 2, MAX_DIMENSION)
+        assert not image.getexif()
+    with opened(thumbnail) as image:
+        assert image.size == (THUMBNAIL_DIMENSION // 2, THUMBNAIL_DIMENSION)
+
+
+def test_small_images_are_not_enlarged():
+    from receipts import normalize_receipt
+
+    receipt, _ = normalize_receipt(jpeg_data_url((200, 100)))
+    with opened(receipt) as image:
+        assert image.size == (200, 100)
+
+
+@pytest.mark.parametrize("data, message", [
+    (b"not an image", "Unreadable receipt image"),
+    (b"\0" * 1025, "Receipt image is too large"),
+])
+def test_bad_uploads_are_rejected(data, message, monkeypatch):
+    import receipts
+
+    monkeypatch.setattr(receipts, "MAX_RECEIPT_BYTES", 1024)
+    with pytest.raises(ValueError, match=message):
+        receipts.normalize_receipt("data:image/png;base64," + base64.b64encode(data).decode())
@@ -0,0 +1,164 @@
+"""Tax report exports, streamed from a scratch Postgres schema (TEST_DATABASE_URL)."""
+import csv
+import io
+import os
+import re
+import uuid
+import zlib
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from fastapi.testclient import TestClient
+
+from .conftest import new_email
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+needs_postgres = pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+
+DAY = datetime(2025, 3, 1, tzinfo=timezone.utc)
+PERIOD = {"start_date": "2025-03-01T00:00:00Z", "end_date": "2025-03-31T23:59:59Z"}
+
+
+@pytest.fixture(scope="module")
+def client():
+    import server
+    with TestClient(server.app) as client:
+        yield client
+
+
+@pytest.fixture
+def pool(client, monkeypatch):
+    """A scratch schema on the client's event loop, holding every user's trips and expenses."""
+    import asyncpg
+    import server
+
+    schema = f"reports_{uuid.uuid4().hex[:8]}"
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+
+    async def create():
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"CREATE SCHEMA {schema}")
+        await admin.close()
+        pool = await asyncpg.create_pool(f"{TEST_DATABASE_URL}{separator}search_path={schema}", min_size=1, max_size=2)
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        return pool
+
+    async def drop(pool):
+        await pool.close()
+        admin = await asyncpg.connect(TEST_DATABASE_URL)
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+    pool = client.portal.call(create)
+
+    async def get_user_pool(user_id):
+        return pool
+
+    monkeypatch.setattr(server, "get_user_pool", get_user_pool)
+    yield pool
+    client.portal.call(drop, pool)
+
+
+def premium_user(client) -> tuple:
+    """(user_id, auth headers) for a new user on the Premium plan."""
+    import server
+
+    async def create():
+        user_id = await server.storage.upsert_user(f"user_{uuid.uuid4().hex[:12]}", new_email(), "Reports", None)
+        token = uuid.uuid4().hex
+        await server.storage.create_session(user_id, token, datetime.now(timezone.utc) + timedelta(days=7))
+        await server.storage.create_subscription(f"sub_{uuid.uuid4().hex[:12]}", user_id, "premium")
+        return user_id, {"Authorization": f"Bearer {token}"}
+
+    return client.portal.call(create)
+
+
+def add_line_items(client, pool, user_id: str, trips: int, expenses: int):
+    """Trips and expenses spread over March, plus one of each in April."""
+    async def create():
+        async with pool.acquire() as conn:
+            await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'R')", user_id, new_email())
+            for day in [i % 28 for i in range(trips)] + [35]:
+                await conn.execute(
+                    """INSERT INTO trips (trip_id, user_id, start_time, distance_m, purpose)
+                       VALUES ($1, $2, $3, 16093, 'Site visit')""",
+                    f"trip_{uuid.uuid4().hex[:12]}", user_id, DAY + timedelta(days=day)
+                )
+            for day in [i % 28 for i in range(expenses)] + [35]:
+                await conn.execute(
+                    """INSERT INTO expenses (expense_id, user_id, amount_cents, category, date)
+                       VALUES ($1, $2, 1250, 'fuel', $3)""",
+                    f"expense_{uuid.uuid4().hex[:12]}", user_id, DAY + timedelta(days=day)
+                )
+
+    client.portal.call(create)
+
+
+def pdf_text_lines(data: bytes) -> list:
+    """Every text line drawn in the PDF's content streams."""
+    lines = []
+    for stream in re.findall(rb"stream\n(.*?)\nendstream", data, re.DOTALL):
+        lines += re.findall(rb"^\((.*)\) '$", zlib.decompress(stream), re.MULTILINE)
+    return [line.decode("latin-1") for line in lines]
+
+
+@needs_postgres
+def test_csv_export_streams_a_row_per_line_item(client, pool):
+    from reports import EXPORT_COLUMNS
+
+    user_id, headers = premium_user(client)
+    add_line_items(client, pool, user_id, trips=3, expenses=2)
+
+    response = client.get("/api/reports/tax/export", params={**PERIOD, "format": "csv"}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="tax-report-2025-03-01-2025-03-31.csv"'
+
+    header, *rows = csv.reader(io.StringIO(response.text))
+    assert header == EXPORT_COLUMNS
+    assert [row[0] for row in rows] == ["trip"] * 3 + ["expense"] * 2
+    assert rows[0][5:] == ["10.0", "", "6.7"]
+    assert rows[-1][5:] == ["", "12.5", "12.5"]
+
+
+@needs_postgres
+def test_pdf_export_spans_pages(client, pool):
+    from pdf import LINES_PER_PAGE
+    from reports import PDF_COLUMN_HEADER
+
+    user_id, headers = premium_user(client)
+    add_line_items(client, pool, user_id, trips=LINES_PER_PAGE, expenses=5)
+
+    response = client.get("/api/reports/tax/export", params={**PERIOD, "format": "pdf"}, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/pdf"
+    assert response.content.startswith(b"%PDF-1.4") and response.content.endswith(b"%%EOF\n")
+
+    lines = pdf_text_lines(response.content)
+    assert sum(re.match(r"2025-03-\d\d trip ", line) is not None for line in lines) == LINES_PER_PAGE
+    assert sum(re.match(r"2025-03-\d\d expense ", line) is not None for line in lines) == 5
+    # Each page repeats the column header
+    assert lines.count(PDF_COLUMN_HEADER) == response.content.count(b"/Type /Page ") == 2
+    assert f"Business miles:     {LINES_PER_PAGE * 10.0:,.2f}" in lines
+
+
+@pytest.mark.parametrize("period, detail", [
+    ({"start_date": "March", "end_date": "2025-03-31"}, "start_date and end_date must be ISO 8601"),
+    ({"start_date": "2025-03-31", "end_date": "2025-03-01"}, "end_date is before start_date"),
+])
+def test_export_rejects_bad_periods(client, period, detail):
+    _, headers = premium_user(client)
+    response = client.get("/api/reports/tax/export", params=period, headers=headers)
+    assert (response.status_code, response.json()["detail"]) == (400, detail)
+
+
+def test_export_needs_postgres(client):
+    import server
+
+    if not isinstance(server.storage, server.MemoryStorage):
+        pytest.skip("Runs against the memory backend")
+    _, headers = premium_user(client)
+    response = client.get("/api/reports/tax/export", params=PERIOD, headers=headers)
+    assert response.status_code == 501
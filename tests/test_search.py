@@ -0,0 +1,129 @@
+"""Search ranking, paging and indexes against a scratch Postgres schema (TEST_DATABASE_URL)."""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+DAY = datetime(2025, 3, 1, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+async def conn():
+    import asyncpg
+    import server
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"search_{uuid.uuid4().hex[:8]}"
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    conn = await asyncpg.connect(f"{TEST_DATABASE_URL}{separator}search_path={schema}")
+    try:
+        await server.create_schema(conn)
+        yield conn
+    finally:
+        await conn.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+async def add_user(conn) -> str:
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'S')", user_id, new_email())
+    return user_id
+
+
+async def add_trip(conn, user_id: str, purpose: str, day: int = 0) -> str:
+    trip_id = f"trip_{uuid.uuid4().hex[:12]}"
+    await conn.execute(
+        """INSERT INTO trips (trip_id, user_id, start_time, distance_m, purpose)
+           VALUES ($1, $2, $3, 1609, $4)""",
+        trip_id, user_id, DAY + timedelta(days=day), purpose
+    )
+    return trip_id
+
+
+async def add_expense(conn, user_id: str, category: str, day: int = 0) -> str:
+    expense_id = f"expense_{uuid.uuid4().hex[:12]}"
+    await conn.execute(
+        """INSERT INTO expenses (expense_id, user_id, amount_cents, category, date)
+           VALUES ($1, $2, 1000, $3, $4)""",
+        expense_id, user_id, category, DAY + timedelta(days=day)
+    )
+    return expense_id
+
+
+async def test_better_matches_rank_first(conn):
+    from search import run_search
+
+    user_id = await add_user(conn)
+    partial = await add_trip(conn, user_id, "client call", day=2)
+    full = await add_trip(conn, user_id, "client lunch", day=1)
+    await add_trip(conn, user_id, "dentist", day=3)
+
+    hits, has_more = await run_search(conn, user_id, "client or lunch", 10, 0)
+    assert [hit['id'] for hit in hits] == [full, partial]
+    assert hits[0]['rank'] > hits[1]['rank']
+    assert not has_more
+
+
+async def test_pages_cover_every_hit_once(conn):
+    from search import run_search
+
+    user_id = await add_user(conn)
+    expenses = [await add_expense(conn, user_id, "fuel", day=day) for day in range(5)]
+    # Another user's entries never show up
+    await add_expense(conn, await add_user(conn), "fuel")
+
+    pages = [await run_search(conn, user_id, "fuel", 2, offset) for offset in (0, 2, 4)]
+    assert [len(hits) for hits, _ in pages] == [2, 2, 1]
+    assert [has_more for _, has_more in pages] == [True, True, False]
+    # Equal ranks come newest first
+    assert [hit['id'] for hits, _ in pages for hit in hits] == expenses[::-1]
+
+
+async def test_index_on_a_partitioned_table_is_built_per_partition(conn):
+    from partitioning import is_partitioned
+    from search import TRIP_VECTOR, build_search_index, index_valid
+
+    assert await is_partitioned(conn, "trips")
+    await build_search_index(conn, "trips", "idx_trips_test_search", f"({TRIP_VECTOR})")
+    assert await index_valid(conn, "idx_trips_test_search")
+    attached = await conn.fetchval(
+        "SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'idx_trips_test_search'::regclass"
+    )
+    partitions = await conn.fetchval("SELECT COUNT(*) FROM pg_inherits WHERE inhparent = 'trips'::regclass")
+    assert attached == partitions > 1
+    # Rerunning finds nothing left to build
+    await build_search_index(conn, "trips", "idx_trips_test_search", f"({TRIP_VECTOR})")
+
+
+async def test_fuzzy_matching_follows_the_trigram_indexes(conn):
+    from search import fuzzy_search_enabled, install_search_indexes, run_search
+
+    user_id = await add_user(conn)
+    trip_id = await add_trip(conn, user_id, "warehouse pickup")
+    assert not await fuzzy_search_enabled(conn)
+    assert (await run_search(conn, user_id, "warehous", 10, 0))[0] == []
+
+    await install_search_indexes(conn)
+    available = await conn.fetchval(
+        "SELECT COUNT(*) FROM pg_available_extensions WHERE name IN ('btree_gin', 'pg_trgm')"
+    )
+    if available < 2:
+        # Without the extensions search stays full-text only
+        assert not await fuzzy_search_enabled(conn)
+        pytest.skip("btree_gin or pg_trgm not installed")
+
+    assert await fuzzy_search_enabled(conn)
+    hits, _ = await run_search(conn, user_id, "warehous", 10, 0)
+    assert [hit['id'] for hit in hits] == [trip_id]
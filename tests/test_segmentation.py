@@ -0,0 +1,150 @@
+"""Trip segmentation of raw fixes; incremental runs use a scratch Postgres schema (TEST_DATABASE_URL)."""
+import os
+import time
+import uuid
+
+import numpy as np
+import pytest
+
+from .conftest import new_email
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+T0 = 1_700_000_000
+STEP = 30
+HOME = (40.0, -75.0)
+# A degree of latitude, in miles
+MILES_PER_DEGREE = 69.09
+
+
+def stop(start: float, minutes: int, at=HOME):
+    """Fixes every STEP seconds at one place, from `start` on."""
+    return [(at[0], at[1], start + i * STEP) for i in range(minutes * 60 // STEP + 1)]
+
+
+def drive(start: float, minutes: int, miles: float, origin=HOME):
+    """Fixes heading north at a steady speed, arriving `miles` away at start + minutes."""
+    count = minutes * 60 // STEP
+    return [
+        (origin[0] + miles / MILES_PER_DEGREE * i / count, origin[1], start + i * STEP)
+        for i in range(1, count + 1)
+    ]
+
+
+def arrays(fixes):
+    lat, lng, t = (np.asarray(column, dtype=float) for column in zip(*fixes))
+    return t, lat, lng
+
+
+def north(miles: float, origin=HOME):
+    return (origin[0] + miles / MILES_PER_DEGREE, origin[1])
+
+
+def test_stop_drive_stop_is_one_trip():
+    from segmentation import segment_fixes
+
+    fixes = stop(T0, 10) + drive(T0 + 600, 10, 5.0) + stop(T0 + 1230, 10, at=north(5.0))
+    t, lat, lng = arrays(fixes)
+    trips, anchor = segment_fixes(t, lat, lng)
+
+    [(start, end, miles)] = trips
+    # From the last fix of the first stop to the first fix of the second
+    assert t[start] == T0 + 600
+    assert t[end] == T0 + 1200
+    assert miles == pytest.approx(5.0, rel=0.01)
+    # The second stop is still going on
+    assert anchor == len(fixes) - 1
+
+
+def test_spikes_are_dropped():
+    from segmentation import drop_spikes, segment_fixes
+
+    fixes = stop(T0, 20)
+    # One fix 10 miles away, thirty seconds from its neighbours
+    fixes[20] = (*north(10.0), fixes[20][2])
+    t, lat, lng = arrays(fixes)
+
+    keep = drop_spikes(t, lat, lng)
+    assert not keep[20] and keep.sum() == len(fixes) - 1
+    trips, _ = segment_fixes(t[keep], lat[keep], lng[keep])
+    assert trips == []
+
+
+@pytest.mark.parametrize("minutes, miles", [
+    (4, 0.1),  # long enough, too short a distance
+    (1, 0.5),  # far enough, too quick
+])
+def test_drift_between_stops_is_not_a_trip(minutes, miles):
+    from segmentation import MIN_TRIP_MILES, MIN_TRIP_SECONDS, segment_fixes
+
+    assert miles < MIN_TRIP_MILES or minutes * 60 < MIN_TRIP_SECONDS
+    moved = T0 + 600 + minutes * 60
+    fixes = stop(T0, 10) + drive(T0 + 600, minutes, miles) + stop(moved + STEP, 10, at=north(miles))
+    trips, _ = segment_fixes(*arrays(fixes))
+    assert trips == []
+
+
+def test_a_long_stream_segments_quickly():
+    from segmentation import segment_fixes
+
+    fixes = []
+    start = T0
+    # A month of stop/drive legs, ~40k fixes
+    for leg in range(1000):
+        origin = north(leg * 3.0)
+        fixes += stop(start, 10, at=origin) + drive(start + 600, 10, 3.0, origin=origin)
+        start += 1200 + STEP
+    fixes += stop(start, 10, at=north(3000.0))
+    t, lat, lng = arrays(fixes)
+
+    started = time.perf_counter()
+    trips, _ = segment_fixes(t, lat, lng)
+    assert time.perf_counter() - started < 1
+    assert len(trips) == 1000
+
+
+@pytest.fixture
+async def conn():
+    import asyncpg
+    import server
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"segments_{uuid.uuid4().hex[:8]}"
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    conn = await asyncpg.connect(f"{TEST_DATABASE_URL}{separator}search_path={schema}")
+    try:
+        await server.create_schema(conn)
+        yield conn
+    finally:
+        await conn.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+async def test_later_runs_only_add_new_trips(conn):
+    from segmentation import segment_user, store_fixes
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'S')", user_id, new_email())
+
+    office = north(5.0)
+    first = stop(T0, 10) + drive(T0 + 600, 10, 5.0) + stop(T0 + 1230, 10, at=office)
+    await store_fixes(conn, user_id, [[lat, lng, ts] for lat, lng, ts in first])
+    [morning] = await segment_user(conn, user_id)
+    assert morning['distance'] == pytest.approx(5.0, rel=0.01)
+    # Nothing new, nothing written
+    assert await segment_user(conn, user_id) == []
+
+    back = T0 + 1230 + 600
+    second = drive(back, 10, 5.0, origin=office)
+    # Heading south, home again
+    second = [(2 * office[0] - lat, lng, ts) for lat, lng, ts in second]
+    second += stop(back + 630, 10)
+    await store_fixes(conn, user_id, [[lat, lng, ts] for lat, lng, ts in second])
+    [evening] = await segment_user(conn, user_id)
+    assert evening['trip_id'] != morning['trip_id']
+    assert evening['start_time'] >= morning['end_time']
+    assert await conn.fetchval("SELECT COUNT(*) FROM trips WHERE user_id = $1", user_id) == 2
@@ -0,0 +1,57 @@
+"""Expired-session sweeping against a scratch Postgres schema (TEST_DATABASE_URL)."""
+import os
+import uuid
+from datetime import timedelta
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+@pytest.fixture
+async def pool():
+    import asyncpg
+    import server
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"sessions_{uuid.uuid4().hex[:8]}"
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    pool = await asyncpg.create_pool(f"{TEST_DATABASE_URL}{separator}search_path={schema}", min_size=1, max_size=2)
+    try:
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        yield pool
+    finally:
+        await pool.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+async def test_sweep_deletes_only_expired_sessions_in_batches(pool, monkeypatch):
+    import sessions
+
+    monkeypatch.setattr(sessions, "SWEEP_BATCH_SIZE", 2)
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    async with pool.acquire() as conn:
+        await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'S')", user_id, new_email())
+        for expires in [timedelta(days=-1)] * 5 + [timedelta(days=1)]:
+            await conn.execute(
+                """INSERT INTO user_sessions (user_id, session_token, expires_at)
+                   VALUES ($1, $2, NOW() + $3)""",
+                user_id, uuid.uuid4().hex, expires
+            )
+
+    # Three batches: 2, 2 and the last 1
+    assert await sessions.sweep_expired_sessions(pool) == 5
+    async with pool.acquire() as conn:
+        assert await conn.fetchval("SELECT COUNT(*) FROM user_sessions WHERE expires_at > NOW()") == 1
+        assert await conn.fetchval("SELECT COUNT(*) FROM user_sessions") == 1
+    assert await sessions.sweep_expired_sessions(pool) == 0
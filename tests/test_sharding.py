@@ -0,0 +1,144 @@
+"""Shard placement and user moves; moves run between two scratch Postgres schemas (TEST_DATABASE_URL)."""
+import os
+import uuid
+from collections import Counter
+from datetime import datetime, timezone
+
+import pytest
+from fastapi import HTTPException
+
+from .conftest import new_email
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+
+def test_parse_shards():
+    from sharding import parse_shards
+
+    assert parse_shards("") == {}
+    assert parse_shards(" east = postgres://e/db , west=postgres://w/db,") == {
+        "east": "postgres://e/db", "west": "postgres://w/db",
+    }
+
+
+def test_ring_splits_users_evenly_and_adding_a_shard_only_takes_its_share():
+    from sharding import HashRing
+
+    users = [f"user_{i:06d}" for i in range(6000)]
+    before = HashRing(["primary", "east"])
+    after = HashRing(["primary", "east", "west"])
+
+    placed = Counter(before.shard_for(user) for user in users)
+    assert set(placed) == {"primary", "east"}
+    assert min(placed.values()) > 2000
+
+    moved = [user for user in users if before.shard_for(user) != after.shard_for(user)]
+    # Every moved user goes to the new shard, about a third of them
+    assert {after.shard_for(user) for user in moved} == {"west"}
+    assert 1500 < len(moved) < 2500
+
+
+@pytest.fixture
+async def router(monkeypatch):
+    """A router whose primary and `east` shard are two schemas of the test database."""
+    import asyncpg
+    import server
+    import sharding
+
+    monkeypatch.setattr(sharding, "DIRECTORY_CACHE_SECONDS", 0)
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    schemas = {name: f"{name}_{uuid.uuid4().hex[:8]}" for name in ("primary", "east")}
+    urls = {name: f"{TEST_DATABASE_URL}{separator}search_path={schema}" for name, schema in schemas.items()}
+    pools = []
+
+    async def create_pool(url):
+        pool = await asyncpg.create_pool(url, min_size=1, max_size=2)
+        pools.append(pool)
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+        return pool
+
+    for schema in schemas.values():
+        await admin.execute(f"CREATE SCHEMA {schema}")
+    try:
+        router = sharding.ShardRouter({"east": urls["east"]})
+        await router.start(await create_pool(urls["primary"]), create_pool)
+        # As in init_db, only the primary holds the directory
+        async with router.primary.acquire() as conn:
+            await sharding.install_shard_directory(conn)
+        yield router
+    finally:
+        for pool in pools:
+            await pool.close()
+        for schema in schemas.values():
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+async def count(pool, table: str, user_id: str) -> int:
+    async with pool.acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM {table} WHERE user_id = $1", user_id)
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+async def test_move_carries_rows_and_sync_state_to_the_target(router):
+    from sharding import move_user, set_moving
+
+    primary, east = router.pools["primary"], router.pools["east"]
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    async with primary.acquire() as conn:
+        await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'M')", user_id, new_email())
+        await conn.execute("INSERT INTO vehicles (vehicle_id, user_id, name) VALUES ('van', $1, 'Van')", user_id)
+        for i in range(3):
+            await conn.execute(
+                """INSERT INTO trips (trip_id, user_id, vehicle_id, start_time, distance_m)
+                   VALUES ($1, $2, 'van', $3, 1609)""",
+                f"trip_{i}", user_id, datetime(2025, i + 1, 1, tzinfo=timezone.utc)
+            )
+        seq = await conn.fetchval("SELECT seq FROM sync_state WHERE user_id = $1", user_id)
+
+    # Users without a directory row live on the primary
+    assert await router.pool_for(user_id) is primary
+
+    counts = await move_user(router, user_id, "east", grace=0)
+    assert (counts["vehicles"], counts["trips"]) == (1, 3)
+    assert await router.pool_for(user_id) is east
+    assert await count(east, "trips", user_id) == 3
+    # The copy's own writes are replaced by the source's log, so client cursors stay valid
+    async with east.acquire() as conn:
+        assert await conn.fetchval("SELECT seq FROM sync_state WHERE user_id = $1", user_id) == seq
+    # The primary keeps the users row but none of the data
+    assert await count(primary, "trips", user_id) == await count(primary, "vehicles", user_id) == 0
+    assert await count(primary, "users", user_id) == 1
+
+    # Moving again to the same shard does nothing
+    assert await move_user(router, user_id, "east", grace=0) == {}
+
+    async with primary.acquire() as conn:
+        await set_moving(conn, user_id, "east", True)
+    with pytest.raises(HTTPException) as frozen:
+        await router.pool_for(user_id)
+    assert frozen.value.status_code == 503 and "Retry-After" in frozen.value.headers
+    with pytest.raises(ValueError, match="already being moved"):
+        await move_user(router, user_id, "primary", grace=0)
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+async def test_new_users_are_placed_on_their_hashed_shard(router):
+    primary = router.pools["primary"]
+    users = [f"user_{uuid.uuid4().hex[:12]}" for _ in range(20)]
+    async with primary.acquire() as conn:
+        for user_id in users:
+            await conn.execute(
+                "INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'N')", user_id, new_email()
+            )
+            await router.place_new_user(conn, user_id)
+
+    for user_id in users:
+        expected = router.ring.shard_for(user_id)
+        assert await router.lookup(user_id, cached=False) == (expected, False)
+        # The shard has the users row its foreign keys need
+        assert await count(router.pools[expected], "users", user_id) == 1
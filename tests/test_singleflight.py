@@ -0,0 +1,80 @@
+"""Coalescing of identical concurrent calls."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pytestmark = pytest.mark.anyio
+
+
+def counting(result=None, error=None):
+    """A slow handler recording each run; every caller waits on `release`."""
+    from singleflight import single_flight
+
+    runs, release = [], asyncio.Event()
+
+    @single_flight
+    async def handler(*args, **kwargs):
+        runs.append((args, kwargs))
+        await release.wait()
+        if error:
+            raise error
+        return result if result is not None else object()
+
+    return handler, runs, release
+
+
+async def settle(*calls):
+    tasks = [asyncio.ensure_future(call) for call in calls]
+    await asyncio.sleep(0)
+    return tasks
+
+
+async def test_identical_calls_share_one_run():
+    handler, runs, release = counting()
+    user = SimpleNamespace(user_id="u1", name="A")
+    # Same user, though a different object with other profile fields
+    same_user = SimpleNamespace(user_id="u1", name="B")
+
+    tasks = await settle(handler(current_user=user), handler(current_user=same_user))
+    release.set()
+    first, second = await asyncio.gather(*tasks)
+    assert len(runs) == 1 and first is second
+
+    # Once done, the next call runs again
+    await handler(current_user=user)
+    assert len(runs) == 2
+
+
+async def test_different_arguments_run_separately():
+    handler, runs, release = counting()
+
+    tasks = await settle(
+        handler(current_user=SimpleNamespace(user_id="u1")),
+        handler(current_user=SimpleNamespace(user_id="u2")),
+        handler("2025", current_user=SimpleNamespace(user_id="u1")),
+    )
+    release.set()
+    await asyncio.gather(*tasks)
+    assert len(runs) == 3
+
+
+async def test_errors_reach_every_caller():
+    handler, runs, release = counting(error=RuntimeError("boom"))
+
+    tasks = await settle(handler("x"), handler("x"))
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert len(runs) == 1
+    assert [str(e) for e in results] == ["boom", "boom"]
+
+
+async def test_a_cancelled_caller_leaves_the_run_to_the_others():
+    handler, runs, release = counting(result="done")
+
+    leaving, staying = await settle(handler("x"), handler("x"))
+    leaving.cancel()
+    await asyncio.sleep(0)
+    release.set()
+    assert await staying == "done"
+    assert leaving.cancelled() and len(runs) == 1
@@ -0,0 +1,50 @@
+"""Cold start budget: importing the server and answering its first requests."""
+import json
+import os
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+BACKEND_DIR = Path(__file__).resolve().parent.parent / "backend"
+
+# Generous for shared CI machines; a cold start here takes about half of it
+STARTUP_BUDGET_SECONDS = float(os.getenv("STARTUP_BUDGET_SECONDS", "3"))
+
+# Only loaded by the requests that need them
+LAZY_MODULES = ["numpy._core", "PIL.ImageFile", "httpx._client", "passlib", "jose"]
+
+PROBE = """
+import json, sys, time
+started = time.perf_counter()
+import server
+imported = time.perf_counter()
+# Before the test client, which imports httpx itself
+loaded = [name for name in %r if name in sys.modules]
+from fastapi.testclient import TestClient
+with TestClient(server.app) as client:
+    assert client.get("/api/health").status_code == 200
+    assert client.get("/api/subscription/plans").status_code == 200
+    first_request = time.perf_counter()
+print(json.dumps({"import": imported - started, "total": first_request - started, "loaded": loaded}))
+""" % (LAZY_MODULES,)
+
+
+@pytest.fixture(scope="module")
+def probe() -> dict:
+    """Timings from a fresh interpreter, so nothing is already imported."""
+    env = {**os.environ, "STORAGE_BACKEND": "memory"}
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE], cwd=BACKEND_DIR, env=env,
+        capture_output=True, text=True, timeout=60, check=True
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def test_import_and_first_request_fit_the_budget(probe):
+    assert probe["total"] < STARTUP_BUDGET_SECONDS, probe
+
+
+def test_rarely_used_modules_are_not_imported_at_startup(probe):
+    assert probe["loaded"] == []
@@ -0,0 +1,333 @@
+"""Contract tests run against every storage backend.
+
+The Postgres backend is included when TEST_DATABASE_URL points at a scratch
+database; its schema is created there on first use.
+"""
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = pytest.mark.anyio
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+T0 = datetime(2025, 3, 10, 12, 0, tzinfo=timezone.utc)
+
+
+@pytest.fixture(params=[
+    "memory",
+    pytest.param("postgres", marks=pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")),
+])
+async def store(request):
+    from storage import MemoryStorage, PostgresStorage
+
+    if request.param == "memory":
+        yield MemoryStorage()
+        return
+
+    import asyncpg
+    import server
+
+    pool = await asyncpg.create_pool(TEST_DATABASE_URL, min_size=1, max_size=4)
+    try:
+        async with pool.acquire() as conn:
+            await server.create_schema(conn)
+
+        async def get_pool():
+            return pool
+
+        async def get_user_pool(user_id):
+            return pool
+
+        yield PostgresStorage(get_pool, get_user_pool)
+    finally:
+        await pool.close()
+
+
+async def new_user(store) -> str:
+    return await store.upsert_user(f"user_{uuid.uuid4().hex[:12]}", new_email(), "Test User", None)
+
+
+def vehicle(name="Car"):
+    from server import VehicleCreate
+    return VehicleCreate(name=name, make="Honda", model="Civic", year=2020)
+
+
+def trip(start=T0, distance=10.0, **fields):
+    from server import TripCreate
+    return TripCreate(start_time=start, distance=distance, **fields)
+
+
+def expense(date=T0, amount=12.34, category="fuel", **fields):
+    from server import ExpenseCreate
+    return ExpenseCreate(amount=amount, category=category, date=date, **fields)
+
+
+def test_incomplete_backend_cannot_be_instantiated():
+    from storage import Storage
+
+    class NoSubscriptions(Storage):
+        async def get_session_user(self, token):
+            return None
+
+    with pytest.raises(TypeError, match="change_plan"):
+        NoSubscriptions()
+
+
+async def test_upsert_user_keeps_existing_email(store):
+    email = new_email()
+    user_id = await store.upsert_user("user_a" + uuid.uuid4().hex[:8], email, "A", None)
+    again = await store.upsert_user("user_b" + uuid.uuid4().hex[:8], email, "B", None)
+    assert again == user_id
+
+
+async def test_sessions(store):
+    user_id = await new_user(store)
+    token = uuid.uuid4().hex
+    expires_at = datetime.now(timezone.utc) + timedelta(days=7)
+    await store.create_session(user_id, token, expires_at)
+
+    session = await store.get_session_user(token)
+    assert session['user_id'] == user_id
+    assert session['name'] == "Test User"
+    assert session['expires_at'] == expires_at
+
+    await store.delete_session(token)
+    assert await store.get_session_user(token) is None
+    assert await store.get_session_user("unknown") is None
+
+
+async def test_sessions_are_capped_per_user(store):
+    from sessions import MAX_SESSIONS_PER_USER
+
+    user_id = await new_user(store)
+    tokens = [uuid.uuid4().hex for _ in range(MAX_SESSIONS_PER_USER + 2)]
+    for token in tokens:
+        await store.create_session(user_id, token, datetime.now(timezone.utc) + timedelta(days=1))
+
+    assert await store.get_session_user(tokens[0]) is None
+    assert await store.get_session_user(tokens[1]) is None
+    assert await store.get_session_user(tokens[-1]) is not None
+
+
+async def test_vehicles(store):
+    user_id, other = await new_user(store), await new_user(store)
+    first = await store.insert_vehicle(f"vehicle_{uuid.uuid4().hex[:12]}", user_id, vehicle("First"))
+    second = await store.insert_vehicle(f"vehicle_{uuid.uuid4().hex[:12]}", user_id, vehicle("Second"))
+    assert first['business_percentage'] == 100 and first['year'] == 2020
+
+    assert [v['name'] for v in await store.list_vehicles(user_id)] == ["Second", "First"]
+    assert await store.list_vehicles(other) == []
+
+    assert not await store.delete_vehicle(first['vehicle_id'], other)
+    assert await store.delete_vehicle(first['vehicle_id'], user_id)
+    assert not await store.delete_vehicle(first['vehicle_id'], user_id)
+    assert [v['vehicle_id'] for v in await store.list_vehicles(user_id)] == [second['vehicle_id']]
+
+
+async def test_deleting_a_vehicle_unlinks_its_records(store):
+    user_id = await new_user(store)
+    car = await store.insert_vehicle(f"vehicle_{uuid.uuid4().hex[:12]}", user_id, vehicle())
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(vehicle_id=car['vehicle_id']))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(vehicle_id=car['vehicle_id']))
+
+    await store.delete_vehicle(car['vehicle_id'], user_id)
+    assert (await store.list_trips(user_id))[0]['vehicle_id'] is None
+    assert (await store.list_expenses(user_id))[0]['vehicle_id'] is None
+
+
+async def test_trips_round_trip_and_order(store):
+    user_id, other = await new_user(store), await new_user(store)
+    ids = []
+    for day, distance in enumerate([1.5, 12.346, 0.001]):
+        created = await store.insert_trip(
+            f"trip_{uuid.uuid4().hex[:12]}", user_id,
+            trip(T0 + timedelta(days=day), distance, purpose="client", start_location="A")
+        )
+        ids.append(created['trip_id'])
+        assert created['distance'] == round(distance, 3)
+        assert created['start_time'] == T0 + timedelta(days=day)
+        assert created['end_time'] is None and created['is_business'] and not created['is_automatic']
+
+    trips = await store.list_trips(user_id)
+    assert [t['trip_id'] for t in trips] == ids[::-1]
+    assert await store.list_trips(other) == []
+
+
+async def test_trip_list_is_limited_to_the_newest(store):
+    from repository import LIST_LIMIT
+
+    user_id = await new_user(store)
+    for minute in range(LIST_LIMIT + 5):
+        await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(T0 + timedelta(minutes=minute)))
+
+    trips = await store.list_trips(user_id)
+    assert len(trips) == LIST_LIMIT
+    assert trips[0]['start_time'] == T0 + timedelta(minutes=LIST_LIMIT + 4)
+    assert trips[-1]['start_time'] == T0 + timedelta(minutes=5)
+
+
+async def test_naive_times_are_utc(store):
+    user_id = await new_user(store)
+    created = await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(datetime(2025, 3, 10, 12, 0)))
+    assert created['start_time'] == T0
+
+
+async def test_update_trip(store):
+    user_id, other = await new_user(store), await new_user(store)
+    created = await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(purpose="before"))
+    later = await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(T0 + timedelta(days=1)))
+
+    assert await store.update_trip(created['trip_id'], other, {"distance": 5}) is None
+
+    updated = await store.update_trip(created['trip_id'], user_id, {
+        "distance": 7.25, "end_time": T0 + timedelta(hours=1), "start_time": T0 + timedelta(days=2),
+    })
+    assert updated['distance'] == 7.25
+    assert updated['purpose'] == "before"
+    assert updated['end_time'] == T0 + timedelta(hours=1)
+    # Moved in time, so now the newest
+    assert [t['trip_id'] for t in await store.list_trips(user_id)] == [created['trip_id'], later['trip_id']]
+
+    assert await store.update_trip("trip_missing", user_id, {"purpose": "x"}) is None
+
+
+async def test_delete_trip(store):
+    user_id, other = await new_user(store), await new_user(store)
+    created = await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip())
+    assert not await store.delete_trip(created['trip_id'], other)
+    assert await store.delete_trip(created['trip_id'], user_id)
+    assert not await store.delete_trip(created['trip_id'], user_id)
+    assert await store.list_trips(user_id) == []
+
+
+async def test_count_auto_trips_since(store):
+    user_id = await new_user(store)
+    before = datetime.now(timezone.utc) - timedelta(seconds=1)
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(is_automatic=True))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(is_automatic=True))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip())
+
+    assert await store.count_auto_trips_since(user_id, before) == 2
+    assert await store.count_auto_trips_since(user_id, datetime.now(timezone.utc) + timedelta(hours=1)) == 0
+
+
+async def test_expenses(store):
+    user_id, other = await new_user(store), await new_user(store)
+    plain = await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(amount=19.99, notes="gas"))
+    assert plain['amount'] == 19.99
+    assert plain['receipt_url'] is None and plain['receipt_thumbnail_base64'] is None
+
+    with_receipt = await store.insert_expense(
+        f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(T0 + timedelta(days=1)),
+        "data:image/webp;base64,AAAA", "data:image/webp;base64,BBBB"
+    )
+    assert with_receipt['receipt_url'] == f"/api/expenses/{with_receipt['expense_id']}/receipt"
+    assert with_receipt['receipt_thumbnail_base64'] == "data:image/webp;base64,BBBB"
+    assert "receipt_image_base64" not in dict(with_receipt)
+
+    assert [e['expense_id'] for e in await store.list_expenses(user_id)] == [
+        with_receipt['expense_id'], plain['expense_id']
+    ]
+    assert await store.get_receipt(with_receipt['expense_id'], user_id) == "data:image/webp;base64,AAAA"
+    assert await store.get_receipt(with_receipt['expense_id'], other) is None
+    assert await store.get_receipt(plain['expense_id'], user_id) is None
+
+    assert not await store.delete_expense(plain['expense_id'], other)
+    assert await store.delete_expense(plain['expense_id'], user_id)
+    assert len(await store.list_expenses(user_id)) == 1
+
+
+async def test_dashboard_totals(store):
+    user_id = await new_user(store)
+    year_start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    month_start = datetime(2025, 3, 1, tzinfo=timezone.utc)
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(datetime(2024, 12, 31, tzinfo=timezone.utc), 100))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(year_start, 10))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(month_start, 2.5))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(month_start, 4, is_business=False))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(datetime(2024, 6, 1, tzinfo=timezone.utc), 50))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(month_start, 20.5))
+
+    totals = await store.dashboard_totals(user_id, month_start, year_start)
+    assert totals['month_miles'] == pytest.approx(2.5, abs=1e-3)
+    assert totals['year_miles'] == pytest.approx(12.5, abs=1e-3)
+    assert totals['total_expenses'] == pytest.approx(20.5, abs=1e-3)
+
+    empty = await store.dashboard_totals(await new_user(store), month_start, year_start)
+    assert (empty['month_miles'], empty['year_miles'], empty['total_expenses']) == (0, 0, 0)
+
+
+async def test_tax_report_totals_include_both_ends(store):
+    user_id = await new_user(store)
+    start, end = datetime(2025, 1, 1, tzinfo=timezone.utc), datetime(2025, 12, 31, tzinfo=timezone.utc)
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(start, 3))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(end, 4, is_business=False))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(end + timedelta(seconds=1), 100))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(end, 10))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(start - timedelta(seconds=1), 99))
+
+    totals = await store.tax_report_totals(user_id, start, end)
+    assert totals['total_miles'] == pytest.approx(7, abs=1e-3)
+    assert totals['business_miles'] == pytest.approx(3, abs=1e-3)
+    assert totals['total_expenses'] == pytest.approx(10, abs=1e-3)
+
+
+async def test_timeseries_buckets_and_series(store):
+    user_id = await new_user(store)
+    vehicle_id = f"veh_{uuid.uuid4().hex[:12]}"
+    await store.insert_vehicle(vehicle_id, user_id, vehicle())
+    sunday, monday = datetime(2025, 3, 9, 23, 30, tzinfo=timezone.utc), datetime(2025, 3, 10, 0, 30, tzinfo=timezone.utc)
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(sunday, 5))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(monday, 2, vehicle_id=vehicle_id))
+    await store.insert_trip(f"trip_{uuid.uuid4().hex[:12]}", user_id, trip(monday, 1, is_business=False))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(monday, 10))
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense(monday, 2.5, category="parking"))
+
+    def rows(result):
+        return sorted(((r['bucket'], r['series'], round(r['value'], 3)) for r in result), key=lambda r: (r[0], r[1] or ""))
+
+    start, end = datetime(2025, 1, 1, tzinfo=timezone.utc), datetime(2026, 1, 1, tzinfo=timezone.utc)
+    week_of = lambda day: datetime(2025, 3, day, tzinfo=timezone.utc)
+    assert rows(await store.timeseries(user_id, "miles", "week", None, start, end)) == [
+        (week_of(3), "total", 5), (week_of(10), "total", 3)
+    ]
+    assert rows(await store.timeseries(user_id, "business_miles", "month", "vehicle", start, end)) == [
+        (week_of(1), None, 5), (week_of(1), vehicle_id, 2)
+    ]
+    assert rows(await store.timeseries(user_id, "trips", "year", "business", start, end)) == [
+        (start, "business", 2), (start, "personal", 1)
+    ]
+    assert rows(await store.timeseries(user_id, "expenses", "day", "category", start, end)) == [
+        (week_of(10), "fuel", 10), (week_of(10), "parking", 2.5)
+    ]
+    # The end is exclusive
+    assert rows(await store.timeseries(user_id, "miles", "day", None, start, monday)) == [(week_of(9), "total", 5)]
+
+
+async def test_change_seq_counts_writes(store):
+    user_id = await new_user(store)
+    assert await store.change_seq(user_id) == 0
+    trip_id = f"trip_{uuid.uuid4().hex[:12]}"
+    await store.insert_trip(trip_id, user_id, trip())
+    after_insert = await store.change_seq(user_id)
+    await store.update_trip(trip_id, user_id, {"distance": 3})
+    await store.delete_trip(trip_id, user_id)
+    await store.insert_expense(f"expense_{uuid.uuid4().hex[:12]}", user_id, expense())
+    assert 0 < after_insert < await store.change_seq(user_id)
+    assert await store.change_seq(await new_user(store)) == 0
+
+
+async def test_subscriptions(store):
+    user_id = await new_user(store)
+    assert await store.get_active_plan(user_id) is None
+
+    await store.create_subscription(f"sub_{uuid.uuid4().hex[:12]}", user_id, "basic")
+    assert await store.get_active_plan(user_id) == "basic"
+
+    await store.change_plan(f"sub_{uuid.uuid4().hex[:12]}", user_id, "premium")
+    assert await store.get_active_plan(user_id) == "premium"
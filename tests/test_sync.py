@@ -0,0 +1,135 @@
+"""Delta sync over the change log, against a scratch Postgres schema (TEST_DATABASE_URL)."""
+import os
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+
+from .conftest import new_email
+
+pytestmark = [
+    pytest.mark.anyio,
+    pytest.mark.skipif(not os.getenv("TEST_DATABASE_URL"), reason="TEST_DATABASE_URL not set"),
+]
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+DAY = datetime(2025, 3, 10, tzinfo=timezone.utc)
+
+
+@pytest.fixture
+async def conn():
+    import asyncpg
+    import server
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"sync_{uuid.uuid4().hex[:8]}"
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    conn = await asyncpg.connect(f"{TEST_DATABASE_URL}{separator}search_path={schema}")
+    try:
+        await server.create_schema(conn)
+        yield conn
+    finally:
+        await conn.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+async def add_user(conn) -> str:
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'S')", user_id, new_email())
+    return user_id
+
+
+async def add_trip(conn, user_id: str, trip_id: str):
+    await conn.execute(
+        "INSERT INTO trips (trip_id, user_id, start_time, distance_m) VALUES ($1, $2, $3, 1609)",
+        trip_id, user_id, DAY
+    )
+
+
+def ids(rows, column: str) -> set:
+    return {row[column] for row in rows}
+
+
+async def test_snapshot_then_deltas_with_tombstones(conn):
+    from sync import fetch_changes
+
+    user_id = await add_user(conn)
+    for trip_id in ("a", "b", "c"):
+        await add_trip(conn, user_id, trip_id)
+    await conn.execute(
+        """INSERT INTO expenses (expense_id, user_id, amount_cents, category, date)
+           VALUES ('fuel', $1, 1000, 'fuel', $2)""",
+        user_id, DAY
+    )
+
+    cursor, has_more, rows, deleted = await fetch_changes(conn, user_id, 0)
+    assert (cursor, has_more) == (4, False)
+    assert ids(rows['trips'], 'trip_id') == {"a", "b", "c"}
+    assert ids(rows['expenses'], 'expense_id') == {"fuel"}
+    assert deleted == {"vehicles": [], "trips": [], "expenses": []}
+
+    await conn.execute("UPDATE trips SET purpose = 'Client' WHERE trip_id = 'a'")
+    await conn.execute("DELETE FROM trips WHERE trip_id = 'b'")
+    await conn.execute("DELETE FROM expenses WHERE expense_id = 'fuel'")
+
+    cursor, has_more, rows, deleted = await fetch_changes(conn, user_id, cursor)
+    assert (cursor, has_more) == (7, False)
+    assert [row['purpose'] for row in rows['trips']] == ["Client"]
+    assert (deleted['trips'], deleted['expenses']) == (["b"], ["fuel"])
+
+    # Caught up
+    assert await fetch_changes(conn, user_id, cursor) == (7, False, {t: [] for t in rows}, {t: [] for t in rows})
+
+
+async def test_pages_follow_the_cursor(conn):
+    from sync import fetch_changes
+
+    user_id, other = await add_user(conn), await add_user(conn)
+    await add_trip(conn, user_id, "first")
+    cursor, *_ = await fetch_changes(conn, user_id, 0)
+    for i in range(5):
+        await add_trip(conn, user_id, f"trip_{i}")
+        # Other users' writes never show up
+        await add_trip(conn, other, f"other_{i}")
+
+    pages = []
+    has_more = True
+    while has_more:
+        cursor, has_more, rows, _ = await fetch_changes(conn, user_id, cursor, limit=2)
+        pages.append([row['trip_id'] for row in rows['trips']])
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert {trip_id for page in pages for trip_id in page} == {f"trip_{i}" for i in range(5)}
+
+
+async def test_an_edit_across_partitions_is_an_upsert(conn):
+    from sync import fetch_changes
+
+    user_id = await add_user(conn)
+    await add_trip(conn, user_id, "a")
+    cursor, *_ = await fetch_changes(conn, user_id, 0)
+
+    # Moves the row to another partition: a delete then an insert underneath
+    await conn.execute("UPDATE trips SET start_time = start_time - INTERVAL '45 days' WHERE trip_id = 'a'")
+    _, _, rows, deleted = await fetch_changes(conn, user_id, cursor)
+    assert [row['trip_id'] for row in rows['trips']] == ["a"]
+    assert deleted['trips'] == []
+
+
+async def test_skipped_writes_are_not_logged(conn):
+    from sync import fetch_changes, skip_change_log
+
+    user_id = await add_user(conn)
+    await add_trip(conn, user_id, "a")
+    cursor, *_ = await fetch_changes(conn, user_id, 0)
+
+    async with conn.transaction():
+        await skip_change_log(conn)
+        await conn.execute("UPDATE trips SET purpose = 'moved' WHERE trip_id = 'a'")
+    # Only for that transaction
+    await add_trip(conn, user_id, "b")
+
+    _, _, rows, _ = await fetch_changes(conn, user_id, cursor)
+    assert [row['trip_id'] for row in rows['trips']] == ["b"]
@@ -0,0 +1,142 @@
+"""Merging overlapping automatic trips; clustering runs against a scratch Postgres schema (TEST_DATABASE_URL)."""
+import io
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from .conftest import new_email
+
+TEST_DATABASE_URL = os.getenv("TEST_DATABASE_URL")
+
+T0 = datetime(2025, 3, 10, 10, 0, tzinfo=timezone.utc)
+
+
+def at(minutes: int) -> datetime:
+    return T0 + timedelta(minutes=minutes)
+
+
+def swept(trips):
+    """Trips as OVERLAPS_QUERY returns them: (id, start, end, meters) in sweep order."""
+    rows, covered_until = [], None
+    for trip_id, start, end, distance_m in trips:
+        rows.append({
+            "trip_id": trip_id, "vehicle_id": None, "start_time": at(start), "end_time": at(end),
+            "distance_m": distance_m, "end_location": f"end of {trip_id}", "covered_until": covered_until,
+        })
+        covered_until = max(filter(None, (covered_until, at(end))))
+    return rows
+
+
+def test_exact_duplicates_add_no_distance():
+    from trip_dedup import merge_cluster
+
+    merge = merge_cluster(swept([("a", 0, 60, 8000), ("b", 0, 60, 8000)]))
+    assert merge['survivor']['trip_id'] == "a"
+    assert [trip['trip_id'] for trip in merge['removed']] == ["b"]
+    assert (merge['end_time'], merge['distance_m']) == (at(60), 8000)
+
+
+def test_partial_overlap_counts_only_the_uncovered_part():
+    from trip_dedup import merge_cluster
+
+    # b's first half is covered by a
+    merge = merge_cluster(swept([("a", 0, 60, 6000), ("b", 30, 90, 4000)]))
+    assert (merge['end_time'], merge['end_location'], merge['distance_m']) == (at(90), "end of b", 8000)
+
+
+def test_contained_trip_adds_nothing_and_keeps_the_later_end():
+    from trip_dedup import merge_cluster
+
+    merge = merge_cluster(swept([("a", 0, 120, 10000), ("b", 20, 40, 3000)]))
+    assert (merge['end_time'], merge['end_location'], merge['distance_m']) == (at(120), "end of a", 10000)
+
+
+@pytest.fixture
+async def conn():
+    import asyncpg
+    import server
+
+    admin = await asyncpg.connect(TEST_DATABASE_URL)
+    schema = f"dedup_{uuid.uuid4().hex[:8]}"
+    await admin.execute(f"CREATE SCHEMA {schema}")
+    separator = "&" if "?" in TEST_DATABASE_URL else "?"
+    conn = await asyncpg.connect(f"{TEST_DATABASE_URL}{separator}search_path={schema}")
+    try:
+        await server.create_schema(conn)
+        yield conn
+    finally:
+        await conn.close()
+        await admin.execute(f"DROP SCHEMA {schema} CASCADE")
+        await admin.close()
+
+
+async def add_trips(conn, user_id: str, trips):
+    """Insert (trip_id, start minute, end minute or None, meters, is_automatic) rows."""
+    for trip_id, start, end, distance_m, automatic in trips:
+        await conn.execute(
+            """INSERT INTO trips (trip_id, user_id, start_time, end_time, distance_m, is_automatic)
+               VALUES ($1, $2, $3, $4, $5, $6)""",
+            trip_id, user_id, at(start), at(end) if end is not None else None, distance_m, automatic
+        )
+
+
+async def snapshot(conn, user_id: str):
+    return [tuple(row) for row in await conn.fetch(
+        "SELECT trip_id, start_time, end_time, distance_m FROM trips WHERE user_id = $1 ORDER BY trip_id",
+        user_id
+    )]
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+async def test_dedup_merges_chained_overlaps_and_leaves_the_rest(conn):
+    from trip_dedup import dedup_user
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'D')", user_id, new_email())
+    await add_trips(conn, user_id, [
+        # c overlaps only b, which overlaps a: one cluster
+        ("a", 0, 60, 6000, True),
+        ("b", 50, 120, 7000, True),
+        ("c", 110, 180, 7000, True),
+        # Manual trips and trips still being tracked are never merged
+        ("manual", 10, 40, 3000, False),
+        ("open", 20, None, 1000, True),
+        ("later", 300, 360, 5000, True),
+    ])
+    before = await snapshot(conn, user_id)
+
+    diff = io.StringIO()
+    assert await dedup_user(conn, user_id, apply=False, out=diff) == 2
+    assert diff.getvalue().count("@@") == 1
+    # diff only prints
+    assert await snapshot(conn, user_id) == before
+
+    assert await dedup_user(conn, user_id, apply=True, out=io.StringIO()) == 2
+    after = {trip_id: rest for trip_id, *rest in await snapshot(conn, user_id)}
+    assert set(after) == {"a", "manual", "open", "later"}
+    # All of a, then the 60 of 70 minutes of b and of c that nothing earlier covered
+    assert after["a"] == [at(0), at(180), 6000 + 6000 + 6000]
+    for trip_id in ("manual", "open", "later"):
+        assert after[trip_id] == [rest for other, *rest in before if other == trip_id][0]
+
+    # Nothing left to merge
+    assert await dedup_user(conn, user_id, apply=True, out=io.StringIO()) == 0
+
+
+@pytest.mark.anyio
+@pytest.mark.skipif(not TEST_DATABASE_URL, reason="TEST_DATABASE_URL not set")
+async def test_merge_matches_trips_by_id_alone(conn):
+    from trip_dedup import apply_merge, merge_cluster
+
+    user_id = f"user_{uuid.uuid4().hex[:12]}"
+    await conn.execute("INSERT INTO users (user_id, email, name) VALUES ($1, $2, 'D')", user_id, new_email())
+    await add_trips(conn, user_id, [("a", 0, 60, 6000, True), ("b", 30, 90, 4000, True)])
+    merge = merge_cluster(swept([("a", 0, 60, 6000), ("b", 30, 90, 4000)]))
+
+    # Both trips are edited after the merge was planned
+    await conn.execute("UPDATE trips SET start_time = start_time - INTERVAL '45 days' WHERE user_id = $1", user_id)
+    await apply_merge(conn, user_id, merge)
+    assert [row[0::2] for row in await snapshot(conn, user_id)] == [("a", at(90))]